@@ -1,3 +1,5 @@
+import copy
+import struct
 from Cartridge import Cartridge
 from OLC6502 import OLC6502
 from CPURam import CPURam
@@ -6,17 +8,24 @@ from OLC2C02 import OLC2C02
 
 class Bus:
     # Main component of NES Hardware
-    def __init__(self):
+    STATE_MAGIC = b"NESS"
+    STATE_VERSION = 1  # bump whenever the layout of a save state changes
+    STATE_HEADER = struct.Struct("<4sHH")  # magic, version, mapper id
+    STATE = struct.Struct("<Q2B2B")  # system clock, controllers, controller shift registers
+
+    def __init__(self, verbose=True):
+        self.verbose = verbose  # report the cart, resets and accesses to unmapped addresses on stdout
+        self.cart = None
         self.cpu = OLC6502()
         self.connect_to_bus("cpu", self.cpu)
         self.cpuram = CPURam()
         self.connect_to_bus("cpuram", self.cpuram)
         self.ppu = OLC2C02()
         self.connect_to_bus("ppu", self.ppu)
-        self.cart = None
         self.controller = [0, 0]
         self.controller_state = [0, 0]
         self.system_clock_counter = 0
+        self.run_ahead = 0  # frames ahead of the machine the pictures from run_frame are, see run_frame
         self.please_break = False
 
     def connect_to_bus(self, dev_type, dev):
@@ -26,6 +35,7 @@ class Bus:
         elif dev_type == "cpuram":
             self.cpuram = dev
             self.cpuram.bus = self
+            self.update_memory_map()
         elif dev_type == "ppu":
             self.ppu = dev
             self.ppu.bus = self
@@ -35,52 +45,269 @@ class Bus:
             self.cart.bus = self
             self.cpu.cart = dev
             self.ppu.cart = dev
+            self.update_memory_map()
         # print(dev_type, "is connected")
 
+    # The cpu address space is split into 256 pages of 256 bytes. A page backed by plain memory has a view of that
+    # memory in read_pages / write_pages and is accessed with a single index, every other page goes through the
+    # handler of the device living there
+
+    def update_memory_map(self):
+        # Rebuild the page tables, needed whenever a cart is connected or its mapper switches banks
+        self.read_pages = [None] * 256
+        self.write_pages = [None] * 256
+        self.read_handlers = [self.unmapped_read] * 256
+        self.write_handlers = [self.unmapped_write] * 256
+        ram = memoryview(self.cpuram.ram)
+        ram_pages = [ram[offset:offset + 0x100] for offset in range(0x000, 0x800, 0x100)]
+        self.read_pages[0x00:0x20] = self.write_pages[0x00:0x20] = ram_pages * 4  # 2kb of ram mirrored up to 0x1FFF
+        self.read_handlers[0x20:0x40] = [self.ppu_register_read] * 0x20
+        self.write_handlers[0x20:0x40] = [self.ppu_register_write] * 0x20
+        self.read_handlers[0x40] = self.io_read
+        self.write_handlers[0x40] = self.io_write
+        if self.cart is None:
+            return
+        self.read_handlers[0x41:] = [self.cart_read] * 0xBF
+        self.write_handlers[0x41:] = [self.cart_write] * 0xBF
+        cpu_read_page = self.cart.cpu_read_page
+        cpu_write_page = self.cart.cpu_write_page
+        self.read_pages[0x41:0x80] = [cpu_read_page(page) for page in range(0x41, 0x80)]
+        self.write_pages[0x41:] = [cpu_write_page(page) for page in range(0x41, 0x100)]
+        self.update_prg_pages()
+
+    def update_prg_pages(self):
+        # Point the pages from 0x8000 up at the PRG banks the mapper has switched in, called on every bank switch
+        for window in range(4):
+            first = 0x80 + (window << 5)
+            self.read_pages[first:first + 0x20] = self.cart.cpu_prg_pages(window)
+        self.cpu.idle_loops.clear()
+
     def cpu_write(self, addr, data):
-        if self.cart.cpu_write(addr, data):
-            pass
-        elif 0x0000 <= addr <= 0x1FFF:
-            self.cpuram.ram[addr & 0x07FF] = data
-        elif 0x2000 <= addr <= 0x3FFF:
-            self.ppu.cpu_write(addr & 0x0007, data)
-        elif 0x4016 <= addr <= 0x4017:
-            self.controller_state[addr & 0x0001] = self.controller[addr & 0x0001]
+        page = self.write_pages[addr >> 8]
+        if page is not None:
+            page[addr & 0xFF] = data
         else:
-            print("No device found at", hex(addr), "cannot write")
+            self.write_handlers[addr >> 8](addr, data)
 
     def cpu_read(self, addr, _b_read_only=False):
-        data = [0x00]
-        if self.cart.cpu_read(addr, data):
-            pass
-        elif 0x0000 <= addr <= 0x1FFF:
-            data[0] = self.cpuram.ram[addr & 0x07FF]
-        elif 0x2000 <= addr <= 0x3FFF:
-            data[0] = self.ppu.cpu_read(addr & 0x0007)
-        elif 0x4016 <= addr <= 0x4017:
-            data[0] = (self.controller_state[addr & 0x0001] & 0x80) > 0
-            self.controller_state[addr & 0x0001] = (self.controller_state[addr & 0x0001] << 1) & 0xFF
+        page = self.read_pages[addr >> 8]
+        if page is not None:
+            return page[addr & 0xFF]
+        return self.read_handlers[addr >> 8](addr)
+
+    def ppu_register_write(self, addr, data):
+        self.catch_up_ppu(3 * self.cpu.clock_count + 1)
+        self.ppu.cpu_write(addr & 0x0007, data)
+
+    def ppu_register_read(self, addr):
+        self.catch_up_ppu(3 * self.cpu.clock_count + 1)
+        return self.ppu.cpu_read(addr & 0x0007)
+
+    def io_write(self, addr, data):
+        if 0x4016 <= addr <= 0x4017:
+            self.controller_state[addr & 0x0001] = self.controller[addr & 0x0001]
         else:
+            self.unmapped_write(addr, data)
+
+    def io_read(self, addr):
+        if 0x4016 <= addr <= 0x4017:
+            data = (self.controller_state[addr & 0x0001] & 0x80) >> 7
+            self.controller_state[addr & 0x0001] = (self.controller_state[addr & 0x0001] << 1) & 0xFF
+            return data
+        return self.unmapped_read(addr)
+
+    def cart_write(self, addr, data):
+        # Mapper registers can change what the ppu sees, so it has to be up to date first
+        self.catch_up_ppu(3 * self.cpu.clock_count + 1)
+        if not self.cart.cpu_write(addr, data):
+            self.unmapped_write(addr, data)
+
+    def cart_read(self, addr):
+        data = self.cart.cpu_read(addr)
+        if data is None:
+            return self.unmapped_read(addr)
+        return data
+
+    def unmapped_write(self, addr, _data):
+        if self.verbose:
+            print("No device found at", hex(addr), "cannot write")
+
+    def unmapped_read(self, addr):
+        if self.verbose:
             print("No device found at", hex(addr), "cannot read. returning 0x0000")
-        return data[0]
+        return 0x00
 
     def insert_cart(self, path_to_file=None):
         if not path_to_file:
             print("No path given for cartridge")
             return
-        cart_obj = Cartridge(path_to_file)
+        cart_obj = Cartridge(path_to_file, self.verbose)
         self.connect_to_bus("cart", cart_obj)
 
     def reset(self):
         self.cpu.reset()
         self.system_clock_counter = 0
-        print("system reset")
+        if self.verbose:
+            print("system reset")
+
+    # The system clock counts ppu dots, a cpu cycle is 3 of them. The cpu runs whole instructions ahead of the ppu
+    # and the ppu is only brought up to the cpu's time when something depends on it: the cpu touching its
+    # registers, the vblank nmi and the end of a frame. An instruction happens on the dot its first cycle starts on
+
+    def catch_up_ppu(self, target):
+        # Clock the ppu until every dot before system clock tick target has been processed
+        if target > self.system_clock_counter:
+            self.ppu.run(target - self.system_clock_counter)
+            self.system_clock_counter = target
+
+    def next_ppu_event(self):
+        # System clock tick of the next dot on which the ppu can raise an nmi, finish a frame or clock the mapper
+        ppu = self.ppu
+        dots = min(ppu.dots_until(241, 1), ppu.dots_until(260, 340))
+        if self.cart.mapper.counts_scanlines:
+            dots = min(dots, ppu.dots_until_scanline())
+        return self.system_clock_counter + dots
+
+    def run_until(self, target):
+        # Run the system until every dot before system clock tick target has been processed
+        cpu = self.cpu
+        ppu = self.ppu
+        mapper = self.cart.mapper
+        step = cpu.step
+        idle_loop = cpu.idle_loop
+        while self.system_clock_counter < target:
+            limit = min(target, self.next_ppu_event() + 1)
+            end = (limit + 2) // 3  # first cpu cycle starting on or after the limit
+            if mapper.irq_active:
+                # The irq line is level triggered, it is taken at the first instruction boundary where the
+                # I flag is clear for as long as the mapper keeps it up
+                while cpu.clock_count < end:
+                    if mapper.irq_active:
+                        cpu.irq()
+                    step()
+            elif cpu.use_blocks:
+                run_block = cpu.run_block
+                while cpu.clock_count < end:
+                    pc = cpu.pc
+                    run_block(end)
+                    if cpu.pc <= pc and idle_loop(cpu.pc):
+                        self.skip_idle_loop(end)
+            else:
+                while cpu.clock_count < end:
+                    pc = cpu.pc
+                    step()
+                    if cpu.pc <= pc and idle_loop(cpu.pc):
+                        self.skip_idle_loop(end)
+            self.catch_up_ppu(limit)
+            if ppu.nmi:
+                ppu.nmi = False
+                cpu.nmi()
+
+    def skip_idle_loop(self, end):
+        # The cpu jumped back to the head of what may be an idle loop. Run two iterations of it, and if the second
+        # leaves the registers and flags as the first did and takes as long, every iteration up to cpu cycle end
+        # would too. They are skipped by only advancing the clock, except the last whole one and any part of one,
+        # which run normally since their reads may already see the ppu event at the end of the span
+        cpu = self.cpu
+        head = cpu.pc
+        length = cpu.idle_loop(head)
+        states = []
+        for _ in range(2):
+            start = cpu.clock_count
+            for _ in range(length):
+                if cpu.clock_count >= end:
+                    return
+                cpu.step()
+                if cpu.pc == head:
+                    break
+            if cpu.pc != head:
+                return
+            states.append((cpu.a, cpu.x, cpu.y, cpu.status, cpu.stkp, cpu.clock_count - start))
+        if states[0] != states[1]:
+            return
+        cycles = states[1][-1]
+        skipped = (end - cpu.clock_count) // cycles - 1
+        if skipped > 0:
+            cpu.clock_count += skipped * cycles
 
     def clock(self):
-        self.ppu.clock()
-        if self.system_clock_counter % 3 == 0:
-            self.cpu.clock()
-        if self.ppu.nmi:
-            self.ppu.nmi = False
-            self.cpu.nmi()
-        self.system_clock_counter += 1
+        # Advance the system by a single ppu dot
+        self.run_until(self.system_clock_counter + 1)
+
+    def finish_frame(self):
+        # Advance the system until the ppu completes the current frame
+        self.run_until(self.system_clock_counter + self.ppu.dots_until(260, 340) + 1)
+        self.ppu.frame_complete = False
+
+    def run_frame(self, indices=False):
+        # Advance the system until the ppu completes the current frame and return it as an image array, or as the
+        # ppu's own buffer of palette indices with indices.
+        # With run_ahead the picture is instead the one run_ahead frames later, when the controllers stay as they
+        # are now. That hides as many frames of the time a game takes to react to input. The frame itself and all
+        # but the last frame ahead run headless, then the state from the end of the frame is loaded again
+        if not self.run_ahead:
+            self.finish_frame()
+            return self.ppu.get_screen(indices)
+        ppu = self.ppu
+        ppu.headless = True
+        self.finish_frame()
+        state = self.save_state()
+        for _ in range(self.run_ahead - 1):
+            self.finish_frame()
+        ppu.headless = False
+        self.finish_frame()
+        screen = ppu.get_screen(indices)
+        self.load_state(state)
+        return screen
+
+    def clone(self):
+        # Independent copy of the machine, to try different inputs from the same point. Only the mutable state is
+        # copied, the rom and everything worked out from it is shared with the original
+        bus = copy.copy(self)
+        bus.controller = list(self.controller)
+        bus.controller_state = list(self.controller_state)
+        bus.cart = None
+        bus.cpuram = self.cpuram.clone()  # connected with the cart, which builds the memory map once for both
+        bus.cpuram.bus = bus
+        bus.connect_to_bus("cpu", self.cpu.clone())
+        bus.connect_to_bus("ppu", self.ppu.clone())
+        bus.connect_to_bus("cart", self.cart.clone())
+        return bus
+
+    # A save state is the header followed by the fixed layout state of the bus, cpu, ram, ppu and cart in that order.
+    # It only depends on the cart and the version, so states of the same game can be compared byte for byte. The
+    # ppu is always up to date with the system clock between calls to run_until, so any point outside one works,
+    # the end of a frame is the natural one
+
+    def save_state(self):
+        return b"".join((self.STATE_HEADER.pack(self.STATE_MAGIC, self.STATE_VERSION, self.cart.mapperID),
+                         self.STATE.pack(self.system_clock_counter, *self.controller, *self.controller_state),
+                         self.cpu.save_state(), self.cpuram.save_state(), self.ppu.save_state(),
+                         self.cart.save_state()))
+
+    def load_state(self, state):
+        # Restore a state saved from the same game with save_state
+        magic, version, mapper_id = self.STATE_HEADER.unpack_from(state, 0)
+        if magic != self.STATE_MAGIC:
+            raise ValueError("not a save state")
+        if version != self.STATE_VERSION:
+            raise ValueError("save state version {} is not supported, expected {}".format(version, self.STATE_VERSION))
+        if mapper_id != self.cart.mapperID:
+            raise ValueError("save state is for mapper {}, the cart uses mapper {}".format(mapper_id, self.cart.mapperID))
+        values = self.STATE.unpack_from(state, self.STATE_HEADER.size)
+        self.system_clock_counter = values[0]
+        self.controller[:] = values[1:3]
+        self.controller_state[:] = values[3:5]
+        offset = self.STATE_HEADER.size + self.STATE.size
+        offset = self.cpu.load_state(state, offset)
+        offset = self.cpuram.load_state(state, offset)
+        offset = self.ppu.load_state(state, offset)
+        offset = self.cart.load_state(state, offset)
+        if offset != len(state):
+            raise ValueError("save state has the wrong size for this cart")
+
+    def run_frames(self, n, indices=False):
+        # Advance n whole frames and return the last one
+        for _ in range(n - 1):
+            self.finish_frame()
+        return self.run_frame(indices)
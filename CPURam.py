@@ -2,5 +2,18 @@ class CPURam:
     def __init__(self):
         self.bus = None
         self.size = 2048
-        self.ram = [0x00 for _ in range(self.size)]
+        self.ram = bytearray(self.size)
         # self.ram = np.zeros((self.size,), dtype=np.uint8)
+
+    def clone(self):
+        ram = CPURam()
+        ram.ram[:] = self.ram
+        return ram
+
+    def save_state(self):
+        return bytes(self.ram)
+
+    def load_state(self, data, offset):
+        # Copied into the existing buffer, the bus page tables are views of it
+        self.ram[:] = data[offset:offset + self.size]
+        return offset + self.size
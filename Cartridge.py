@@ -1,19 +1,13 @@
-from Mappers import Mapper0
-from enum import Enum
-
-
-class MIRROR(Enum):
-    # Enumerations for the status register
-    HORIZONTAL = 0
-    VERTICAL = 1
-    ONESCREEN_LO = 2
-    ONESCREEN_HI = 3
+import copy
+import numpy as np
+from Mappers import MAPPERS, MIRROR
 
 
 class Cartridge:
-    def __init__(self, file_path):
+    def __init__(self, file_path, verbose=True):
         self.bus = None
         self.file_path = file_path
+        self.verbose = verbose  # print the header while loading
         self.header = self.CartHeader()
         self.MIRROR = MIRROR
         self.mirror = MIRROR.HORIZONTAL  # default is HORIZONTAL
@@ -23,6 +17,13 @@ class Cartridge:
         self.PRG_memory = []
         self.CHR_memory = []
         self.sram = []
+        self.prg_pages = []  # View of every 256 byte page of PRG memory
+        self.chr_pages = []  # View of every 1kb bank of CHR memory
+        self.chr_windows = []  # The CHR banks the ppu currently sees at 0x0000 - 0x1FFF
+        self.chr_tiles = None  # Every 16 byte tile of CHR memory decoded to 8x8 2 bit pixels
+        self.dirty_tiles = set()  # Tiles of chr ram written since they were last decoded
+        self.tile_map = None  # Index into chr_tiles of each of the 512 tiles the ppu currently sees
+        self.header_mirror = MIRROR.HORIZONTAL
         self.mapper = None
         self.load_rom()
 
@@ -39,29 +40,34 @@ class Cartridge:
             self.unused = ""
 
     def load_rom(self):
+        # The whole image is read once into an immutable bytes object and PRG/CHR rom are memoryviews into it,
+        # so nothing is copied and instances can share it
         with open(self.file_path, "rb") as rom:
-            self.header.name = rom.read(4).decode("utf-8")
-            print("name", self.header.name)
+            self.rom = rom.read()
+            image = memoryview(self.rom)
+            self.header.name = bytes(image[0:4]).decode("utf-8")
+            self.report("name", self.header.name)
 
-            self.header.prg_rom_chunks = int().from_bytes(rom.read(1), byteorder="little")
-            self.header.chr_rom_chunks = int().from_bytes(rom.read(1), byteorder="little")
-            print("prg rom chunks", self.header.prg_rom_chunks, "chr rom chunks", self.header.chr_rom_chunks)
+            self.header.prg_rom_chunks = image[4]
+            self.header.chr_rom_chunks = image[5]
+            self.report("prg rom chunks", self.header.prg_rom_chunks, "chr rom chunks", self.header.chr_rom_chunks)
 
-            self.header.mapper1 = int().from_bytes(rom.read(1), byteorder="little")
-            self.header.mapper2 = int().from_bytes(rom.read(1), byteorder="little")
-            print("mapper1", self.header.mapper1, "mapper2", self.header.mapper2)
+            self.header.mapper1 = image[6]
+            self.header.mapper2 = image[7]
+            self.report("mapper1", self.header.mapper1, "mapper2", self.header.mapper2)
 
-            self.header.prg_ram_size = int().from_bytes(rom.read(1), byteorder="little")
-            print("prg ram size", self.header.prg_ram_size)
+            self.header.prg_ram_size = image[8]
+            self.report("prg ram size", self.header.prg_ram_size)
 
-            self.header.tv_system1 = int().from_bytes(rom.read(1), byteorder="little")
-            self.header.tv_system2 = int().from_bytes(rom.read(1), byteorder="little")
-            print("tv system1", self.header.tv_system1, "tv system2", self.header.tv_system2)
+            self.header.tv_system1 = image[9]
+            self.header.tv_system2 = image[10]
+            self.report("tv system1", self.header.tv_system1, "tv system2", self.header.tv_system2)
 
-            self.header.unused = rom.read(5)
+            self.header.unused = bytes(image[11:16])
+            offset = 16
 
             if self.header.mapper1 & 0x04:
-                rom.read(512)
+                offset += 512
 
             file_type = 1
 
@@ -69,50 +75,119 @@ class Cartridge:
                 pass
             elif file_type == 1:
                 self.PRG_banks = self.header.prg_rom_chunks
-                self.PRG_memory = [0 for _ in range(self.PRG_banks * 16384)]
-                self.PRG_memory[:] = rom.read(len(self.PRG_memory))
+                self.PRG_memory = image[offset:offset + self.PRG_banks * 16384]
+                offset += len(self.PRG_memory)
 
                 self.CHR_banks = self.header.chr_rom_chunks
                 if self.CHR_banks == 0:
-                    self.CHR_memory = [0 for _ in range(8192)]
+                    self.CHR_memory = bytearray(8192)  # the cart has chr ram instead
                 else:
-                    self.CHR_memory = [0 for _ in range(self.CHR_banks * 8192)]
-                self.CHR_memory[:] = rom.read(len(self.CHR_memory))
+                    self.CHR_memory = image[offset:offset + self.CHR_banks * 8192]
 
             elif file_type == 2:
                 pass
 
             self.mapperID = ((self.header.mapper2 >> 4) << 4) | (self.header.mapper1 >> 4)
             self.mirror = MIRROR.VERTICAL if (self.header.mapper1 & 0x01) else MIRROR.HORIZONTAL
-            print("mapperID ", self.mapperID)
-            print("mirror mode", "vertical" if self.mirror == MIRROR.VERTICAL else "horizontal")
-            if self.mapperID == 0:
-                print("selected Mapper0")
-                self.mapper = Mapper0(self.PRG_banks, self.CHR_banks)
+            self.header_mirror = self.mirror
+            self.report("mapperID ", self.mapperID)
+            self.report("mirror mode", "vertical" if self.mirror == MIRROR.VERTICAL else "horizontal")
+            if self.mapperID in MAPPERS:
+                self.report("selected Mapper{}".format(self.mapperID))
+                self.mapper = MAPPERS[self.mapperID](self.PRG_banks, self.CHR_banks)
+                self.mapper.cart = self
             else:
                 print("Mapper{} not implemented yet".format(self.mapperID))
                 return None
-        self.sram = [0 for _ in range(0x2000)]
-
-    def cpu_read(self, addr, data):
-        mapped_addr = [0]
-        if self.mapper.cpu_map_read(addr, mapped_addr):
-            data[0] = self.PRG_memory[mapped_addr[0]]
-            # print("{} -> {} = {} reading from cartridge PRG mem".format(hex(addr), hex(mapped_addr[0]), hex(data[0])))
-            return True
+        self.sram = bytearray(0x2000)
+        chr_memory = memoryview(self.CHR_memory)
+        self.prg_pages = [self.PRG_memory[i:i + 0x100] for i in range(0, len(self.PRG_memory), 0x100)]
+        self.chr_pages = [chr_memory[i:i + 0x400] for i in range(0, len(self.CHR_memory), 0x400)]
+        self.chr_tiles = self.decode_tiles(self.CHR_memory)
+        self.update_banks()
+
+    def report(self, *args):
+        if self.verbose:
+            print(*args)
+
+    @staticmethod
+    def decode_tiles(chr_memory):
+        # Split 2bpp tiles (8 bytes of low bit plane, then 8 of high) into an (n, 8, 8) array of pixel values 0-3
+        planes = np.unpackbits(np.frombuffer(chr_memory, dtype=np.uint8).reshape(-1, 2, 8, 1), axis=3)
+        return planes[:, 0] | (planes[:, 1] << 1)
+
+    def pattern_tiles(self):
+        # Decoded tiles and the map from the ppu's tile numbers (0 - 511) into them, with chr ram writes applied
+        if self.dirty_tiles:
+            tiles = sorted(self.dirty_tiles)
+            memory = np.frombuffer(self.CHR_memory, dtype=np.uint8).reshape(-1, 16)
+            self.chr_tiles[tiles] = self.decode_tiles(memory[tiles])
+            self.dirty_tiles.clear()
+        return self.chr_tiles, self.tile_map
+
+    def update_banks(self):
+        # Point the memory views at the banks the mapper has switched in
+        self.chr_windows = [self.chr_pages[offset >> 10] for offset in self.mapper.chr_windows]
+        self.tile_map = ((np.array(self.mapper.chr_windows) >> 4)[:, None] + np.arange(64)).ravel()
+        self.mirror = self.mapper.mirror if self.mapper.mirror is not None else self.header_mirror
+        if self.bus is not None:
+            self.bus.update_prg_pages()
+
+    def clone(self):
+        # Copy of the cartridge for Bus.clone. The rom is shared and with it PRG and CHR rom and the decoded tiles,
+        # sram, chr ram and the mapper are copied
+        cart = copy.copy(self)
+        cart.bus = None
+        cart.sram = bytearray(self.sram)
+        cart.mapper = self.mapper.clone()
+        cart.mapper.cart = cart
+        cart.dirty_tiles = set(self.dirty_tiles)
+        if self.CHR_banks == 0:
+            cart.CHR_memory = bytearray(self.CHR_memory)
+            chr_memory = memoryview(cart.CHR_memory)
+            cart.chr_pages = [chr_memory[i:i + 0x400] for i in range(0, len(cart.CHR_memory), 0x400)]
+            cart.chr_tiles = self.chr_tiles.copy()
+        cart.update_banks()
+        return cart
+
+    def save_state(self):
+        # Sram, the mapper and chr ram when the cart has it
+        state = bytes(self.sram) + self.mapper.save_state()
+        if self.CHR_banks == 0:
+            state += bytes(self.CHR_memory)
+        return state
+
+    def load_state(self, data, offset):
+        # Restore the cart from data at offset and return the offset after it. Memory is copied into the existing
+        # buffers since the bus and the bank windows hold views of them
+        self.sram[:] = data[offset:offset + len(self.sram)]
+        offset = self.mapper.load_state(data, offset + len(self.sram))
+        if self.CHR_banks == 0:
+            self.CHR_memory[:] = data[offset:offset + len(self.CHR_memory)]
+            offset += len(self.CHR_memory)
+            self.chr_tiles = self.decode_tiles(self.CHR_memory)
+            self.dirty_tiles.clear()
+        self.update_banks()
+        return offset
+
+    def cpu_prg_pages(self, window):
+        # Views of the 32 pages of PRG memory showing in one of the 8kb cpu windows
+        first = self.mapper.prg_windows[window] >> 8
+        return self.prg_pages[first:first + 0x20]
+
+    def cpu_read(self, addr):
+        # The byte at a cpu address, None when the cart has nothing there
+        mapped_addr = self.mapper.cpu_map_read(addr)
+        if mapped_addr is not None:
+            return self.PRG_memory[mapped_addr]
         elif 0x6000 <= addr <= 0x7FFF:
-            addr &= 0x1FFF
-            data[0] = self.sram[addr]
-            # print("reading {} from sram[{}]".format(hex(data[0]), hex(addr)))
-            return True
+            return self.sram[addr & 0x1FFF]
         else:
-            return False
+            return None
 
     def cpu_write(self, addr, data):
-        mapped_addr = [0]
-        if self.mapper.cpu_map_write(addr, mapped_addr):
-            self.PRG_memory[mapped_addr[0]] = data
-            # print("{} -> {} = {} writing to cartridge PRG mem".format(hex(addr), hex(mapped_addr[0]), hex(data)))
+        if self.mapper.cpu_map_write(addr, data):
+            # PRG memory is rom, the write only reaches the mapper registers
             return True
         elif 0x6000 <= addr <= 0x7FFF:
             addr &= 0x1FFF
@@ -121,20 +196,34 @@ class Cartridge:
         else:
             return False
 
-    def ppu_read(self, addr, data):
-        mapped_addr = [0]
-        if self.mapper.ppu_map_read(addr, mapped_addr):
-            data[0] = self.CHR_memory[mapped_addr[0]]
-            # print("{} -> {} = {} reading from cartridge CHR mem".format(hex(addr), hex(mapped_addr[0]), hex(data[0])))
-            return True
+    def cpu_read_page(self, page):
+        # View of the memory behind a whole 256 byte cpu page, or None when reads there need cpu_read.
+        # PRG pages are banked so they are handed out by cpu_prg_pages instead
+        if 0x60 <= page <= 0x7F:
+            offset = (page << 8) & 0x1FFF
+            return memoryview(self.sram)[offset:offset + 0x100]
+        return None
+
+    def cpu_write_page(self, page):
+        # View of the memory behind a whole 256 byte cpu page, or None when writes there need cpu_write.
+        # PRG memory is rom so only sram can be written directly
+        if 0x60 <= page <= 0x7F:
+            offset = (page << 8) & 0x1FFF
+            return memoryview(self.sram)[offset:offset + 0x100]
+        return None
+
+    def ppu_read(self, addr):
+        # The byte at a ppu address, None when it is not pattern memory
+        if 0x0000 <= addr <= 0x1FFF:
+            return self.chr_windows[addr >> 10][addr & 0x03FF]
         else:
-            return False
+            return None
 
     def ppu_write(self, addr, data):
-        mapped_addr = [0]
-        if self.mapper.ppu_map_write(addr, mapped_addr):
-            self.CHR_memory[mapped_addr[0]] = data
-            # print("{} -> {} = {} writing to cartridge CHR mem".format(hex(addr), hex(mapped_addr[0]), hex(data)))
+        if 0x0000 <= addr <= 0x1FFF:
+            if self.CHR_banks == 0:  # chr rom ignores writes
+                self.chr_windows[addr >> 10][addr & 0x03FF] = data
+                self.dirty_tiles.add((self.mapper.chr_windows[addr >> 10] + (addr & 0x03FF)) >> 4)
             return True
         else:
             return False
@@ -0,0 +1,538 @@
+# Source snippets for every addressing mode and operation of the 6502. They are stitched together into one fused
+# handler per opcode when OLC6502 is imported, so the interpreter never has to look at the addressing mode at run time.
+#
+# Names available to a snippet:
+#   cpu     the OLC6502 executing the instruction
+#   read    cpu.bus.cpu_read
+#   write   cpu.bus.cpu_write
+#   pc      program counter, already pointing past the opcode byte. written back to cpu.pc by the handler
+#   cycles  cycles used by the instruction so far
+# Addressing modes set addr (effective address), rel (signed branch offset) or page_cross (extra cycle if the
+# operation allows it). Operations use {fetch} to get the operand into m and {store} to put a result back, which
+# become accumulator or memory accesses depending on the addressing mode.
+
+ADDR_MODES = {
+    "IMP": "",
+    "IMM": """
+addr = pc
+pc = (pc + 1) & 0xFFFF
+""",
+    "ZP0": """
+addr = read(pc) & 0x00FF
+pc = (pc + 1) & 0xFFFF
+""",
+    "ZPX": """
+addr = (read(pc) + cpu.x) & 0x00FF
+pc = (pc + 1) & 0xFFFF
+""",
+    "ZPY": """
+addr = (read(pc) + cpu.y) & 0x00FF
+pc = (pc + 1) & 0xFFFF
+""",
+    "REL": """
+rel = read(pc)
+pc = (pc + 1) & 0xFFFF
+if rel & 0x80:
+    rel -= 0x100
+""",
+    "ABS": """
+lo = read(pc)
+hi = read((pc + 1) & 0xFFFF)
+pc = (pc + 2) & 0xFFFF
+addr = (hi << 8) | lo
+""",
+    "ABX": """
+lo = read(pc)
+hi = read((pc + 1) & 0xFFFF)
+pc = (pc + 2) & 0xFFFF
+addr = (((hi << 8) | lo) + cpu.x) & 0xFFFF
+page_cross = (addr & 0xFF00) != (hi << 8)
+""",
+    "ABY": """
+lo = read(pc)
+hi = read((pc + 1) & 0xFFFF)
+pc = (pc + 2) & 0xFFFF
+addr = (((hi << 8) | lo) + cpu.y) & 0xFFFF
+page_cross = (addr & 0xFF00) != (hi << 8)
+""",
+    "IND": """
+ptr_lo = read(pc)
+ptr_hi = read((pc + 1) & 0xFFFF)
+pc = (pc + 2) & 0xFFFF
+ptr = (ptr_hi << 8) | ptr_lo
+if ptr_lo == 0x00FF:
+    addr = (read(ptr & 0xFF00) << 8) | read(ptr)
+else:
+    addr = (read(ptr + 1) << 8) | read(ptr)
+""",
+    "IZX": """
+t = read(pc)
+pc = (pc + 1) & 0xFFFF
+lo = read((t + cpu.x) & 0x00FF)
+hi = read((t + cpu.x + 1) & 0x00FF)
+addr = (hi << 8) | lo
+""",
+    "IZY": """
+t = read(pc)
+pc = (pc + 1) & 0xFFFF
+lo = read(t & 0x00FF)
+hi = read((t + 1) & 0x00FF)
+addr = (((hi << 8) | lo) + cpu.y) & 0xFFFF
+page_cross = (addr & 0xFF00) != (hi << 8)
+""",
+}
+
+# Addressing modes that can take an extra cycle when an indexed address crosses a page
+PAGE_CROSS_MODES = ("ABX", "ABY", "IZY")
+
+# Status register bits: C 0x01, Z 0x02, I 0x04, D 0x08, B 0x10, U 0x20, V 0x40, N 0x80
+# B is never held in the register, it only shows on the stack when BRK or PHP push it
+# N and Z are evaluated lazily. cpu.flags holds every other bit (N and Z always clear) and cpu.nz the last result
+# that set N and Z: Z is set when its low byte is 0 and N when bit 7 or bit 8 is. Most instructions just store
+# their result there, the full register is only put together when it is read (see OLC6502.status)
+BRANCH = """
+if {condition}:
+    addr = (pc + rel) & 0xFFFF
+    cycles += 1
+    if (addr & 0xFF00) != (pc & 0xFF00):
+        cycles += 1
+    pc = addr
+"""
+
+# operation name -> (takes the page cross cycle, source)
+OPERATIONS = {
+    "ADC": (True, """
+{fetch}
+a = cpu.a
+temp = a + m + (cpu.flags & 0x01)
+flags = (cpu.flags & 0x3C) | (0x01 if temp > 255 else 0)
+if (~(a ^ m) & (a ^ temp)) & 0x0080:
+    flags |= 0x40
+cpu.flags = flags
+cpu.nz = temp & 0x00FF
+cpu.a = temp & 0x00FF
+"""),
+    "AND": (True, """
+{fetch}
+a = cpu.a & m
+cpu.a = a
+cpu.nz = a
+"""),
+    "ASL": (False, """
+{fetch}
+temp = (m << 1) & 0xFF
+cpu.flags = (cpu.flags & 0x7C) | (0x01 if m & 0x80 else 0)
+cpu.nz = temp
+{store}
+"""),
+    "BCC": (False, BRANCH.format(condition="not cpu.flags & 0x01")),
+    "BCS": (False, BRANCH.format(condition="cpu.flags & 0x01")),
+    "BEQ": (False, BRANCH.format(condition="not cpu.nz & 0xFF")),
+    "BMI": (False, BRANCH.format(condition="cpu.nz & 0x180")),
+    "BNE": (False, BRANCH.format(condition="cpu.nz & 0xFF")),
+    "BPL": (False, BRANCH.format(condition="not cpu.nz & 0x180")),
+    "BVC": (False, BRANCH.format(condition="not cpu.flags & 0x40")),
+    "BVS": (False, BRANCH.format(condition="cpu.flags & 0x40")),
+    "BIT": (False, """
+{fetch}
+cpu.flags = (cpu.flags & 0xBF) | (m & 0x40)
+cpu.nz = (cpu.a & m) | ((m & 0x80) << 1)
+"""),
+    "BRK": (False, """
+pc = (pc + 1) & 0xFFFF
+stkp = cpu.stkp
+write(0x0100 + stkp, (pc >> 8) & 0x00FF)
+stkp = (stkp - 1) & 0xFF
+write(0x0100 + stkp, pc & 0x00FF)
+stkp = (stkp - 1) & 0xFF
+write(0x0100 + stkp, cpu.status | 0x30)
+cpu.stkp = (stkp - 1) & 0xFF
+cpu.flags |= 0x04
+pc = read(0xFFFE) | (read(0xFFFF) << 8)
+"""),
+    "CLC": (False, "cpu.flags &= ~0x01"),
+    "CLD": (False, "cpu.flags &= ~0x08"),
+    "CLI": (False, "cpu.flags &= ~0x04"),
+    "CLV": (False, "cpu.flags &= ~0x40"),
+    "CMP": (True, """
+{fetch}
+temp = (cpu.a - m) & 0xFF
+cpu.flags = (cpu.flags & 0x7C) | (0x01 if cpu.a >= m else 0)
+cpu.nz = temp
+"""),
+    "CPX": (False, """
+{fetch}
+temp = (cpu.x - m) & 0xFF
+cpu.flags = (cpu.flags & 0x7C) | (0x01 if cpu.x >= m else 0)
+cpu.nz = temp
+"""),
+    "CPY": (False, """
+{fetch}
+temp = (cpu.y - m) & 0xFF
+cpu.flags = (cpu.flags & 0x7C) | (0x01 if cpu.y >= m else 0)
+cpu.nz = temp
+"""),
+    "DEC": (False, """
+{fetch}
+temp = (m - 1) & 0xFF
+write(addr, temp)
+cpu.nz = temp
+"""),
+    "DEX": (False, """
+x = (cpu.x - 1) & 0xFF
+cpu.x = x
+cpu.nz = x
+"""),
+    "DEY": (False, """
+y = (cpu.y - 1) & 0xFF
+cpu.y = y
+cpu.nz = y
+"""),
+    "EOR": (True, """
+{fetch}
+a = cpu.a ^ m
+cpu.a = a
+cpu.nz = a
+"""),
+    "INC": (False, """
+{fetch}
+temp = (m + 1) & 0xFF
+write(addr, temp)
+cpu.nz = temp
+"""),
+    "INX": (False, """
+x = (cpu.x + 1) & 0xFF
+cpu.x = x
+cpu.nz = x
+"""),
+    "INY": (False, """
+y = (cpu.y + 1) & 0xFF
+cpu.y = y
+cpu.nz = y
+"""),
+    "JMP": (False, "pc = addr"),
+    "JSR": (False, """
+pc = (pc - 1) & 0xFFFF
+stkp = cpu.stkp
+write(0x0100 + stkp, (pc >> 8) & 0x00FF)
+stkp = (stkp - 1) & 0xFF
+write(0x0100 + stkp, pc & 0x00FF)
+cpu.stkp = (stkp - 1) & 0xFF
+pc = addr
+"""),
+    "LDA": (True, """
+{fetch}
+cpu.a = m
+cpu.nz = m
+"""),
+    "LDX": (True, """
+{fetch}
+cpu.x = m
+cpu.nz = m
+"""),
+    "LDY": (True, """
+{fetch}
+cpu.y = m
+cpu.nz = m
+"""),
+    "LSR": (False, """
+{fetch}
+temp = m >> 1
+cpu.flags = (cpu.flags & 0x7C) | (m & 0x01)
+cpu.nz = temp
+{store}
+"""),
+    "NOP": (False, ""),
+    "ORA": (True, """
+{fetch}
+a = cpu.a | m
+cpu.a = a
+cpu.nz = a
+"""),
+    "PHA": (False, """
+write(0x0100 + cpu.stkp, cpu.a)
+cpu.stkp = (cpu.stkp - 1) & 0xFF
+"""),
+    "PHP": (False, """
+write(0x0100 + cpu.stkp, cpu.status | 0x30)
+cpu.stkp = (cpu.stkp - 1) & 0xFF
+"""),
+    "PLA": (False, """
+stkp = (cpu.stkp + 1) & 0xFF
+cpu.stkp = stkp
+a = read(0x0100 + stkp)
+cpu.a = a
+cpu.nz = a
+"""),
+    "PLP": (False, """
+stkp = (cpu.stkp + 1) & 0xFF
+cpu.stkp = stkp
+cpu.status = read(0x0100 + stkp) | 0x20
+"""),
+    "ROL": (False, """
+{fetch}
+temp = (m << 1) | (cpu.flags & 0x01)
+cpu.flags = (cpu.flags & 0x7C) | (temp >> 8)
+temp &= 0xFF
+cpu.nz = temp
+{store}
+"""),
+    "ROR": (False, """
+{fetch}
+temp = (m | ((cpu.flags & 0x01) << 8)) >> 1
+cpu.flags = (cpu.flags & 0x7C) | (m & 0x01)
+cpu.nz = temp
+{store}
+"""),
+    "RTI": (False, """
+stkp = (cpu.stkp + 1) & 0xFF
+cpu.status = read(0x0100 + stkp)
+stkp = (stkp + 1) & 0xFF
+pc = read(0x0100 + stkp)
+stkp = (stkp + 1) & 0xFF
+pc |= read(0x0100 + stkp) << 8
+cpu.stkp = stkp
+"""),
+    "RTS": (False, """
+stkp = (cpu.stkp + 1) & 0xFF
+pc = read(0x0100 + stkp)
+stkp = (stkp + 1) & 0xFF
+pc |= read(0x0100 + stkp) << 8
+cpu.stkp = stkp
+pc = (pc + 1) & 0xFFFF
+"""),
+    "SBC": (True, """
+{fetch}
+a = cpu.a
+value = m ^ 0x00FF
+temp = a + value + (cpu.flags & 0x01)
+flags = (cpu.flags & 0x3C) | (temp >> 8)
+if (temp ^ a) & (temp ^ value) & 0x80:
+    flags |= 0x40
+cpu.flags = flags
+temp &= 0xFF
+cpu.nz = temp
+cpu.a = temp
+"""),
+    "SEC": (False, "cpu.flags |= 0x01"),
+    "SED": (False, "cpu.flags |= 0x08"),
+    "SEI": (False, "cpu.flags |= 0x04"),
+    "STA": (False, "write(addr, cpu.a)"),
+    "STX": (False, "write(addr, cpu.x)"),
+    "STY": (False, "write(addr, cpu.y)"),
+    "TAX": (False, """
+x = cpu.a & 0xFF
+cpu.x = x
+cpu.nz = x
+"""),
+    "TAY": (False, """
+y = cpu.a & 0xFF
+cpu.y = y
+cpu.nz = y
+"""),
+    "TSX": (False, """
+x = cpu.stkp & 0xFF
+cpu.x = x
+cpu.nz = x
+"""),
+    "TXA": (False, """
+a = cpu.x & 0xFF
+cpu.a = a
+cpu.nz = a
+"""),
+    "TXS": (False, "cpu.stkp = cpu.x & 0xFF"),
+    "TYA": (False, """
+a = cpu.y & 0xFF
+cpu.a = a
+cpu.nz = a
+"""),
+    "XXX": (False, ""),
+
+    # Unofficial Opcodes
+    "LAX": (True, """
+{fetch}
+cpu.a = m
+cpu.x = m
+cpu.nz = m
+"""),
+}
+
+# The only unofficial NOP that pays for a page cross
+PAGE_CROSS_NOPS = (0xFC,)
+
+
+def takes_page_cross(opcode, item):
+    # Whether the instruction pays an extra cycle when its indexed address crosses a page
+    if item.operation == "NOP":
+        return opcode in PAGE_CROSS_NOPS and item.addr_mode in PAGE_CROSS_MODES
+    return OPERATIONS[item.operation][0] and item.addr_mode in PAGE_CROSS_MODES
+
+
+def instruction_source(opcode, item, addressing=None, fetch=None):
+    # Body of the fused handler for one opcode, with the operand access specialised for its addressing mode.
+    # A translated block passes its own addressing and fetch source with the operands filled in
+    operation = OPERATIONS[item.operation][1]
+    if item.addr_mode == "IMP":
+        fetch = "m = cpu.a"
+        store = "cpu.a = temp"
+    else:
+        fetch = fetch or "m = read(addr)"
+        store = "write(addr, temp)"
+    lines = ["# {} {}".format(item.name, item.addr_mode), "cycles = {}".format(item.cycles)]
+    if addressing is None:
+        addressing = ADDR_MODES[item.addr_mode]
+    addressing = addressing.strip().splitlines()
+    if takes_page_cross(opcode, item):
+        lines += addressing
+        lines += operation.replace("{fetch}", fetch).replace("{store}", store).strip().splitlines()
+        lines += ["if page_cross:", "    cycles += 1"]
+    else:
+        lines += [line for line in addressing if not line.startswith("page_cross")]
+        lines += operation.replace("{fetch}", fetch).replace("{store}", store).strip().splitlines()
+    return lines
+
+
+def build_handler(opcode, item):
+    body = instruction_source(opcode, item)
+    source = "\n".join(body)
+    prologue = ["pc = cpu.pc"]
+    if "read(" in source:
+        prologue.append("read = cpu.bus.cpu_read")
+    if "write(" in source:
+        prologue.append("write = cpu.bus.cpu_write")
+    lines = ["def op_{:02X}(cpu):".format(opcode)]
+    lines += ["    " + line for line in prologue + body + ["cpu.pc = pc", "return cycles"]]
+    namespace = {}
+    exec(compile("\n".join(lines) + "\n", "<6502 op {:02X}>".format(opcode), "exec"), namespace)
+    return namespace["op_{:02X}".format(opcode)]
+
+
+def build_dispatch(instructions):
+    # One fused handler per opcode, indexed directly by the opcode byte
+    return [build_handler(opcode, item) for opcode, item in enumerate(instructions)]
+
+
+# Basic blocks
+# Straight line code can be translated into one function for the whole run of instructions, which costs a single
+# call instead of a dispatch per instruction and has the operand bytes baked in as constants. A block ends at any
+# instruction that changes the flow (branches, jumps, calls, returns, BRK) and after any write that could switch a
+# PRG bank, since the code after it may not be there anymore.
+
+BLOCK_LENGTH = 32  # Most instructions translated into one block
+
+# Addressing modes of translated code. {operand} is the byte after the opcode, {address} the word after it
+BLOCK_ADDR_MODES = {
+    "IMP": "",
+    "IMM": "",
+    "ZP0": "addr = {operand}",
+    "ZPX": "addr = ({operand} + cpu.x) & 0x00FF",
+    "ZPY": "addr = ({operand} + cpu.y) & 0x00FF",
+    "REL": "rel = {rel}",
+    "ABS": "addr = {address}",
+    "ABX": """
+addr = ({address} + cpu.x) & 0xFFFF
+page_cross = (addr & 0xFF00) != {page}
+""",
+    "ABY": """
+addr = ({address} + cpu.y) & 0xFFFF
+page_cross = (addr & 0xFF00) != {page}
+""",
+    "IND": "addr = (read({pointer_hi}) << 8) | read({address})",
+    "IZX": """
+lo = read(({operand} + cpu.x) & 0x00FF)
+hi = read(({operand} + cpu.x + 1) & 0x00FF)
+addr = (hi << 8) | lo
+""",
+    "IZY": """
+lo = read({operand})
+hi = read({operand_next})
+addr = (((hi << 8) | lo) + cpu.y) & 0xFFFF
+page_cross = (addr & 0xFF00) != (hi << 8)
+""",
+}
+
+# Number of operand bytes of each addressing mode
+OPERAND_SIZES = {"IMP": 0, "IMM": 1, "ZP0": 1, "ZPX": 1, "ZPY": 1, "REL": 1, "IZX": 1, "IZY": 1,
+                 "ABS": 2, "ABX": 2, "ABY": 2, "IND": 2}
+
+# Operations after which a block always ends
+BLOCK_ENDS = ("BCC", "BCS", "BEQ", "BMI", "BNE", "BPL", "BVC", "BVS", "BRK", "JMP", "JSR", "RTI", "RTS")
+
+
+class Block:
+    # A translated run of instructions
+    def __init__(self, run, code, lead):
+        self.run = run  # function executing the block on the cpu passed to it, None for code that did not fit one
+        self.code = code  # the bytes it was translated from
+        self.lead = lead  # most cycles the instructions before the last one can take
+
+
+def write_range(item, operand):
+    # Lowest and highest address the instruction can write to, None if it does not write memory
+    source = OPERATIONS[item.operation][1]
+    if "write(" not in source and not ("{store}" in source and item.addr_mode != "IMP"):
+        return None
+    if item.operation in ("PHA", "PHP", "JSR", "BRK"):
+        return 0x0100, 0x01FF
+    if item.addr_mode in ("ZP0", "ZPX", "ZPY"):
+        return 0x0000, 0x00FF
+    if item.addr_mode == "ABS":
+        return operand, operand
+    if item.addr_mode in ("ABX", "ABY"):
+        return operand, operand + 0xFF
+    return 0x0000, 0xFFFF
+
+
+def translate_block(instructions, read, start, limit, writes_end):
+    # Translate the code from start, staying below address limit. writes_end(low, high) tells whether a write to
+    # that range has to end the block. Returns None when not even one instruction fits
+    lines = []
+    code = []
+    pc = start
+    lead = 0
+    cycles = 0
+    ends = False
+    for _ in range(BLOCK_LENGTH):
+        opcode = read(pc)
+        item = instructions[opcode]
+        size = OPERAND_SIZES[item.addr_mode]
+        if pc + 1 + size > limit:
+            break
+        operands = [read(pc + 1 + i) for i in range(size)]
+        operand = operands[0] | (operands[1] << 8) if size == 2 else operands[0] if size else 0
+        values = {
+            "operand": "0x{:02X}".format(operand),
+            "operand_next": "0x{:02X}".format((operand + 1) & 0xFF),
+            "rel": operand - 0x100 if operand & 0x80 else operand,
+            "address": "0x{:04X}".format(operand),
+            "page": "0x{:04X}".format(operand & 0xFF00),
+            "pointer_hi": "0x{:04X}".format(operand & 0xFF00 if operand & 0xFF == 0xFF else operand + 1),
+        }
+        fetch = "m = 0x{:02X}".format(operand) if item.addr_mode == "IMM" else None
+        body = instruction_source(opcode, item, BLOCK_ADDR_MODES[item.addr_mode].format(**values), fetch)
+        pc = (pc + 1 + size) & 0xFFFF
+        ends = item.operation in BLOCK_ENDS
+        if ends:
+            body.insert(2, "pc = 0x{:04X}".format(pc))
+        body[0] = "# {:04X} {}".format((pc - 1 - size) & 0xFFFF, body[0][2:])
+        lines += body + ["cpu.clock_count += cycles"]
+        code += [opcode] + operands
+        lead += cycles
+        cycles = item.cycles + takes_page_cross(opcode, item) + (2 if item.operation in BLOCK_ENDS[:8] else 0)
+        written = write_range(item, operand)
+        if ends or (written is not None and writes_end(*written)) or pc < start:
+            break
+    if not code:
+        return None
+    lines += ["cpu.flags |= 0x20", "cpu.pc = pc" if ends else "cpu.pc = 0x{:04X}".format(pc)]
+    source = "\n".join(lines)
+    prologue = []
+    if "read(" in source:
+        prologue.append("read = cpu.bus.cpu_read")
+    if "write(" in source:
+        prologue.append("write = cpu.bus.cpu_write")
+    name = "block_{:04X}".format(start)
+    lines = ["def {}(cpu):".format(name)] + ["    " + line for line in prologue + lines]
+    namespace = {}
+    exec(compile("\n".join(lines) + "\n", "<6502 block {:04X}>".format(start), "exec"), namespace)
+    return Block(namespace[name], bytes(code), lead)
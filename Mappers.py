@@ -1,45 +1,310 @@
+import copy
+import struct
+from enum import Enum
+
+
+class MIRROR(Enum):
+    # Enumerations for the status register
+    HORIZONTAL = 0
+    VERTICAL = 1
+    ONESCREEN_LO = 2
+    ONESCREEN_HI = 3
+
+
 class Mapper:
+    counts_scanlines = False  # True when the mapper needs scanline() to be called on time, so the bus stops there
+    # Save states hold the windows, the mirroring (0xFF for the header's) and the irq line, followed by the
+    # registers a mapper lists in REGISTERS with their struct format in REGISTERS_FORMAT
+    STATE = struct.Struct("<4I8IB?")
+    REGISTERS = ()
+    REGISTERS_FORMAT = "<"
+    # PRG is seen by the cpu through four 8kb windows at 0x8000, 0xA000, 0xC000 and 0xE000, CHR by the ppu through
+    # eight 1kb windows. A mapper only keeps the offset of the bank showing in each window, a bank switch rewrites a
+    # few of those offsets and tells the cartridge, which points its memory views at the new banks
     def __init__(self, prg_banks, chr_banks):
         self.prg_banks = prg_banks
         self.chr_banks = chr_banks
+        self.cart = None  # Connection to cartridge
+        self.prg_windows = [0x0000, 0x2000, 0x4000, 0x6000]  # Offset into PRG memory of each 8kb cpu window
+        self.chr_windows = [0x0400 * i for i in range(8)]  # Offset into CHR memory of each 1kb ppu window
+        self.mirror = None  # Mirroring chosen by the mapper, None keeps the one from the rom header
+        self.irq_active = False  # State of the irq line the mapper drives, stays up until the mapper acknowledges it
+        self.set_prg_32k(0)
 
-    def cpu_map_read(self, addr, mapped_addr):
-        pass
+    def cpu_map_read(self, addr):
+        # Offset into PRG memory of a cpu address, None when the address is not PRG memory
+        if 0x8000 <= addr <= 0xFFFF:
+            return self.prg_windows[(addr >> 13) & 0x03] + (addr & 0x1FFF)
+        return None
 
-    def cpu_map_write(self, addr, mapped_addr):
-        pass
+    def cpu_map_write(self, addr, data):
+        # PRG memory is rom, mappers with registers override this to latch the data
+        return 0x8000 <= addr <= 0xFFFF
 
-    def ppu_map_read(self, addr, mapped_addr):
+    def scanline(self):
+        # Called by the ppu at dot 260 of every rendered scanline, where the sprite pattern fetches begin
         pass
 
-    def ppu_map_write(self, addr, mapped_addr):
-        pass
+    def clone(self):
+        # Copy of the mapper for Cartridge.clone
+        mapper = copy.copy(self)
+        mapper.prg_windows = list(self.prg_windows)
+        mapper.chr_windows = list(self.chr_windows)
+        return mapper
+
+    def save_state(self):
+        mirror = 0xFF if self.mirror is None else self.mirror.value
+        return (self.STATE.pack(*self.prg_windows, *self.chr_windows, mirror, self.irq_active) +
+                struct.pack(self.REGISTERS_FORMAT, *self.registers_state()))
+
+    def load_state(self, data, offset):
+        # Restore the mapper from data at offset and return the offset after it, the cartridge updates its views
+        values = self.STATE.unpack_from(data, offset)
+        self.prg_windows = list(values[0:4])
+        self.chr_windows = list(values[4:12])
+        self.mirror = None if values[12] == 0xFF else MIRROR(values[12])
+        self.irq_active = values[13]
+        offset += self.STATE.size
+        self.load_registers(struct.unpack_from(self.REGISTERS_FORMAT, data, offset))
+        return offset + struct.calcsize(self.REGISTERS_FORMAT)
+
+    def registers_state(self):
+        return [getattr(self, name) for name in self.REGISTERS]
+
+    def load_registers(self, values):
+        for name, value in zip(self.REGISTERS, values):
+            setattr(self, name, value)
+
+    def switched(self):
+        # Called after the windows or the mirroring changed
+        if self.cart is not None:
+            self.cart.update_banks()
+
+    def set_prg_8k(self, window, bank):
+        self.prg_windows[window] = (bank % (self.prg_banks * 2)) * 0x2000
+
+    def set_prg_16k(self, window, bank):
+        offset = (bank % self.prg_banks) * 0x4000
+        self.prg_windows[window * 2] = offset
+        self.prg_windows[window * 2 + 1] = offset + 0x2000
+
+    def set_prg_32k(self, bank):
+        if self.prg_banks < 2:
+            self.set_prg_16k(0, 0)
+            self.set_prg_16k(1, 0)
+            return
+        self.set_prg_16k(0, bank * 2)
+        self.set_prg_16k(1, bank * 2 + 1)
+
+    def set_chr_1k(self, window, bank):
+        self.chr_windows[window] = (bank % (max(self.chr_banks, 1) * 8)) * 0x0400
+
+    def set_chr_4k(self, window, bank):
+        for i in range(4):
+            self.set_chr_1k(window * 4 + i, bank * 4 + i)
+
+    def set_chr_8k(self, bank):
+        for i in range(8):
+            self.set_chr_1k(i, bank * 8 + i)
 
 
 class Mapper0(Mapper):
-    def cpu_map_read(self, addr, mapped_addr):
-        if 0x8000 <= addr <= 0xFFFF:
-            map_mask = 0x7FFF if self.prg_banks > 1 else 0x3FFF
-            mapped_addr[0] = addr & map_mask
-            return True
-        return False
+    # NROM, 16kb or 32kb of PRG and 8kb of CHR with nothing to switch
+    pass
 
-    def cpu_map_write(self, addr, mapped_addr):
-        if 0x8000 <= addr <= 0xFFFF:
-            map_mask = 0x7FFF if self.prg_banks > 1 else 0x3FFF
-            mapped_addr[0] = addr & map_mask
-            return True
-        return False
-
-    def ppu_map_read(self, addr, mapped_addr):
-        if 0x0000 <= addr <= 0x1FFF:
-            mapped_addr[0] = addr
-            return True
-        return False
-
-    def ppu_map_write(self, addr, mapped_addr):
-        if 0x0000 <= addr <= 0x1FFF:
-            if self.chr_banks == 0:
-                mapped_addr[0] = addr
-                return True
-        return False
+
+class Mapper1(Mapper):
+    # MMC1, registers are loaded one bit at a time through a 5 bit shift register
+    REGISTERS = ("load", "load_count", "control", "chr_bank0", "chr_bank1", "prg_bank")
+    REGISTERS_FORMAT = "<6B"
+
+    def __init__(self, prg_banks, chr_banks):
+        super().__init__(prg_banks, chr_banks)
+        self.load = 0x00
+        self.load_count = 0
+        self.control = 0x1C
+        self.chr_bank0 = 0
+        self.chr_bank1 = 0
+        self.prg_bank = 0
+        self.update()
+
+    def cpu_map_write(self, addr, data):
+        if not 0x8000 <= addr <= 0xFFFF:
+            return False
+        if data & 0x80:
+            # Reset the shift register and fix the last bank at 0xC000
+            self.load = 0x00
+            self.load_count = 0
+            self.control |= 0x0C
+        else:
+            self.load = (self.load >> 1) | ((data & 0x01) << 4)
+            self.load_count += 1
+            if self.load_count == 5:
+                target = (addr >> 13) & 0x03
+                if target == 0:
+                    self.control = self.load
+                elif target == 1:
+                    self.chr_bank0 = self.load
+                elif target == 2:
+                    self.chr_bank1 = self.load
+                else:
+                    self.prg_bank = self.load & 0x0F
+                self.load = 0x00
+                self.load_count = 0
+        self.update()
+        self.switched()
+        return True
+
+    def update(self):
+        self.mirror = (MIRROR.ONESCREEN_LO, MIRROR.ONESCREEN_HI, MIRROR.VERTICAL, MIRROR.HORIZONTAL)[self.control & 0x03]
+        prg_mode = (self.control >> 2) & 0x03
+        if prg_mode <= 1:
+            self.set_prg_32k(self.prg_bank >> 1)
+        elif prg_mode == 2:
+            self.set_prg_16k(0, 0)
+            self.set_prg_16k(1, self.prg_bank)
+        else:
+            self.set_prg_16k(0, self.prg_bank)
+            self.set_prg_16k(1, self.prg_banks - 1)
+        if self.control & 0x10:
+            self.set_chr_4k(0, self.chr_bank0)
+            self.set_chr_4k(1, self.chr_bank1)
+        else:
+            self.set_chr_8k(self.chr_bank0 >> 1)
+
+
+class Mapper2(Mapper):
+    # UxROM, switchable 16kb bank at 0x8000 and the last bank fixed at 0xC000
+    def __init__(self, prg_banks, chr_banks):
+        super().__init__(prg_banks, chr_banks)
+        self.set_prg_16k(0, 0)
+        self.set_prg_16k(1, self.prg_banks - 1)
+
+    def cpu_map_write(self, addr, data):
+        if not 0x8000 <= addr <= 0xFFFF:
+            return False
+        self.set_prg_16k(0, data & 0x0F)
+        self.switched()
+        return True
+
+
+class Mapper3(Mapper):
+    # CNROM, fixed PRG and a switchable 8kb CHR bank
+    def cpu_map_write(self, addr, data):
+        if not 0x8000 <= addr <= 0xFFFF:
+            return False
+        self.set_chr_8k(data & 0x03)
+        self.switched()
+        return True
+
+
+class Mapper7(Mapper):
+    # AxROM, switchable 32kb PRG bank and single screen mirroring picked by bit 4
+    def __init__(self, prg_banks, chr_banks):
+        super().__init__(prg_banks, chr_banks)
+        self.mirror = MIRROR.ONESCREEN_LO
+
+    def cpu_map_write(self, addr, data):
+        if not 0x8000 <= addr <= 0xFFFF:
+            return False
+        self.set_prg_32k(data & 0x07)
+        self.mirror = MIRROR.ONESCREEN_HI if data & 0x10 else MIRROR.ONESCREEN_LO
+        self.switched()
+        return True
+
+
+class Mapper4(Mapper):
+    # MMC3, 8kb PRG and 1kb/2kb CHR banks behind eight bank registers and a scanline counter driving an irq.
+    # The counter is clocked by the rise of ppu A12 when the sprite patterns are fetched, which for the usual
+    # setup (background at 0x0000, sprites at 0x1000) is dot 260 of every rendered scanline
+    counts_scanlines = True
+    REGISTERS = ("target_register", "prg_mode", "chr_inversion", "irq_latch", "irq_counter", "irq_reload",
+                 "irq_enabled")
+    REGISTERS_FORMAT = "<5B??8B"  # followed by the eight bank registers
+
+    def __init__(self, prg_banks, chr_banks):
+        super().__init__(prg_banks, chr_banks)
+        self.target_register = 0
+        self.registers = [0, 2, 4, 5, 6, 7, 0, 1]
+        self.prg_mode = 0
+        self.chr_inversion = 0
+        self.irq_latch = 0
+        self.irq_counter = 0
+        self.irq_reload = False
+        self.irq_enabled = False
+        self.update()
+
+    def cpu_map_write(self, addr, data):
+        if not 0x8000 <= addr <= 0xFFFF:
+            return False
+        even = (addr & 0x0001) == 0
+        if addr <= 0x9FFF:
+            if even:  # bank select
+                self.target_register = data & 0x07
+                self.prg_mode = (data >> 6) & 0x01
+                self.chr_inversion = (data >> 7) & 0x01
+            else:  # bank data
+                self.registers[self.target_register] = data
+            self.update()
+            self.switched()
+        elif addr <= 0xBFFF:
+            if even:  # mirroring, the odd register protects PRG ram which is always enabled here
+                self.mirror = MIRROR.HORIZONTAL if data & 0x01 else MIRROR.VERTICAL
+                self.switched()
+        elif addr <= 0xDFFF:
+            if even:
+                self.irq_latch = data
+            else:  # reload the counter on the next scanline
+                self.irq_counter = 0
+                self.irq_reload = True
+        else:
+            if even:  # disable and acknowledge
+                self.irq_enabled = False
+                self.irq_active = False
+            else:
+                self.irq_enabled = True
+        return True
+
+    def update(self):
+        last = self.prg_banks * 2 - 1
+        if self.prg_mode == 0:
+            self.set_prg_8k(0, self.registers[6])
+            self.set_prg_8k(2, last - 1)
+        else:
+            self.set_prg_8k(0, last - 1)
+            self.set_prg_8k(2, self.registers[6])
+        self.set_prg_8k(1, self.registers[7])
+        self.set_prg_8k(3, last)
+        # R0 and R1 are 2kb banks, R2 - R5 1kb banks, A12 inversion swaps the two halves of the pattern memory
+        wide = 4 if self.chr_inversion else 0
+        narrow = 4 - wide
+        self.set_chr_1k(wide + 0, self.registers[0] & 0xFE)
+        self.set_chr_1k(wide + 1, self.registers[0] | 0x01)
+        self.set_chr_1k(wide + 2, self.registers[1] & 0xFE)
+        self.set_chr_1k(wide + 3, self.registers[1] | 0x01)
+        for i in range(4):
+            self.set_chr_1k(narrow + i, self.registers[2 + i])
+
+    def scanline(self):
+        if self.irq_counter == 0 or self.irq_reload:
+            self.irq_counter = self.irq_latch
+            self.irq_reload = False
+        else:
+            self.irq_counter -= 1
+        if self.irq_counter == 0 and self.irq_enabled:
+            self.irq_active = True
+
+    def clone(self):
+        mapper = super().clone()
+        mapper.registers = list(self.registers)
+        return mapper
+
+    def registers_state(self):
+        return super().registers_state() + self.registers
+
+    def load_registers(self, values):
+        super().load_registers(values)
+        self.registers = list(values[len(self.REGISTERS):])
+
+
+MAPPERS = {0: Mapper0, 1: Mapper1, 2: Mapper2, 3: Mapper3, 4: Mapper4, 7: Mapper7}
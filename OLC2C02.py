@@ -1,30 +1,67 @@
-import cv2
+import copy
+import struct
 import numpy as np
 from Registers import PPUStatusRegister, PPUControlRegister, PPUMaskRegister, LoopyRegister, Shifter16Bit
 
 
+# The 64 colours of the 2C02 as rgb
+MASTER_PALETTE = [
+    (84, 84, 84), (0, 30, 116), (8, 16, 144), (48, 0, 136),
+    (68, 0, 100), (92, 0, 48), (84, 4, 0), (60, 24, 0),
+    (32, 42, 0), (8, 58, 0), (0, 64, 0), (0, 60, 0),
+    (0, 50, 60), (0, 0, 0), (0, 0, 0), (0, 0, 0),
+    (152, 150, 152), (8, 76, 196), (48, 50, 236), (92, 30, 228),
+    (136, 20, 176), (160, 20, 100), (152, 34, 32), (120, 60, 0),
+    (84, 90, 0), (40, 114, 0), (8, 124, 0), (0, 118, 40),
+    (0, 102, 120), (0, 0, 0), (0, 0, 0), (0, 0, 0),
+    (236, 238, 236), (76, 154, 236), (120, 124, 236), (176, 98, 236),
+    (228, 84, 236), (236, 88, 180), (236, 106, 100), (212, 136, 32),
+    (160, 170, 0), (116, 196, 0), (76, 208, 32), (56, 204, 108),
+    (56, 180, 204), (60, 60, 60), (0, 0, 0), (0, 0, 0),
+    (236, 238, 236), (168, 204, 236), (188, 188, 236), (212, 178, 236),
+    (236, 174, 236), (236, 174, 212), (236, 180, 176), (228, 196, 144),
+    (204, 210, 120), (180, 222, 120), (168, 226, 144), (152, 226, 180),
+    (160, 214, 228), (160, 162, 160), (0, 0, 0), (0, 0, 0),
+]
+EMPHASIS_FACTOR = 0.816328  # how much an emphasis bit darkens the two colour channels it does not emphasise
+
+
 class OLC2C02:
-    def __init__(self):
+    def __init__(self, palette_file=None, bgr=True):
 
         self.cycler = 0
 
         self.bus = None
         self.cart = None
-        self.name_table = [[0 for _ in range(1024)] for _ in range(2)]
-        self.palette_table = [0 for _ in range(32)]
+        self.name_table = [bytearray(1024) for _ in range(2)]
+        self.palette_table = bytearray(32)
         self.pattern_table = [[0 for _ in range(4096)] for _ in range(2)]
         self.screen_size_x = 256
         self.screen_size_y = 240
-        self.screen_image = [[(0, 0, 0) for _ in range(256)] for _ in range(240)]
+        self.screen_indices = np.zeros((240, 256), dtype=np.uint8)  # 6 bit palette index of every pixel
+        self.screen_tints = np.zeros(240, dtype=np.uint8)  # palette variant (see palette_key) each scanline shows
 
         self.selected_palette = 0
-        self.screen_palette = [(0, 0, 0) for _ in range(0x40)]
+        self.bgr = bgr  # channel order of the images handed out, cv2 wants bgr
+        self.palettes = None  # colour of every palette index for each emphasis and grayscale setting
+        self.screen_palette = None  # the colours without emphasis or grayscale
         self.name_table_sprite = np.zeros((2, 240, 256, 3), dtype=np.uint8)
         self.pattern_table_sprite = np.zeros((2, 128, 128, 3), dtype=np.uint8)
         self.scanline = 0
         self.cycle = 0
+        self.frame_dots = 341 * 262 - 1  # dots per frame
+        self.replay_dots = 100  # dots run again by replay_blank_fetches, enough to reach back over two tile fetches
         self.frame_complete = False
-        self.reverse_colors = False
+
+        # Between two cpu accesses nothing the ppu depends on can change, so run() renders every scanline whose
+        # fetches lie entirely inside such a span with numpy in one go. A scanline an access falls into is
+        # rendered dot by dot through clock() instead, from the start of its fetches on the line before
+        self.dot_exact = False  # render every dot through clock()
+        self.headless = False  # run without producing pixels, for frames nobody looks at
+        # Dots left to run through clock() before the current scanline is done, power up is part way into the
+        # fetches of scanline 0
+        self.exact_dots = self.dots_until(0, 257)
+        self.pending_lines = []  # (scanline, vram at the start of its fetches) of scanlines not rendered yet
 
         self.control = PPUControlRegister()  # nmi, ppu m/s, spr height, bg tile sel, inc mode, nametbl sel NN
         self.mask = PPUMaskRegister()  # enh blu, enh grn, enh red, spr en, bg en, spr lft en, bg lft en, gryscale
@@ -47,82 +84,16 @@ class OLC2C02:
         self.ppu_data_buffer = 0x00
         self.nmi = False
 
-        self.screen_palette[0x00] = (84, 84, 84)
-        self.screen_palette[0x01] = (0, 30, 116) if self.reverse_colors else (116, 30, 0)
-        self.screen_palette[0x02] = (8, 16, 144) if self.reverse_colors else (144, 16, 8)
-        self.screen_palette[0x03] = (48, 0, 136) if self.reverse_colors else (136, 0, 48)
-        self.screen_palette[0x04] = (68, 0, 100) if self.reverse_colors else (100, 0, 68)
-        self.screen_palette[0x05] = (92, 0, 48) if self.reverse_colors else (48, 0, 92)
-        self.screen_palette[0x06] = (84, 4, 0) if self.reverse_colors else (0, 4, 84)
-        self.screen_palette[0x07] = (60, 24, 0) if self.reverse_colors else (0, 24, 60)
-        self.screen_palette[0x08] = (32, 42, 0) if self.reverse_colors else (0, 42, 32)
-        self.screen_palette[0x09] = (8, 58, 0) if self.reverse_colors else (0, 58, 8)
-        self.screen_palette[0x0A] = (0, 64, 0)
-        self.screen_palette[0x0B] = (0, 60, 0)
-        self.screen_palette[0x0C] = (0, 50, 60) if self.reverse_colors else (60, 50, 0)
-        self.screen_palette[0x0D] = (0, 0, 0)
-        self.screen_palette[0x0E] = (0, 0, 0)
-        self.screen_palette[0x0F] = (0, 0, 0)
-
-        self.screen_palette[0x10] = (152, 150, 152)
-        self.screen_palette[0x11] = (8, 76, 196) if self.reverse_colors else (196, 76, 8)
-        self.screen_palette[0x12] = (48, 50, 236) if self.reverse_colors else (236, 50, 48)
-        self.screen_palette[0x13] = (92, 30, 228) if self.reverse_colors else (228, 30, 92)
-        self.screen_palette[0x14] = (136, 20, 176) if self.reverse_colors else (176, 20, 136)
-        self.screen_palette[0x15] = (160, 20, 100) if self.reverse_colors else (100, 20, 160)
-        self.screen_palette[0x16] = (152, 34, 32) if self.reverse_colors else (32, 34, 152)
-        self.screen_palette[0x17] = (120, 60, 0) if self.reverse_colors else (0, 60, 120)
-        self.screen_palette[0x18] = (84, 90, 0) if self.reverse_colors else (0, 90, 84)
-        self.screen_palette[0x19] = (40, 114, 0) if self.reverse_colors else (0, 114, 40)
-        self.screen_palette[0x1A] = (8, 124, 0) if self.reverse_colors else (0, 124, 8)
-        self.screen_palette[0x1B] = (0, 118, 40) if self.reverse_colors else (40, 118, 0)
-        self.screen_palette[0x1C] = (0, 102, 120) if self.reverse_colors else (120, 102, 0)
-        self.screen_palette[0x1D] = (0, 0, 0)
-        self.screen_palette[0x1E] = (0, 0, 0)
-        self.screen_palette[0x1F] = (0, 0, 0)
-
-        self.screen_palette[0x20] = (236, 238, 236)
-        self.screen_palette[0x21] = (76, 154, 236) if self.reverse_colors else (236, 154, 76)
-        self.screen_palette[0x22] = (120, 124, 236) if self.reverse_colors else (236, 124, 120)
-        self.screen_palette[0x23] = (176, 98, 236) if self.reverse_colors else (236, 98, 176)
-        self.screen_palette[0x24] = (228, 84, 236) if self.reverse_colors else (236, 84, 228)
-        self.screen_palette[0x25] = (236, 88, 180) if self.reverse_colors else (180, 88, 236)
-        self.screen_palette[0x26] = (236, 106, 100) if self.reverse_colors else (100, 106, 236)
-        self.screen_palette[0x27] = (212, 136, 32) if self.reverse_colors else (32, 136, 212)
-        self.screen_palette[0x28] = (160, 170, 0) if self.reverse_colors else (0, 170, 160)
-        self.screen_palette[0x29] = (116, 196, 0) if self.reverse_colors else (0, 196, 116)
-        self.screen_palette[0x2A] = (76, 208, 32) if self.reverse_colors else (32, 208, 76)
-        self.screen_palette[0x2B] = (56, 204, 108) if self.reverse_colors else (108, 204, 56)
-        self.screen_palette[0x2C] = (56, 180, 204) if self.reverse_colors else (204, 180, 56)
-        self.screen_palette[0x2D] = (60, 60, 60)
-        self.screen_palette[0x2E] = (0, 0, 0)
-        self.screen_palette[0x2F] = (0, 0, 0)
-
-        self.screen_palette[0x30] = (236, 238, 236)
-        self.screen_palette[0x31] = (168, 204, 236) if self.reverse_colors else (236, 204, 168)
-        self.screen_palette[0x32] = (188, 188, 236) if self.reverse_colors else (236, 188, 188)
-        self.screen_palette[0x33] = (212, 178, 236) if self.reverse_colors else (236, 178, 212)
-        self.screen_palette[0x34] = (236, 174, 236)
-        self.screen_palette[0x35] = (236, 174, 212) if self.reverse_colors else (212, 174, 236)
-        self.screen_palette[0x36] = (236, 180, 176) if self.reverse_colors else (176, 180, 236)
-        self.screen_palette[0x37] = (228, 196, 144) if self.reverse_colors else (144, 196, 228)
-        self.screen_palette[0x38] = (204, 210, 120) if self.reverse_colors else (120, 210, 204)
-        self.screen_palette[0x39] = (180, 222, 120) if self.reverse_colors else (120, 222, 180)
-        self.screen_palette[0x3A] = (168, 226, 144) if self.reverse_colors else (144, 226, 168)
-        self.screen_palette[0x3B] = (152, 226, 180) if self.reverse_colors else (180, 226, 152)
-        self.screen_palette[0x3C] = (160, 214, 228) if self.reverse_colors else (228, 214, 160)
-        self.screen_palette[0x3D] = (160, 162, 160)
-        self.screen_palette[0x3E] = (0, 0, 0)
-        self.screen_palette[0x3F] = (0, 0, 0)
+        self.load_palette(palette_file)
 
     def cpu_read(self, addr, _read_only=False):
-        data = [0x00]
+        data = 0x00
         if addr == 0x0000:  # control register is not readable
             pass
         elif addr == 0x0001:  # mask register is not readable
             pass
         elif addr == 0x0002:  # status
-            data[0] = (self.status.get() & 0xE0) | (self.ppu_data_buffer & 0x1F)
+            data = (self.status.get() & 0xE0) | (self.ppu_data_buffer & 0x1F)
             self.status.set_flag(self.status.Flags.vertical_blank, 0)
             self.address_latch = 0
         elif addr == 0x0003:  # OAM address
@@ -134,14 +105,14 @@ class OLC2C02:
         elif addr == 0x0006:  # PPU address is not readable
             pass
         elif addr == 0x0007:  # PPU data
-            data[0] = self.ppu_data_buffer
+            data = self.ppu_data_buffer
             ppu_address = self.vram.get()
             self.ppu_data_buffer = self.ppu_read(ppu_address)
             if ppu_address >= 0x3F00:
-                data[0] = self.ppu_data_buffer
+                data = self.ppu_data_buffer
             ppu_address += 32 if self.control.get_flag(self.control.Flags.increment_mode) else 1
             self.vram.set(ppu_address)
-        return data[0]
+        return data
 
     def cpu_write(self, addr, data):
         if addr == 0x0000:  # control
@@ -180,34 +151,39 @@ class OLC2C02:
             self.vram.set(ppu_address)
 
     def ppu_read(self, addr, _read_only=False):
-        data = [0x00]
         addr &= 0x3FFF
-        if self.cart.ppu_read(addr, data):
-            pass
-        elif 0x0000 <= addr <= 0x1FFF:
+        data = self.cart.ppu_read(addr)
+        if data is not None:
+            return data
+        data = 0x00
+        if 0x0000 <= addr <= 0x1FFF:
             # reading
-            data[0] = self.pattern_table[(addr & 0x1000) >> 12][(addr & 0x0FFF)]
+            data = self.pattern_table[(addr & 0x1000) >> 12][(addr & 0x0FFF)]
         elif 0x2000 <= addr <= 0x3EFF:
             addr &= 0x0FFF
 
             if self.cart.mirror == self.cart.MIRROR.VERTICAL:
                 if 0x0000 <= addr <= 0x03FF:
-                    data[0] = self.name_table[0][addr & 0x03FF]
+                    data = self.name_table[0][addr & 0x03FF]
                 if 0x0400 <= addr <= 0x07FF:
-                    data[0] = self.name_table[1][addr & 0x03FF]
+                    data = self.name_table[1][addr & 0x03FF]
                 if 0x0800 <= addr <= 0x0BFF:
-                    data[0] = self.name_table[0][addr & 0x03FF]
+                    data = self.name_table[0][addr & 0x03FF]
                 if 0x0C00 <= addr <= 0x0FFF:
-                    data[0] = self.name_table[1][addr & 0x03FF]
+                    data = self.name_table[1][addr & 0x03FF]
             elif self.cart.mirror == self.cart.MIRROR.HORIZONTAL:
                 if 0x0000 <= addr <= 0x03FF:
-                    data[0] = self.name_table[0][addr & 0x03FF]
+                    data = self.name_table[0][addr & 0x03FF]
                 if 0x0400 <= addr <= 0x07FF:
-                    data[0] = self.name_table[0][addr & 0x03FF]
+                    data = self.name_table[0][addr & 0x03FF]
                 if 0x0800 <= addr <= 0x0BFF:
-                    data[0] = self.name_table[1][addr & 0x03FF]
+                    data = self.name_table[1][addr & 0x03FF]
                 if 0x0C00 <= addr <= 0x0FFF:
-                    data[0] = self.name_table[1][addr & 0x03FF]
+                    data = self.name_table[1][addr & 0x03FF]
+            elif self.cart.mirror == self.cart.MIRROR.ONESCREEN_LO:
+                data = self.name_table[0][addr & 0x03FF]
+            elif self.cart.mirror == self.cart.MIRROR.ONESCREEN_HI:
+                data = self.name_table[1][addr & 0x03FF]
 
         elif 0x3F00 <= addr <= 0x3FFF:
             addr &= 0x001F
@@ -219,9 +195,9 @@ class OLC2C02:
                 addr = 0x0008
             if addr == 0x001C:
                 addr = 0x000C
-            data[0] = self.palette_table[addr]
-        # print("ppu read", hex(addr), hex(data[0]))
-        return data[0]
+            data = self.palette_table[addr]
+        # print("ppu read", hex(addr), hex(data))
+        return data
 
     def ppu_write(self, addr, data):
         # print("ppu write", hex(addr), hex(data))
@@ -253,6 +229,10 @@ class OLC2C02:
                     self.name_table[1][addr & 0x03FF] = data
                 if 0x0C00 <= addr <= 0x0FFF:
                     self.name_table[1][addr & 0x03FF] = data
+            elif self.cart.mirror == self.cart.MIRROR.ONESCREEN_LO:
+                self.name_table[0][addr & 0x03FF] = data
+            elif self.cart.mirror == self.cart.MIRROR.ONESCREEN_HI:
+                self.name_table[1][addr & 0x03FF] = data
 
         elif 0x3F00 <= addr <= 0x3FFF:
             addr &= 0x001F
@@ -266,48 +246,328 @@ class OLC2C02:
                 addr = 0x000C
             self.palette_table[addr] = data
 
-    def get_screen(self):
-        screen = np.array(self.screen_image, dtype=np.uint8)
-        return screen
+    @staticmethod
+    def frame_dot(scanline, cycle):
+        # Position of a dot within the frame, counted from the pre-render line. Dot 0 of scanline 0 is skipped
+        if scanline == -1:
+            return cycle
+        if scanline == 0:
+            return 340 + max(cycle, 1)
+        return 681 + (scanline - 1) * 341 + cycle
+
+    @staticmethod
+    def frame_position(dot):
+        # Scanline and cycle of a position within the frame, the inverse of frame_dot
+        if dot < 341:
+            return -1, dot
+        if dot < 681:
+            return 0, dot - 340
+        return 1 + (dot - 681) // 341, (dot - 681) % 341
+
+    def dots_until(self, scanline, cycle):
+        # Number of clock() calls from now before the dot at (scanline, cycle) has been processed
+        return (self.frame_dot(scanline, cycle) - self.frame_dot(self.scanline, self.cycle)) % self.frame_dots
+
+    def dots_until_scanline(self):
+        # Number of clock() calls from now before the next dot at which the mapper's scanline() is called
+        scanline = self.scanline if self.cycle <= 260 else self.scanline + 1
+        if scanline >= 240:
+            scanline = -1
+        return self.dots_until(scanline, 260)
+
+    def rendering(self):
+        return self.mask.get_flag(self.mask.Flags.render_background) or self.mask.get_flag(self.mask.Flags.render_sprites)
+
+    def run(self, dots):
+        # Advance the ppu by a number of dots during which none of its registers or memory change
+        if self.dot_exact:
+            for _ in range(dots):
+                self.clock()
+            return
+        clock = self.clock
+        rendering = self.rendering()
+        if rendering and not self.exact_dots:
+            # Rendering was switched on part way into the fetches of a scanline that had been left blank, the
+            # rest of them go through clock()
+            if -1 <= self.scanline < 239 and self.cycle > 321:
+                self.exact_dots = self.dots_until(self.scanline + 1, 257)
+            elif 0 <= self.scanline < 240 and self.cycle < 257:
+                self.exact_dots = self.dots_until(self.scanline, 257)
+            if self.exact_dots:
+                self.replay_blank_fetches()
+        while dots > 0:
+            if self.exact_dots:
+                n = min(dots, self.exact_dots)
+                for _ in range(n):
+                    clock()
+                self.exact_dots -= n
+                dots -= n
+                continue
+            if not rendering:
+                n = min(dots, self.dots_until(260, 340) + 1)
+                self.skip_blank(n)
+                dots -= n
+                continue
+            if self.scanline == 0 and self.cycle == 0:
+                self.cycle = 1
+            if self.cycle == 321 and -1 <= self.scanline < 239:
+                # The fetches for the next scanline start here
+                fetch_dots = self.dots_until(self.scanline + 1, 257)
+                if dots < fetch_dots:
+                    self.exact_dots = fetch_dots
+                    continue
+                self.pending_lines.append((self.scanline + 1, self.vram.get()))
+            start = self.cycle
+            end = min(341, start + dots, 321 if start < 321 else 341)
+            self.skip_dots(start, end, rendering)
+            dots -= end - start
+            self.cycle = end
+            if self.cycle >= 341:
+                self.cycle = 0
+                self.scanline += 1
+                if self.scanline >= 261:
+                    self.scanline = -1
+                    self.frame_complete = True
+        if self.pending_lines:
+            if not self.headless:
+                self.render_lines(self.pending_lines)
+            self.pending_lines = []
+
+    def skip_dots(self, start, end, rendering):
+        # Everything clock() does on dots start to end - 1 of the current scanline except producing pixels
+        scanline = self.scanline
+        if scanline == -1 and start <= 1 < end:
+            self.status.set_flag(self.status.Flags.vertical_blank, 0)
+        if scanline == 241 and start <= 1 < end:
+            self.status.set_flag(self.status.Flags.vertical_blank, 1)
+            if self.control.get_flag(self.control.Flags.enable_nmi):
+                self.nmi = True
+        if not rendering or not -1 <= scanline < 240:
+            return
+        v = self.vram.get()
+        if start < 257 and end > 8:
+            # coarse x steps after every tile fetched on dots 8, 16, ..., 256
+            v = self.increment_x(v, min(end - 1, 256) // 8 - (max(start, 8) - 1) // 8)
+        if start <= 256 < end:
+            v = self.increment_y(v)
+        if start <= 257 < end:
+            v = (v & ~0x041F) | (self.tram.get() & 0x041F)
+        if start <= 260 < end:
+            self.cart.mapper.scanline()
+        if scanline == -1 and start < 305 and end > 280:
+            v = (v & ~0x7BE0) | (self.tram.get() & 0x7BE0)
+        # the first two tiles of the next scanline are fetched before dots 328 and 336
+        v = self.increment_x(v, (start <= 328 < end) + (start <= 336 < end))
+        self.vram.set(v)
+
+    def replay_blank_fetches(self):
+        # clock() keeps fetching background tiles into its latches and the low bytes of the shifters while
+        # rendering is off, skip_blank does not. Before clock() takes over part way into a scanline the last dots
+        # are run through it again as they went, blank and without drawing. With rendering off they all fetch from
+        # the current vram address, so this holds unless it was written in those dots
+        scanline, cycle = self.scanline, self.cycle
+        mask = self.mask.get()
+        headless = self.headless
+        self.mask.set(0)
+        self.headless = True
+        self.scanline, self.cycle = self.frame_position(self.frame_dot(scanline, cycle) - self.replay_dots)
+        for _ in range(self.replay_dots):
+            self.clock()
+        self.mask.set(mask)
+        self.headless = headless
+
+    def skip_blank(self, dots):
+        # Advance the ppu with rendering off, at most to the end of the frame. Nothing is fetched and every
+        # visible dot shows the backdrop, so the scanlines passed over are filled with it and only the vblank
+        # flag changes. The pixel of column x on scanline y is drawn on frame dot 341 * (y + 1) + x
+        start = self.frame_dot(self.scanline, self.cycle)
+        end = start + dots
+        if start <= self.frame_dot(-1, 1) < end:
+            self.status.set_flag(self.status.Flags.vertical_blank, 0)
+        if start <= self.frame_dot(241, 1) < end:
+            self.status.set_flag(self.status.Flags.vertical_blank, 1)
+            if self.control.get_flag(self.control.Flags.enable_nmi):
+                self.nmi = True
+        first = max(start // 341 - 1, 0)
+        last = min((end - 1) // 341 - 1, 239)
+        if first <= last:
+            backdrop = self.palette_table[0] & 0x3F
+            key = self.palette_key()
+            self.screen_indices[first + 1:last] = backdrop
+            self.screen_tints[first + 1:last] = key
+            for line in (first, last):
+                left = max(start - 341 * (line + 1), 0)
+                right = min(end - 341 * (line + 1), 256)
+                if left < right:
+                    self.screen_indices[line, left:right] = backdrop
+                    self.screen_tints[line] = key
+        if end >= self.frame_dots:
+            self.scanline, self.cycle = -1, 0
+            self.frame_complete = True
+        else:
+            self.scanline, self.cycle = self.frame_position(end)
+
+    @staticmethod
+    def increment_x(v, n):
+        # Step coarse x n tiles, carrying into the horizontal nametable bit
+        x = (((v >> 10) & 0x01) << 5 | (v & 0x1F)) + n
+        return (v & ~0x041F) | ((x & 0x20) << 5) | (x & 0x1F)
+
+    @staticmethod
+    def increment_y(v):
+        # Step fine y one row, carrying into coarse y and the vertical nametable bit
+        if v & 0x7000 != 0x7000:
+            return v + 0x1000
+        v &= ~0x7000
+        course_y = (v >> 5) & 0x1F
+        if course_y == 29:
+            course_y = 0
+            v ^= 0x0800
+        elif course_y == 31:
+            course_y = 0
+        else:
+            course_y += 1
+        return (v & ~0x03E0) | (course_y << 5)
+
+    def nametable_layout(self):
+        # Which of the two physical nametables each of the four logical ones is
+        mirror = self.cart.mirror
+        if mirror == self.cart.MIRROR.VERTICAL:
+            return [0, 1, 0, 1]
+        if mirror == self.cart.MIRROR.HORIZONTAL:
+            return [0, 0, 1, 1]
+        if mirror == self.cart.MIRROR.ONESCREEN_HI:
+            return [1, 1, 1, 1]
+        return [0, 0, 0, 0]
+
+    def render_lines(self, lines):
+        # Produce the background of whole scanlines at once. Each scanline shows 33 tiles starting at the coarse
+        # x it had when its fetches began, shifted left by fine x
+        scanlines = np.array([line for line, _ in lines])
+        if not self.mask.get_flag(self.mask.Flags.render_background):
+            self.screen_indices[scanlines] = self.palette_table[0] & 0x3F
+            self.screen_tints[scanlines] = self.palette_key()
+            return
+        v = np.array([vram for _, vram in lines])
+        course_y = (v >> 5) & 0x1F
+        fine_y = (v >> 12) & 0x07
+        x = ((((v >> 10) & 0x01) << 5) | (v & 0x1F))[:, None] + np.arange(33)
+        course_x = x & 0x1F
+        table = np.array(self.nametable_layout())[((v >> 10) & 0x02)[:, None] | ((x >> 5) & 0x01)]
+        name_tables = np.frombuffer(self.name_table[0] + self.name_table[1], dtype=np.uint8).reshape(2, 1024)
+        tile_id = name_tables[table, (course_y << 5)[:, None] | course_x]
+        attrib = name_tables[table, 0x3C0 | ((course_y >> 2) << 3)[:, None] | (course_x >> 2)]
+        attrib = (attrib >> (((course_y & 0x02) << 1)[:, None] | (course_x & 0x02))) & 0x03
+        tiles, tile_map = self.cart.pattern_tiles()
+        tile = tile_map[(self.control.get_flag(self.control.Flags.pattern_background) << 8) + tile_id.astype(np.int32)]
+        index = (attrib[:, :, None] << 2) | tiles[tile, fine_y[:, None]]
+        index = index.reshape(len(lines), 33 * 8)[:, self.fine_x:self.fine_x + 256]
+        palette = np.frombuffer(self.palette_table, dtype=np.uint8) & 0x3F
+        self.screen_indices[scanlines] = palette[index]
+        self.screen_tints[scanlines] = self.palette_key()
+
+    def clone(self):
+        # Copy of the ppu for Bus.clone with its own memory, registers and picture, not connected to anything yet.
+        # The palettes are shared, they are only ever replaced as a whole
+        ppu = copy.copy(self)
+        ppu.name_table = [bytearray(table) for table in self.name_table]
+        ppu.palette_table = bytearray(self.palette_table)
+        for register in ("control", "mask", "status", "vram", "tram", "bg_shifter_pattern_lo",
+                         "bg_shifter_pattern_hi", "bg_shifter_attrib_lo", "bg_shifter_attrib_hi"):
+            setattr(ppu, register, copy.copy(getattr(self, register)))
+        ppu.pending_lines = list(self.pending_lines)
+        ppu.screen_indices = self.screen_indices.copy()
+        ppu.screen_tints = self.screen_tints.copy()
+        ppu.name_table_sprite = np.zeros(self.name_table_sprite.shape, dtype=np.uint8)
+        ppu.pattern_table_sprite = np.zeros(self.pattern_table_sprite.shape, dtype=np.uint8)
+        return ppu
+
+    # Save states hold the registers, the background pipeline and the ppu's memory. The picture is left out, every
+    # pixel of it is drawn again in the frame after a state saved at the end of one is loaded
+    STATE = struct.Struct("<hHBBBHHBBB??BBBB4HI")
+
+    def save_state(self):
+        return b"".join((self.STATE.pack(self.scanline, self.cycle, self.control.reg, self.mask.reg,
+                                         self.status.reg, self.vram.reg & 0xFFFF, self.tram.reg & 0xFFFF, self.fine_x,
+                                         self.address_latch, self.ppu_data_buffer, self.nmi, self.frame_complete,
+                                         self.bg_next_tile_id, self.bg_next_tile_attrib, self.bg_next_tile_lsb,
+                                         self.bg_next_tile_msb, self.bg_shifter_pattern_lo.reg,
+                                         self.bg_shifter_pattern_hi.reg, self.bg_shifter_attrib_lo.reg,
+                                         self.bg_shifter_attrib_hi.reg, self.exact_dots),
+                         self.name_table[0], self.name_table[1], self.palette_table))
+
+    def load_state(self, data, offset):
+        # Restore the ppu from data at offset and return the offset after it
+        (self.scanline, self.cycle, self.control.reg, self.mask.reg, self.status.reg, self.vram.reg, self.tram.reg,
+         self.fine_x, self.address_latch, self.ppu_data_buffer, self.nmi, self.frame_complete, self.bg_next_tile_id,
+         self.bg_next_tile_attrib, self.bg_next_tile_lsb, self.bg_next_tile_msb, self.bg_shifter_pattern_lo.reg,
+         self.bg_shifter_pattern_hi.reg, self.bg_shifter_attrib_lo.reg, self.bg_shifter_attrib_hi.reg,
+         self.exact_dots) = self.STATE.unpack_from(data, offset)
+        offset += self.STATE.size
+        for memory in (*self.name_table, self.palette_table):
+            memory[:] = data[offset:offset + len(memory)]
+            offset += len(memory)
+        self.pending_lines = []
+        return offset
+
+    def get_screen(self, indices=False):
+        # The frame as an image, coloured with a single lookup of every palette index in the palette variant its
+        # scanline was drawn with. With indices the palette index buffer itself is returned without a copy, it
+        # keeps changing while the ppu runs and has no emphasis or grayscale applied
+        if indices:
+            return self.screen_indices
+        return self.palettes[self.screen_tints[:, None], self.screen_indices]
+
+    def load_palette(self, palette_file=None):
+        # Precompute the colour tables from the built in palette or a .pal file. A .pal file holds 64 rgb triplets,
+        # or 8 sets of them with the emphasis already applied, one per value of the three emphasis bits
+        if palette_file is None:
+            colors = np.array(MASTER_PALETTE, dtype=np.float64)[None]
+        else:
+            with open(palette_file, "rb") as pal:
+                colors = np.frombuffer(pal.read(), dtype=np.uint8).astype(np.float64)
+            if colors.size not in (64 * 3, 8 * 64 * 3):
+                raise ValueError("{} is not a palette of 64 or 512 colours".format(palette_file))
+            colors = colors.reshape(-1, 64, 3)
+        if len(colors) == 1:
+            # Bits 0 - 2 of the emphasis select red, green and blue, each one darkens the other two channels
+            emphasis = np.arange(8)[:, None]
+            darkened = (emphasis & ~(1 << np.arange(3)) & 0x07) != 0
+            colors = colors * np.where(darkened, EMPHASIS_FACTOR, 1.0)[:, None, :]
+        # Grayscale keeps only the column of grey colours, index & 0x30
+        gray = colors[:, np.arange(64) & 0x30]
+        palettes = np.stack([colors, gray], axis=1).reshape(16, 64, 3)
+        if self.bgr:
+            palettes = palettes[:, :, ::-1]
+        self.palettes = np.ascontiguousarray(np.rint(palettes).astype(np.uint8))
+        self.screen_palette = self.palettes[0]
+
+    def palette_key(self):
+        # Which of the precomputed palettes the mask register selects: emphasis bits times two plus grayscale
+        mask = self.mask.get()
+        return ((mask >> 4) & 0x0E) | (mask & 0x01)
 
     def get_name_table(self, i, pat):
-        for y in range(30):
-            for x in range(32):
-                t_id = self.name_table[i][(y*32) + x]
-                tile_x = (t_id & 0x0f)
-                tile_y = ((t_id >> 4) & 0x0f)
-                tile = self.get_tile(pat, tile_x, tile_y)
-                self.name_table_sprite[i, y*8:(y*8) + 8, x*8:(x*8) + 8] = tile
+        tiles, tile_map = self.cart.pattern_tiles()
+        tile_ids = np.frombuffer(self.name_table[i], dtype=np.uint8)[:960].reshape(30, 32).astype(np.int32)
+        pixels = tiles[tile_map[(pat << 8) + tile_ids]].transpose(0, 2, 1, 3).reshape(240, 256)
+        self.name_table_sprite[i] = self.get_colors(self.selected_palette)[pixels]
 #        return self.name_table_sprite[i]
 
     def get_tile(self, tbl_index, tile_x, tile_y):
-        offset = tile_y * 256 + tile_x * 16
-        tile = np.zeros((8, 8, 3))
-        for row in range(8):
-            tile_lsb = self.ppu_read(tbl_index * 0x1000 + offset + row + 0x0000)
-            tile_msb = self.ppu_read(tbl_index * 0x1000 + offset + row + 0x0008)
-            for col in range(8):
-                pix = (tile_lsb & 0x01) + (tile_msb & 0x01)
-                tile_lsb = tile_lsb >> 1
-                tile_msb = tile_msb >> 1
-                tile[row, (7 - col)] = self.get_color(self.selected_palette, pix)
-        return tile
+        tiles, tile_map = self.cart.pattern_tiles()
+        return self.get_colors(self.selected_palette)[tiles[tile_map[(tbl_index << 8) + (tile_y << 4) + tile_x]]]
 
     def get_pattern_table(self, i, pal):
-        for tile_y in range(16):
-            for tile_x in range(16):
-                offset = tile_y * 256 + tile_x * 16
-                for row in range(8):
-                    tile_lsb = self.ppu_read(i * 0x1000 + offset + row + 0x0000)
-                    tile_msb = self.ppu_read(i * 0x1000 + offset + row + 0x0008)
-                    for col in range(8):
-                        pix = (tile_lsb & 0x01) + (tile_msb & 0x01)
-                        tile_lsb = tile_lsb >> 1
-                        tile_msb = tile_msb >> 1
-                        self.pattern_table_sprite[i, tile_y * 8 + row, tile_x * 8 + (7 - col)] = self.get_color(pal, pix)
-
+        tiles, tile_map = self.cart.pattern_tiles()
+        pixels = tiles[tile_map[i << 8:(i + 1) << 8]].reshape(16, 16, 8, 8).transpose(0, 2, 1, 3).reshape(128, 128)
+        self.pattern_table_sprite[i] = self.get_colors(pal)[pixels]
         return self.pattern_table_sprite[i]
 
+    def get_colors(self, pal):
+        # The four colours of a palette as an array to index with pixel values
+        return np.array([self.get_color(pal, pix) for pix in range(4)], dtype=np.uint8)
+
     def get_color(self, pal, pix):
         result = self.ppu_read(0x3F00 + (pal << 2) + pix) & 0x3F
         return self.screen_palette[result]
@@ -403,6 +663,9 @@ class OLC2C02:
             if self.cycle == 257:
                 load_background_shifters()
                 transfer_address_x()
+            if self.cycle == 260:
+                if self.mask.get_flag(self.mask.Flags.render_background) or self.mask.get_flag(self.mask.Flags.render_sprites):
+                    self.cart.mapper.scanline()
             if self.scanline == -1 and 280 <= self.cycle < 305:
                 transfer_address_y()
 
@@ -427,8 +690,10 @@ class OLC2C02:
             bg_pal1 = self.bg_shifter_attrib_hi.get(self.fine_x) > 0
             bg_palette = (bg_pal1 << 1) | bg_pal0
 
-        if 0 <= self.scanline < 240 and 0 <= self.cycle < 256:
-            self.screen_image[self.scanline][self.cycle - 1] = self.get_color(bg_palette, bg_pixel)
+        if 0 <= self.scanline < 240 and 1 <= self.cycle <= 256 and not self.headless:
+            if self.cycle == 1:
+                self.screen_tints[self.scanline] = self.palette_key()
+            self.screen_indices[self.scanline, self.cycle - 1] = self.ppu_read(0x3F00 + (bg_palette << 2) + bg_pixel) & 0x3F
 
         self.cycle += 1
 
@@ -438,23 +703,3 @@ class OLC2C02:
             if self.scanline >= 261:
                 self.scanline = -1
                 self.frame_complete = True
-        if self.frame_complete:
-
-            cv2.imshow("screen_image", self.get_screen())
-            # self.get_name_table(0, 1)
-            # cv2.imshow("nametable", self.name_table_sprite[0])
-            # cv2.imshow("pattertable1", self.get_pattern_table(0, self.selected_palette))
-            # cv2.imshow("patterntable2", self.get_pattern_table(1, self.selected_palette))
-            key = cv2.waitKey(1)
-            if key == ord("w"):
-                print("pressing up")
-                self.bus.controller[0] = 0b1000
-            elif key == ord("s"):
-                print("pressing down")
-                self.bus.controller[0] = 0b100
-            elif key == ord("i"):
-                print("pressing start")
-                self.bus.controller[0] = 0b10000
-            else:
-                self.bus.controller[0] = 0
-            self.frame_complete = False
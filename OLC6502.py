@@ -1,5 +1,7 @@
+import copy
+import struct
 from enum import Enum
-import numpy as np
+from Instructions import Block, build_dispatch, translate_block
 
 
 class OLC6502:
@@ -9,18 +11,20 @@ class OLC6502:
         self.ppu = None  # Connection to ppu
         self.cart = None  # Connection to cartridge
         self.FLAGS6502 = self.FLAGS6502Enums  # Flags Enum
-        self.a = np.uint8(0x00)  # Accumulator Register
-        self.x = np.uint8(0x00)  # X Register
-        self.y = np.uint8(0x00)  # Y Register
+        self.a = 0x00  # Accumulator Register
+        self.x = 0x00  # X Register
+        self.y = 0x00  # Y Register
         self.stkp = 0xFD  # Stack Pointer (points to location on bus)
         self.pc = 0x00  # Program Counter
-        self.status = 0x00  # Status Register
-        self.fetched = 0x00
+        self.flags = 0x00  # Status Register without N and Z, see status
+        self.nz = 0x01  # Last result N and Z are taken from, see status
         self.addr_abs = 0x0000
-        self.addr_rel = 0x00
         self.opcode = 0x00
-        self.opcode_item = None
         self.cycles = 0
+        self.clock_count = 0  # Cycles since reset, the time at which the next instruction starts
+        self.idle_loops = {}  # Result of idle_loop() for loops in PRG rom, cleared when the banks switch
+        self.use_blocks = False  # Run code as translated basic blocks instead of an instruction at a time
+        self.blocks = {}  # Translated blocks by (pc, offset of the PRG bank) for rom and by pc for ram
 
         self.debug = False
 
@@ -41,6 +45,17 @@ class OLC6502:
     def read(self, a):
         return self.bus.cpu_read(a)
 
+    @property
+    def status(self):
+        # Status Register, N and Z are only worked out from the last result when it is read
+        nz = self.nz
+        return self.flags | (0x80 if nz & 0x180 else 0) | (0x00 if nz & 0xFF else 0x02)
+
+    @status.setter
+    def status(self, v):
+        self.flags = (v & 0x4D) | 0x20  # B only exists on the stack and U always reads as set
+        self.nz = ((v & 0x80) << 1) | (0x00 if v & 0x02 else 0x01)
+
     def get_flag(self, f):
         if self.status & f.value > 0:
             return 1
@@ -54,569 +69,62 @@ class OLC6502:
             self.status &= ~f.value
 
     #######################################################
-    # Addressing Modes
-
-    def ACC(self):
-        return 0
-
-    def IMP(self):
-        self.fetched = self.a
-        return 0
-
-    def IMM(self):
-        self.addr_abs = self.pc
-        self.pc = (self.pc + 1) & 0xFFFF
-        return 0
-
-    def ZP0(self):
-        self.addr_abs = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-        self.addr_abs &= 0x00FF
-        return 0
-
-    def ZPX(self):
-        self.addr_abs = self.read(self.pc) + self.x
-        self.pc = (self.pc + 1) & 0xFFFF
-        self.addr_abs &= 0x00FF
-        return 0
-
-    def ZPY(self):
-        self.addr_abs = self.read(self.pc) + self.y
-        self.pc = (self.pc + 1) & 0xFFFF
-        self.addr_abs &= 0x00FF
-        return 0
-
-    def REL(self):
-        self.addr_rel = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-        if self.addr_rel & 0x80:
-            self.addr_rel = -(self.addr_rel & 0x80) | (self.addr_rel & 0x7f)
-        return 0
-
-    def ABS(self):
-        lo = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-        hi = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-        self.addr_abs = (hi << 8) | lo
-        return 0
-
-    def ABX(self):
-        lo = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-        hi = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-
-        self.addr_abs = (hi << 8) | lo
-        self.addr_abs = (self.addr_abs + self.x) & 0xFFFF
-        if (self.addr_abs & 0xFF00) != (hi << 8):
-            return 1
-        else:
-            return 0
-
-    def ABY(self):
-        lo = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-        hi = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-        self.addr_abs = (hi << 8) | lo
-        self.addr_abs = (self.addr_abs + self.y) & 0xFFFF
-        if (self.addr_abs & 0xFF00) != (hi << 8):
-            return 1
-        else:
-            return 0
-
-    def IND(self):
-        ptr_lo = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-        ptr_hi = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-        ptr = (ptr_hi << 8) | ptr_lo
-        if ptr_lo == 0x00FF:
-            self.addr_abs = (self.read(ptr & 0xFF00) << 8) | self.read(ptr + 0)
-        else:
-            self.addr_abs = (self.read(ptr + 1) << 8) | self.read(ptr + 0)
-        return 0
-
-    def IZX(self):
-        t = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-        lo = self.read((t + self.x) & 0x00FF)
-        hi = self.read((t + self.x + 1) & 0x00FF)
-        self.addr_abs = (hi << 8) | lo
-        return 0
-
-    def IZY(self):
-        t = self.read(self.pc)
-        self.pc = (self.pc + 1) & 0xFFFF
-        lo = self.read(t & 0x00FF)
-        hi = self.read((t + 1) & 0x00FF)
-        self.addr_abs = (hi << 8) | lo
-        self.addr_abs = (self.addr_abs + self.y) & 0xFFFF
-        if (self.addr_abs & 0xFF00) != (hi << 8):
-            return 1
-        else:
-            return 0
-
-    #######################################################
-    # Operations
-    def ADC(self):
-        self.fetch()
-        temp = self.a + self.fetched + self.get_flag(self.FLAGS6502.C)
-        self.set_flag(self.FLAGS6502.C, temp > 255)
-        self.set_flag(self.FLAGS6502.Z, (temp & 0x00FF) == 0)
-        self.set_flag(self.FLAGS6502.V, (~(self.a ^ self.fetched) & (self.a ^ temp)) & 0x0080)
-        self.set_flag(self.FLAGS6502.N, temp & 0x80)
-        self.a = temp & 0x00FF
-        return 1
-
-    def AND(self):
-        self.fetch()
-        self.a = self.a & self.fetched
-        self.set_flag(self.FLAGS6502.N, self.a & 0x80)
-        self.set_flag(self.FLAGS6502.Z, self.a == 0x00)
-        return 1
-
-    def ASL(self):
-        self.fetch()
-        self.set_flag(self.FLAGS6502.C, (self.fetched & 0x80))
-        temp = (self.fetched << 1) & 0xFF
-        self.set_flag(self.FLAGS6502.N, temp & 0x80)
-        self.set_flag(self.FLAGS6502.Z, (temp & 0xFF) == 0x00)
-        if self.opcode_item.addr_mode.__name__ == "IMP":
-            self.a = temp & 0x00FF
-        else:
-            self.write(self.addr_abs, temp & 0x00FF)
-        return 0
-
-    def BCC(self):
-        self.addr_abs = (self.pc + self.addr_rel) & 0xFFFF
-        if self.get_flag(self.FLAGS6502.C) == 0:
-            self.cycles += 1
-            if (self.addr_abs & 0xFF00) != (self.pc & 0xFF00):
-                self.cycles += 1
-            self.pc = self.addr_abs
-        return 0
-
-    def BCS(self):
-        self.addr_abs = (self.pc + self.addr_rel) & 0xFFFF
-        if self.get_flag(self.FLAGS6502.C) == 1:
-            self.cycles += 1
-            if (self.addr_abs & 0xFF00) != (self.pc & 0xFF00):
-                self.cycles += 1
-            self.pc = self.addr_abs
-        return 0
-
-    def BEQ(self):
-        self.addr_abs = (self.pc + self.addr_rel) & 0xFFFF
-        if self.get_flag(self.FLAGS6502.Z) == 1:
-            self.cycles += 1
-            if (self.addr_abs & 0xFF00) != (self.pc & 0xFF00):
-                self.cycles += 1
-            self.pc = self.addr_abs
-        return 0
-
-    def BIT(self):
-        self.fetch()
-        temp = self.a & self.fetched
-        self.set_flag(self.FLAGS6502.Z, (temp & 0x00FF) == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.fetched & (1 << 7))
-        self.set_flag(self.FLAGS6502.V, self.fetched & (1 << 6))
-        return 0
-
-    def BMI(self):
-        self.addr_abs = (self.pc + self.addr_rel) & 0xFFFF
-        if self.get_flag(self.FLAGS6502.N) == 1:
-            self.cycles += 1
-            if (self.addr_abs & 0xFF00) != (self.pc & 0xFF00):
-                self.cycles += 1
-            self.pc = self.addr_abs
-        return 0
-
-    def BNE(self):
-        self.addr_abs = (self.pc + self.addr_rel) & 0xFFFF
-        if self.get_flag(self.FLAGS6502.Z) == 0:
-            self.cycles += 1
-            if (self.addr_abs & 0xFF00) != (self.pc & 0xFF00):
-                self.cycles += 1
-            self.pc = self.addr_abs
-        return 0
-
-    def BPL(self):
-        self.addr_abs = (self.pc + self.addr_rel) & 0xFFFF
-        if self.get_flag(self.FLAGS6502.N) == 0:
-            self.cycles += 1
-            if (self.addr_abs & 0xFF00) != (self.pc & 0xFF00):
-                self.cycles += 1
-            self.pc = self.addr_abs
-        return 0
+    # External Signals
 
-    def BRK(self):
+    def step(self):
+        # Execute one whole instruction and return the number of cycles it took
+        self.opcode = self.read(self.pc)
         self.pc = (self.pc + 1) & 0xFFFF
-        self.write(0x0100 + self.stkp, (self.pc >> 8) & 0x00FF)
-        self.stkp = (self.stkp - 1) % 256
-        self.write(0x0100 + self.stkp, self.pc & 0x00FF)
-        self.stkp = (self.stkp - 1) % 256
-
-        self.set_flag(self.FLAGS6502.B, 1)
-        self.write(0x0100 + self.stkp, self.status)
-        self.stkp = (self.stkp - 1) % 256
-        self.set_flag(self.FLAGS6502.I, 1)
-
-        self.pc = self.read(0xFFFE) | (self.read(0xFFFF) << 8)
-        return 0
-
-    def BVC(self):
-        self.addr_abs = (self.pc + self.addr_rel) & 0xFFFF
-        if self.get_flag(self.FLAGS6502.V) == 0:
-            self.cycles += 1
-            if (self.addr_abs & 0xFF00) != (self.pc & 0xFF00):
-                self.cycles += 1
-            self.pc = self.addr_abs
-        return 0
-
-    def BVS(self):
-        self.addr_abs = (self.pc + self.addr_rel) & 0xFFFF
-        if self.get_flag(self.FLAGS6502.V) == 1:
-            self.cycles += 1
-            if (self.addr_abs & 0xFF00) != (self.pc & 0xFF00):
-                self.cycles += 1
-            self.pc = self.addr_abs
-        return 0
-
-    def CLC(self):
-        self.set_flag(self.FLAGS6502.C, False)
-        return 0
-
-    def CLD(self):
-        self.set_flag(self.FLAGS6502.D, False)
-        return 0
-
-    def CLI(self):
-        self.set_flag(self.FLAGS6502.I, False)
-        return 0
-
-    def CLV(self):
-        self.set_flag(self.FLAGS6502.V, False)
-        return 0
-
-    def CMP(self):
-        self.fetch()
-        temp = (self.a - self.fetched) & 0xFF
-        self.set_flag(self.FLAGS6502.C, self.a >= self.fetched)
-        self.set_flag(self.FLAGS6502.Z, temp == 0x00)
-        self.set_flag(self.FLAGS6502.N, temp & 0x80)
-        return 1
-
-    def CPX(self):
-        self.fetch()
-        temp = (self.x - self.fetched) & 0xFF
-        self.set_flag(self.FLAGS6502.C, self.x >= self.fetched)
-        self.set_flag(self.FLAGS6502.Z, temp == 0x00)
-        self.set_flag(self.FLAGS6502.N, temp & 0x80)
-        return 0
-
-    def CPY(self):
-        self.fetch()
-        temp = (self.y - self.fetched) & 0xFF
-        self.set_flag(self.FLAGS6502.C, self.y >= self.fetched)
-        self.set_flag(self.FLAGS6502.Z, temp == 0x00)
-        self.set_flag(self.FLAGS6502.N, temp & 0x80)
-        return 0
-
-    def DEC(self):
-        self.fetch()
-        temp = (self.fetched - 1) % 256
-        self.write(self.addr_abs, temp & 0x00FF)
-        self.set_flag(self.FLAGS6502.Z, (temp & 0x00FF) == 0x0000)
-        self.set_flag(self.FLAGS6502.N, temp & 0x0080)
-        return 0
-
-    def DEX(self):
-        self.x = (self.x - 1) % 256
-        self.set_flag(self.FLAGS6502.Z, self.x == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.x & 0x80)
-        return 0
-
-    def DEY(self):
-        self.y = (self.y - 1) % 256
-        self.set_flag(self.FLAGS6502.Z, self.y == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.y & 0x80)
-        return 0
-
-    def EOR(self):
-        self.fetch()
-        self.a = self.a ^ self.fetched
-        self.set_flag(self.FLAGS6502.Z, self.a == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.a & 0x80)
-        return 1
-
-    def INC(self):
-        self.fetch()
-        temp = (self.fetched + 1) % 256
-        self.write(self.addr_abs, (temp & 0x00FF))
-        self.set_flag(self.FLAGS6502.Z, (temp & 0x00FF) == 0x0000)
-        self.set_flag(self.FLAGS6502.N, temp & 0x0080)
-        return 0
-
-    def INX(self):
-        self.x = (self.x + 1) % 256
-        self.set_flag(self.FLAGS6502.Z, self.x == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.x & 0x80)
-        return 0
-
-    def INY(self):
-        self.y = (self.y + 1) % 256
-        self.set_flag(self.FLAGS6502.Z, self.y == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.y & 0x80)
-        return 0
-
-    def JMP(self):
-        self.pc = self.addr_abs
-        return 0
-
-    def JSR(self):
-        self.pc -= 1
-        self.write(0x0100 + self.stkp, (self.pc >> 8) & 0x00FF)
-        self.stkp = (self.stkp - 1) % 256
-        self.write(0x0100 + self.stkp, self.pc & 0x00FF)
-        self.stkp = (self.stkp - 1) % 256
-        self.pc = self.addr_abs
-        return 0
-
-    def LDA(self):
-        self.fetch()
-        self.a = self.fetched
-        self.set_flag(self.FLAGS6502.Z, self.a == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.a & 0x80)
-        return 1
-
-    def LDX(self):
-        self.fetch()
-        self.x = self.fetched
-        self.set_flag(self.FLAGS6502.Z, self.x == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.x & 0x80)
-        return 1
-
-    def LDY(self):
-        self.fetch()
-        self.y = self.fetched
-        self.set_flag(self.FLAGS6502.Z, self.y == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.y & 0x80)
-        return 1
-
-    def LSR(self):
-        self.fetch()
-        self.set_flag(self.FLAGS6502.C, self.fetched & 0x0001)
-        temp = self.fetched >> 1
-        self.set_flag(self.FLAGS6502.Z, (temp & 0x00FF) == 0x0000)
-        self.set_flag(self.FLAGS6502.N, temp & 0x0080)
-        if self.opcode_item.addr_mode.__name__ == "IMP":
-            self.a = temp & 0x00FF
+        cycles = self.dispatch[self.opcode](self)
+        self.flags |= 0x20  # unused flag always reads as set
+        self.clock_count += cycles
+        return cycles
+
+    def run_block(self, end):
+        # Execute the translated block at pc when all of its instructions start before cpu cycle end, otherwise a
+        # single instruction. Rom blocks are kept per PRG bank, ram and sram blocks are checked against the code
+        # they were translated from and translated again when it was overwritten. Where not even one instruction
+        # fits a block without a run function is kept, so the translation is not tried again every time
+        pc = self.pc
+        if pc >= 0x8000:
+            key = (pc, self.cart.mapper.prg_windows[(pc >> 13) & 0x03])
+            block = self.blocks.get(key)
+            if block is None:
+                block = translate_block(self.instructions, self.read, pc, (pc | 0x1FFF) + 1, self.block_write_ends_rom)
+                block = self.blocks[key] = block or Block(None, b"", 0)
+        elif pc < 0x2000 or pc >= 0x6000:
+            key = pc
+            block = self.blocks.get(key)
+            page = self.bus.read_pages[pc >> 8]
+            offset = pc & 0xFF
+            if block is not None and page[offset:offset + len(block.code)] != block.code:
+                block = None
+            if block is None:
+                block = translate_block(self.instructions, self.read, pc, (pc | 0xFF) + 1, self.block_write_ends_ram)
+                # whether the first instruction fits depends on the bytes up to the end of the page
+                block = self.blocks[key] = block or Block(None, bytes(page[offset:]), 0)
         else:
-            self.write(self.addr_abs, temp & 0x00FF)
-        return 0
-
-    def NOP(self):
-        if self.opcode == 0xFC:
-            return 1
+            self.step()
+            return
+        if block.run is None or self.clock_count + block.lead >= end:
+            self.step()
         else:
-            return 0
-
-    def ORA(self):
-        self.fetch()
-        self.a = self.a | self.fetched
-        self.set_flag(self.FLAGS6502.Z, self.a == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.a & 0x80)
-        return 1
-
-    def PHA(self):
-        self.write(0x0100 + self.stkp, self.a)
-        self.stkp = (self.stkp - 1) % 256
-        return 0
+            block.run(self)
 
-    def PHP(self):
-        self.write(0x0100 + self.stkp, self.status | self.FLAGS6502.B.value | self.FLAGS6502.U.value)
-        self.stkp = (self.stkp - 1) % 256
-        return 0
+    @staticmethod
+    def block_write_ends_rom(low, high):
+        # Writes from 0x4020 up may reach mapper registers and switch the bank the block is in
+        return high >= 0x4020
 
-    def PLA(self):
-        self.stkp = (self.stkp + 1) % 256
-        self.a = self.read(0x0100 + self.stkp)
-        self.set_flag(self.FLAGS6502.Z, self.a == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.a & 0x80)
-        return 0
-
-    def PLP(self):
-        self.stkp = (self.stkp + 1) % 256
-        self.status = self.read(0x0100 + self.stkp)
-        self.set_flag(self.FLAGS6502.U, 1)
-        return 0
-
-    def ROL(self):
-        self.fetch()
-        temp = (self.fetched << 1)
-        if self.get_flag(self.FLAGS6502.C):
-            temp |= 0x1
-        self.set_flag(self.FLAGS6502.C, temp > 0xFF)
-        temp &= 0xFF
-        self.set_flag(self.FLAGS6502.N, temp & 0x80)
-        self.set_flag(self.FLAGS6502.Z, temp == 0x0)
-        if self.opcode_item.addr_mode.__name__ == "IMP":
-            self.a = temp
-        else:
-            self.write(self.addr_abs, temp)
-        return 0
-
-    def ROR(self):
-        self.fetch()
-        temp = self.fetched
-        if self.get_flag(self.FLAGS6502.C):
-            temp |= 0x100
-        self.set_flag(self.FLAGS6502.C, temp & 0x01)
-        temp = temp >> 1
-        self.set_flag(self.FLAGS6502.N, temp & 0x80)
-        self.set_flag(self.FLAGS6502.Z, temp == 0x0)
-        if self.opcode_item.addr_mode.__name__ == "IMP":
-            self.a = temp & 0xFF
-        else:
-            self.write(self.addr_abs, temp & 0xFF)
-        return 0
-
-    def RTI(self):
-        self.stkp = (self.stkp + 1) % 256
-        self.status = self.read(0x0100 + self.stkp)
-        self.stkp = (self.stkp + 1) % 256
-        self.pc = self.read(0x0100 + self.stkp)
-        self.stkp = (self.stkp + 1) % 256
-        self.pc |= (self.read(0x0100 + self.stkp) << 8)
-        return 0
-
-    def RTS(self):
-        self.stkp = (self.stkp + 1) % 256
-        self.pc = self.read(0x0100 + self.stkp)
-        self.stkp = (self.stkp + 1) % 256
-        self.pc |= (self.read(0x0100 + self.stkp) << 8)
-        self.pc = (self.pc + 1) & 0xFFFF
-        return 0
-
-    def SBC(self):
-        self.fetch()
-        value = self.fetched ^ 0x00FF
-        temp = np.uint16(self.a + value + self.get_flag(self.FLAGS6502.C))
-        self.set_flag(self.FLAGS6502.C, temp & 0xFF00)
-        self.set_flag(self.FLAGS6502.Z, (temp & 0x00FF) == 0x00)
-        self.set_flag(self.FLAGS6502.V, (temp ^ self.a) & (temp ^ value) & 0x80)
-        self.set_flag(self.FLAGS6502.N, temp & 0x80)
-        self.a = (temp & 0xFF)
-        return 1
-
-    def SEC(self):
-        self.set_flag(self.FLAGS6502.C, True)
-        return 0
-
-    def SED(self):
-        self.set_flag(self.FLAGS6502.D, True)
-        return 0
-
-    def SEI(self):
-        self.set_flag(self.FLAGS6502.I, True)
-        return 0
-
-    def STA(self):
-        self.write(self.addr_abs, self.a)
-        return 0
-
-    def STX(self):
-        self.write(self.addr_abs, self.x)
-        return 0
-
-    def STY(self):
-        self.write(self.addr_abs, self.y)
-        return 0
-
-    def TAX(self):
-        self.x = self.a % 256
-        self.set_flag(self.FLAGS6502.Z, self.x == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.x & 0x80)
-        return 0
-
-    def TAY(self):
-        self.y = self.a % 256
-        self.set_flag(self.FLAGS6502.Z, self.y == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.y & 0x80)
-        return 0
-
-    def TSX(self):
-        self.x = self.stkp % 256
-        self.set_flag(self.FLAGS6502.Z, self.x == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.x & 0x80)
-        return 0
-
-    def TXA(self):
-        self.a = self.x % 256
-        self.set_flag(self.FLAGS6502.Z, self.a == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.a & 0x80)
-        return 0
-
-    def TXS(self):
-        self.stkp = self.x % 256
-        return 0
-
-    def TYA(self):
-        self.a = self.y % 256
-        self.set_flag(self.FLAGS6502.Z, self.a == 0x00)
-        self.set_flag(self.FLAGS6502.N, self.a & 0x80)
-        return 0
-
-    def XXX(self):
-        return 0
-
-    #######################################################
-    # Unofficial Opcodes
-
-    def LAX(self):
-        self.LDA()
-        self.TAX()
-        return 1
-
-    #######################################################
-    # External Signals
+    @staticmethod
+    def block_write_ends_ram(_low, _high):
+        # Code in ram or sram can overwrite itself
+        return True
 
     def clock(self):
+        # Cycle by cycle view of step(), the instruction runs whole on its first cycle
         if self.cycles == 0:
-            self.opcode = self.read(self.pc)
-            self.opcode_item = self.do_lookup(self.opcode)
-            # if self.opcode_item.name == "???":
-            #     print("addr {} ran illegal opcode {} {}".format(hex(self.pc), hex(self.opcode), self.opcode_item.name))
-            #     self.debug = True
-            # if self.debug is True or hex(self.pc) == "0xe4da":  # or self.opcode_item.addr_mode.__name__ == "ABX" or hex(self.pc) == "0xe1e2":
-            #     print("addr: {} op: {} {} {}".format(hex(self.pc), hex(self.opcode), self.opcode_item.addr_mode.__name__, self.opcode_item.name), end=" ")
-            #     self.debug = True
-            self.set_flag(self.FLAGS6502.U, True)
-            self.pc = (self.pc + 1) & 0xFFFF
-            self.cycles = self.opcode_item.cycles
-            additional_cycle1 = self.opcode_item.addr_mode(self)
-            additional_cycle2 = self.opcode_item.operation(self)
-            self.cycles += (additional_cycle1 + additional_cycle2)
-            # if self.debug is True:
-            #     print("f: {} abs: {} rel: {} l_d: {}".format(hex(self.fetched), hex(self.addr_abs), hex(self.addr_rel), hex(self.read(self.addr_abs))))
-            # status_string = ""
-            # status_string += "C " if self.get_flag(self.FLAGS6502.C) else "c "
-            # status_string += "Z " if self.get_flag(self.FLAGS6502.Z) else "z "
-            # status_string += "I " if self.get_flag(self.FLAGS6502.I) else "i "
-            # status_string += "D " if self.get_flag(self.FLAGS6502.D) else "d "
-            # status_string += "B " if self.get_flag(self.FLAGS6502.B) else "b "
-            # status_string += "U " if self.get_flag(self.FLAGS6502.U) else "u "
-            # status_string += "V " if self.get_flag(self.FLAGS6502.V) else "v "
-            # status_string += "N" if self.get_flag(self.FLAGS6502.N) else "n"
-            # if self.debug is True:
-            #     print("ram:", self.bus.cpuram.ram[0x0:0x11], "A: {} X: {} Y: {}".format(hex(self.a), hex(self.x), hex(self.y)), status_string)
-            #     a = input("1 to skip, any other to step: ")
-            #     if a == "1":
-            #         self.debug = False
-
-            self.set_flag(self.FLAGS6502.U, True)
+            self.cycles = self.step()
 
         self.cycles -= 1
 
@@ -625,16 +133,17 @@ class OLC6502:
         lo = self.read(self.addr_abs + 0)
         hi = self.read(self.addr_abs + 1)
         self.pc = (hi << 8) | lo
-        print("starting at", hex(self.pc))
+        if self.bus.verbose:
+            print("starting at", hex(self.pc))
         self.a = 0
         self.x = 0
         self.y = 0
         self.stkp = 0xFD
-        self.status = 0x00 | self.FLAGS6502.U.value
+        self.status = 0x00 | self.FLAGS6502.U.value | self.FLAGS6502.I.value
         self.addr_abs = 0x0000
-        self.addr_rel = 0x0000
-        self.fetched = 0x00
-        self.cycles = 8
+        # Reset takes 7 cycles before the first instruction, the cycle count nestest.log starts at
+        self.cycles = 7
+        self.clock_count = 7
 
     def irq(self):
         # If interrupts are allowed
@@ -644,11 +153,9 @@ class OLC6502:
             self.stkp = (self.stkp - 1) % 256
             self.write(0x0100 + self.stkp, self.pc & 0x00FF)
             self.stkp = (self.stkp - 1) % 256
-            # Then Push the status register to the stack
+            # Then Push the status register to the stack, B is left clear as only BRK and PHP push it set
             self.write(0x0100 + self.stkp, self.status)
             self.stkp = (self.stkp - 1) % 256
-            self.set_flag(self.FLAGS6502.B, 0)
-            self.set_flag(self.FLAGS6502.U, 1)
             self.set_flag(self.FLAGS6502.I, 1)
             # Read new program counter location from fixed address
             self.addr_abs = 0xFFFE
@@ -657,6 +164,7 @@ class OLC6502:
             self.pc = (hi << 8) | lo
             # IRQs take time
             self.cycles = 7
+            self.clock_count += 7
 
     def nmi(self):
         # A Non - Maskable Interrupt cannot be ignored. It behaves in exactly the same way as a regular IRQ,
@@ -667,12 +175,10 @@ class OLC6502:
         self.stkp = (self.stkp - 1) % 256
         self.write(0x0100 + self.stkp, self.pc & 0x00FF)
         self.stkp = (self.stkp - 1) % 256
-        # Then Push the status register to the stack
-        self.set_flag(self.FLAGS6502.B, 0)
-        self.set_flag(self.FLAGS6502.U, 1)
-        self.set_flag(self.FLAGS6502.I, 1)
+        # Then Push the status register to the stack as it was before the interrupt, so RTI leaves I as it found it
         self.write(0x0100 + self.stkp, self.status)
         self.stkp = (self.stkp - 1) % 256
+        self.set_flag(self.FLAGS6502.I, 1)
         # Read new program counter location from fixed address
         self.addr_abs = 0xFFFA
         lo = self.read(self.addr_abs + 0)
@@ -680,6 +186,87 @@ class OLC6502:
         self.pc = (hi << 8) | lo
         # IRQs take time
         self.cycles = 7
+        self.clock_count += 7
+
+    def clone(self):
+        # Copy of the cpu for Bus.clone, not connected to anything yet. The translated blocks are shared: rom blocks
+        # are kept per bank and ram blocks are checked against their code before they run, so they hold for every
+        # copy. Idle loops are only valid for the banks of the cpu that found them
+        cpu = copy.copy(self)
+        cpu.idle_loops = {}
+        return cpu
+
+    #######################################################
+    # Save states
+
+    STATE = struct.Struct("<BBBBHBHQB")  # a, x, y, stkp, pc, flags, nz, clock_count, cycles
+
+    def save_state(self):
+        return self.STATE.pack(self.a, self.x, self.y, self.stkp, self.pc, self.flags, self.nz, self.clock_count,
+                               self.cycles)
+
+    def load_state(self, data, offset):
+        # Restore the registers from data at offset and return the offset after them
+        (self.a, self.x, self.y, self.stkp, self.pc, self.flags, self.nz, self.clock_count,
+         self.cycles) = self.STATE.unpack_from(data, offset)
+        return offset + self.STATE.size
+
+    #######################################################
+    # Idle loops
+    # Games wait for the nmi in a tight loop: JMP *, or reading a ram flag or PPUSTATUS until it changes. Such a
+    # loop writes nothing and only reads memory that cannot change before the next ppu event, so once an iteration
+    # leaves the registers as the previous one did, so will every following one and the bus can skip them
+
+    # Operations allowed in an idle loop, besides branches and a JMP back to its head
+    IDLE_OPERATIONS = ("LDA", "LDX", "LDY", "BIT", "CMP", "CPX", "CPY", "AND", "ORA", "EOR", "NOP",
+                       "CLC", "SEC", "CLV", "TAX", "TAY", "TXA", "TYA")
+    IDLE_LOOP_LENGTH = 8  # Most instructions in an idle loop
+
+    @staticmethod
+    def idle_read(addr):
+        # Reading addr has no side effect, or one that does not change when repeated (PPUSTATUS)
+        return addr < 0x2000 or addr >= 0x6000 or (addr & 0xE007) == 0x2002
+
+    def idle_loop(self, head):
+        # Number of instructions in the loop at head if it can be an idle loop, else 0
+        if head in self.idle_loops:
+            return self.idle_loops[head]
+        length = self.scan_idle_loop(head)
+        if 0x8000 <= head <= 0xFFE0:
+            self.idle_loops[head] = length
+        return length
+
+    def scan_idle_loop(self, head):
+        # Walk the code from head until a branch or JMP back to it, giving up on anything that writes, uses the
+        # stack, indexes or reads a register with side effects
+        pc = head
+        for length in range(1, self.IDLE_LOOP_LENGTH + 1):
+            if not (pc < 0x2000 or pc >= 0x6000):
+                return 0
+            item = self.instructions[self.read(pc)]
+            if item.addr_mode in ("IMP", "IMM"):
+                operand = None
+                size = 0 if item.addr_mode == "IMP" else 1
+            elif item.addr_mode in ("ZP0", "REL"):
+                operand = self.read((pc + 1) & 0xFFFF)
+                size = 1
+            elif item.addr_mode == "ABS":
+                operand = self.read((pc + 1) & 0xFFFF) | (self.read((pc + 2) & 0xFFFF) << 8)
+                size = 2
+            else:
+                return 0
+            pc = (pc + 1 + size) & 0xFFFF
+            if item.addr_mode == "REL":
+                if (pc + operand - (0x100 if operand & 0x80 else 0)) & 0xFFFF == head:
+                    return length
+                # a branch anywhere else leaves the loop, it is not taken while the cpu idles
+            elif item.operation == "JMP":
+                return length if operand == head else 0
+            elif item.operation not in self.IDLE_OPERATIONS:
+                return 0
+            elif item.addr_mode in ("ZP0", "ABS") and not self.idle_read(operand):
+                return 0
+        return 0
 
     #######################################################
     # Lookup Table and helper class for getting correct address mode and operation based on opcode
@@ -691,31 +278,24 @@ class OLC6502:
             self.cycles = cycles
 
     lookup = [
-        [LookupItem("BRK", BRK, IMM, 7), LookupItem("ORA", ORA, IZX, 6), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("NOP", NOP, IMP, 3), LookupItem("ORA", ORA, ZP0, 3), LookupItem("ASL", ASL, ZP0, 5), LookupItem("???", XXX, IMP, 5), LookupItem("PHP", PHP, IMP, 3), LookupItem("ORA", ORA, IMM, 2), LookupItem("ASL", ASL, IMP, 2), LookupItem("???", XXX, IMP, 2), LookupItem("NOP", NOP, IMP, 4), LookupItem("ORA", ORA, ABS, 4), LookupItem("ASL", ASL, ABS, 6), LookupItem("???", XXX, IMP, 6)],
-        [LookupItem("BPL", BPL, REL, 2), LookupItem("ORA", ORA, IZY, 5), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("NOP", NOP, IMP, 4), LookupItem("ORA", ORA, ZPX, 4), LookupItem("ASL", ASL, ZPX, 6), LookupItem("???", XXX, IMP, 6), LookupItem("CLC", CLC, IMP, 2), LookupItem("ORA", ORA, ABY, 4), LookupItem("NOP", NOP, IMP, 2), LookupItem("???", XXX, IMP, 7), LookupItem("NOP", NOP, IMP, 4), LookupItem("ORA", ORA, ABX, 4), LookupItem("ASL", ASL, ABX, 7), LookupItem("???", XXX, IMP, 7)],
-        [LookupItem("JSR", JSR, ABS, 6), LookupItem("AND", AND, IZX, 6), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("BIT", BIT, ZP0, 3), LookupItem("AND", AND, ZP0, 3), LookupItem("ROL", ROL, ZP0, 5), LookupItem("???", XXX, IMP, 5), LookupItem("PLP", PLP, IMP, 4), LookupItem("AND", AND, IMM, 2), LookupItem("ROL", ROL, IMP, 2), LookupItem("???", XXX, IMP, 2), LookupItem("BIT", BIT, ABS, 4), LookupItem("AND", AND, ABS, 4), LookupItem("ROL", ROL, ABS, 6), LookupItem("???", XXX, IMP, 6)],
-        [LookupItem("BMI", BMI, REL, 2), LookupItem("AND", AND, IZY, 5), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("NOP", NOP, IMP, 4), LookupItem("AND", AND, ZPX, 4), LookupItem("ROL", ROL, ZPX, 6), LookupItem("???", XXX, IMP, 6), LookupItem("SEC", SEC, IMP, 2), LookupItem("AND", AND, ABY, 4), LookupItem("NOP", NOP, IMP, 2), LookupItem("???", XXX, IMP, 7), LookupItem("NOP", NOP, IMP, 4), LookupItem("AND", AND, ABX, 4), LookupItem("ROL", ROL, ABX, 7), LookupItem("???", XXX, IMP, 7)],
-        [LookupItem("RTI", RTI, IMP, 6), LookupItem("EOR", EOR, IZX, 6), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("NOP", NOP, IMP, 3), LookupItem("EOR", EOR, ZP0, 3), LookupItem("LSR", LSR, ZP0, 5), LookupItem("???", XXX, IMP, 5), LookupItem("PHA", PHA, IMP, 3), LookupItem("EOR", EOR, IMM, 2), LookupItem("LSR", LSR, IMP, 2), LookupItem("???", XXX, IMP, 2), LookupItem("JMP", JMP, ABS, 3), LookupItem("EOR", EOR, ABS, 4), LookupItem("LSR", LSR, ABS, 6), LookupItem("???", XXX, IMP, 6)],
-        [LookupItem("BVC", BVC, REL, 2), LookupItem("EOR", EOR, IZY, 5), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("NOP", NOP, IMP, 4), LookupItem("EOR", EOR, ZPX, 4), LookupItem("LSR", LSR, ZPX, 6), LookupItem("???", XXX, IMP, 6), LookupItem("CLI", CLI, IMP, 2), LookupItem("EOR", EOR, ABY, 4), LookupItem("NOP", NOP, IMP, 2), LookupItem("???", XXX, IMP, 7), LookupItem("NOP", NOP, IMP, 4), LookupItem("EOR", EOR, ABX, 4), LookupItem("LSR", LSR, ABX, 7), LookupItem("???", XXX, IMP, 7)],
-        [LookupItem("RTS", RTS, IMP, 6), LookupItem("ADC", ADC, IZX, 6), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("NOP", NOP, IMP, 3), LookupItem("ADC", ADC, ZP0, 3), LookupItem("ROR", ROR, ZP0, 5), LookupItem("???", XXX, IMP, 5), LookupItem("PLA", PLA, IMP, 4), LookupItem("ADC", ADC, IMM, 2), LookupItem("ROR", ROR, IMP, 2), LookupItem("???", XXX, IMP, 2), LookupItem("JMP", JMP, IND, 5), LookupItem("ADC", ADC, ABS, 4), LookupItem("ROR", ROR, ABS, 6), LookupItem("???", XXX, IMP, 6)],
-        [LookupItem("BVS", BVS, REL, 2), LookupItem("ADC", ADC, IZY, 5), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("NOP", NOP, IMP, 4), LookupItem("ADC", ADC, ZPX, 4), LookupItem("ROR", ROR, ZPX, 6), LookupItem("???", XXX, IMP, 6), LookupItem("SEI", SEI, IMP, 2), LookupItem("ADC", ADC, ABY, 4), LookupItem("NOP", NOP, IMP, 2), LookupItem("???", XXX, IMP, 7), LookupItem("NOP", NOP, IMP, 4), LookupItem("ADC", ADC, ABX, 4), LookupItem("ROR", ROR, ABX, 7), LookupItem("???", XXX, IMP, 7)],
-        [LookupItem("NOP", NOP, IMP, 2), LookupItem("STA", STA, IZX, 6), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 6), LookupItem("STY", STY, ZP0, 3), LookupItem("STA", STA, ZP0, 3), LookupItem("STX", STX, ZP0, 3), LookupItem("???", XXX, IMP, 3), LookupItem("DEY", DEY, IMP, 2), LookupItem("NOP", NOP, IMM, 2), LookupItem("TXA", TXA, IMP, 2), LookupItem("???", XXX, IMP, 2), LookupItem("STY", STY, ABS, 4), LookupItem("STA", STA, ABS, 4), LookupItem("STX", STX, ABS, 4), LookupItem("???", XXX, IMP, 4)],
-        [LookupItem("BCC", BCC, REL, 2), LookupItem("STA", STA, IZY, 6), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 6), LookupItem("STY", STY, ZPX, 4), LookupItem("STA", STA, ZPX, 4), LookupItem("STX", STX, ZPY, 4), LookupItem("???", XXX, IMP, 4), LookupItem("TYA", TYA, IMP, 2), LookupItem("STA", STA, ABY, 5), LookupItem("TXS", TXS, IMP, 2), LookupItem("???", XXX, IMP, 5), LookupItem("NOP", NOP, IMP, 5), LookupItem("STA", STA, ABX, 5), LookupItem("???", XXX, IMP, 5), LookupItem("???", XXX, IMP, 5)],
-        [LookupItem("LDY", LDY, IMM, 2), LookupItem("LDA", LDA, IZX, 6), LookupItem("LDX", LDX, IMM, 2), LookupItem("LAX", LAX, IZX, 6), LookupItem("LDY", LDY, ZP0, 3), LookupItem("LDA", LDA, ZP0, 3), LookupItem("LDX", LDX, ZP0, 3), LookupItem("???", XXX, IMP, 3), LookupItem("TAY", TAY, IMP, 2), LookupItem("LDA", LDA, IMM, 2), LookupItem("TAX", TAX, IMP, 2), LookupItem("???", XXX, IMP, 2), LookupItem("LDY", LDY, ABS, 4), LookupItem("LDA", LDA, ABS, 4), LookupItem("LDX", LDX, ABS, 4), LookupItem("???", XXX, IMP, 4)],
-        [LookupItem("BCS", BCS, REL, 2), LookupItem("LDA", LDA, IZY, 5), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 5), LookupItem("LDY", LDY, ZPX, 4), LookupItem("LDA", LDA, ZPX, 4), LookupItem("LDX", LDX, ZPY, 4), LookupItem("???", XXX, IMP, 4), LookupItem("CLV", CLV, IMP, 2), LookupItem("LDA", LDA, ABY, 4), LookupItem("TSX", TSX, IMP, 2), LookupItem("???", XXX, IMP, 4), LookupItem("LDY", LDY, ABX, 4), LookupItem("LDA", LDA, ABX, 4), LookupItem("LDX", LDX, ABY, 4), LookupItem("???", XXX, IMP, 4)],
-        [LookupItem("CPY", CPY, IMM, 2), LookupItem("CMP", CMP, IZX, 6), LookupItem("NOP", NOP, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("CPY", CPY, ZP0, 3), LookupItem("CMP", CMP, ZP0, 3), LookupItem("DEC", DEC, ZP0, 5), LookupItem("???", XXX, IMP, 5), LookupItem("INY", INY, IMP, 2), LookupItem("CMP", CMP, IMM, 2), LookupItem("DEX", DEX, IMP, 2), LookupItem("???", XXX, IMP, 2), LookupItem("CPY", CPY, ABS, 4), LookupItem("CMP", CMP, ABS, 4), LookupItem("DEC", DEC, ABS, 6), LookupItem("???", XXX, IMP, 6)],
-        [LookupItem("BNE", BNE, REL, 2), LookupItem("CMP", CMP, IZY, 5), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("NOP", NOP, IMP, 4), LookupItem("CMP", CMP, ZPX, 4), LookupItem("DEC", DEC, ZPX, 6), LookupItem("???", XXX, IMP, 6), LookupItem("CLD", CLD, IMP, 2), LookupItem("CMP", CMP, ABY, 4), LookupItem("NOP", NOP, IMP, 2), LookupItem("???", XXX, IMP, 7), LookupItem("NOP", NOP, IMP, 4), LookupItem("CMP", CMP, ABX, 4), LookupItem("DEC", DEC, ABX, 7), LookupItem("???", XXX, IMP, 7)],
-        [LookupItem("CPX", CPX, IMM, 2), LookupItem("SBC", SBC, IZX, 6), LookupItem("NOP", NOP, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("CPX", CPX, ZP0, 3), LookupItem("SBC", SBC, ZP0, 3), LookupItem("INC", INC, ZP0, 5), LookupItem("???", XXX, IMP, 5), LookupItem("INX", INX, IMP, 2), LookupItem("SBC", SBC, IMM, 2), LookupItem("NOP", NOP, IMP, 2), LookupItem("SBC", SBC, IMP, 2), LookupItem("CPX", CPX, ABS, 4), LookupItem("SBC", SBC, ABS, 4), LookupItem("INC", INC, ABS, 6), LookupItem("???", XXX, IMP, 6)],
-        [LookupItem("BEQ", BEQ, REL, 2), LookupItem("SBC", SBC, IZY, 5), LookupItem("???", XXX, IMP, 2), LookupItem("???", XXX, IMP, 8), LookupItem("NOP", NOP, IMP, 4), LookupItem("SBC", SBC, ZPX, 4), LookupItem("INC", INC, ZPX, 6), LookupItem("???", XXX, IMP, 6), LookupItem("SED", SED, IMP, 2), LookupItem("SBC", SBC, ABY, 4), LookupItem("NOP", NOP, IMP, 2), LookupItem("???", XXX, IMP, 7), LookupItem("NOP", NOP, IMP, 4), LookupItem("SBC", SBC, ABX, 4), LookupItem("INC", INC, ABX, 7), LookupItem("???", XXX, IMP, 7)],
+        [LookupItem("BRK", "BRK", "IMM", 7), LookupItem("ORA", "ORA", "IZX", 6), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("NOP", "NOP", "IMP", 3), LookupItem("ORA", "ORA", "ZP0", 3), LookupItem("ASL", "ASL", "ZP0", 5), LookupItem("???", "XXX", "IMP", 5), LookupItem("PHP", "PHP", "IMP", 3), LookupItem("ORA", "ORA", "IMM", 2), LookupItem("ASL", "ASL", "IMP", 2), LookupItem("???", "XXX", "IMP", 2), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("ORA", "ORA", "ABS", 4), LookupItem("ASL", "ASL", "ABS", 6), LookupItem("???", "XXX", "IMP", 6)],
+        [LookupItem("BPL", "BPL", "REL", 2), LookupItem("ORA", "ORA", "IZY", 5), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("ORA", "ORA", "ZPX", 4), LookupItem("ASL", "ASL", "ZPX", 6), LookupItem("???", "XXX", "IMP", 6), LookupItem("CLC", "CLC", "IMP", 2), LookupItem("ORA", "ORA", "ABY", 4), LookupItem("NOP", "NOP", "IMP", 2), LookupItem("???", "XXX", "IMP", 7), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("ORA", "ORA", "ABX", 4), LookupItem("ASL", "ASL", "ABX", 7), LookupItem("???", "XXX", "IMP", 7)],
+        [LookupItem("JSR", "JSR", "ABS", 6), LookupItem("AND", "AND", "IZX", 6), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("BIT", "BIT", "ZP0", 3), LookupItem("AND", "AND", "ZP0", 3), LookupItem("ROL", "ROL", "ZP0", 5), LookupItem("???", "XXX", "IMP", 5), LookupItem("PLP", "PLP", "IMP", 4), LookupItem("AND", "AND", "IMM", 2), LookupItem("ROL", "ROL", "IMP", 2), LookupItem("???", "XXX", "IMP", 2), LookupItem("BIT", "BIT", "ABS", 4), LookupItem("AND", "AND", "ABS", 4), LookupItem("ROL", "ROL", "ABS", 6), LookupItem("???", "XXX", "IMP", 6)],
+        [LookupItem("BMI", "BMI", "REL", 2), LookupItem("AND", "AND", "IZY", 5), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("AND", "AND", "ZPX", 4), LookupItem("ROL", "ROL", "ZPX", 6), LookupItem("???", "XXX", "IMP", 6), LookupItem("SEC", "SEC", "IMP", 2), LookupItem("AND", "AND", "ABY", 4), LookupItem("NOP", "NOP", "IMP", 2), LookupItem("???", "XXX", "IMP", 7), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("AND", "AND", "ABX", 4), LookupItem("ROL", "ROL", "ABX", 7), LookupItem("???", "XXX", "IMP", 7)],
+        [LookupItem("RTI", "RTI", "IMP", 6), LookupItem("EOR", "EOR", "IZX", 6), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("NOP", "NOP", "IMP", 3), LookupItem("EOR", "EOR", "ZP0", 3), LookupItem("LSR", "LSR", "ZP0", 5), LookupItem("???", "XXX", "IMP", 5), LookupItem("PHA", "PHA", "IMP", 3), LookupItem("EOR", "EOR", "IMM", 2), LookupItem("LSR", "LSR", "IMP", 2), LookupItem("???", "XXX", "IMP", 2), LookupItem("JMP", "JMP", "ABS", 3), LookupItem("EOR", "EOR", "ABS", 4), LookupItem("LSR", "LSR", "ABS", 6), LookupItem("???", "XXX", "IMP", 6)],
+        [LookupItem("BVC", "BVC", "REL", 2), LookupItem("EOR", "EOR", "IZY", 5), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("EOR", "EOR", "ZPX", 4), LookupItem("LSR", "LSR", "ZPX", 6), LookupItem("???", "XXX", "IMP", 6), LookupItem("CLI", "CLI", "IMP", 2), LookupItem("EOR", "EOR", "ABY", 4), LookupItem("NOP", "NOP", "IMP", 2), LookupItem("???", "XXX", "IMP", 7), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("EOR", "EOR", "ABX", 4), LookupItem("LSR", "LSR", "ABX", 7), LookupItem("???", "XXX", "IMP", 7)],
+        [LookupItem("RTS", "RTS", "IMP", 6), LookupItem("ADC", "ADC", "IZX", 6), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("NOP", "NOP", "IMP", 3), LookupItem("ADC", "ADC", "ZP0", 3), LookupItem("ROR", "ROR", "ZP0", 5), LookupItem("???", "XXX", "IMP", 5), LookupItem("PLA", "PLA", "IMP", 4), LookupItem("ADC", "ADC", "IMM", 2), LookupItem("ROR", "ROR", "IMP", 2), LookupItem("???", "XXX", "IMP", 2), LookupItem("JMP", "JMP", "IND", 5), LookupItem("ADC", "ADC", "ABS", 4), LookupItem("ROR", "ROR", "ABS", 6), LookupItem("???", "XXX", "IMP", 6)],
+        [LookupItem("BVS", "BVS", "REL", 2), LookupItem("ADC", "ADC", "IZY", 5), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("ADC", "ADC", "ZPX", 4), LookupItem("ROR", "ROR", "ZPX", 6), LookupItem("???", "XXX", "IMP", 6), LookupItem("SEI", "SEI", "IMP", 2), LookupItem("ADC", "ADC", "ABY", 4), LookupItem("NOP", "NOP", "IMP", 2), LookupItem("???", "XXX", "IMP", 7), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("ADC", "ADC", "ABX", 4), LookupItem("ROR", "ROR", "ABX", 7), LookupItem("???", "XXX", "IMP", 7)],
+        [LookupItem("NOP", "NOP", "IMP", 2), LookupItem("STA", "STA", "IZX", 6), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 6), LookupItem("STY", "STY", "ZP0", 3), LookupItem("STA", "STA", "ZP0", 3), LookupItem("STX", "STX", "ZP0", 3), LookupItem("???", "XXX", "IMP", 3), LookupItem("DEY", "DEY", "IMP", 2), LookupItem("NOP", "NOP", "IMM", 2), LookupItem("TXA", "TXA", "IMP", 2), LookupItem("???", "XXX", "IMP", 2), LookupItem("STY", "STY", "ABS", 4), LookupItem("STA", "STA", "ABS", 4), LookupItem("STX", "STX", "ABS", 4), LookupItem("???", "XXX", "IMP", 4)],
+        [LookupItem("BCC", "BCC", "REL", 2), LookupItem("STA", "STA", "IZY", 6), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 6), LookupItem("STY", "STY", "ZPX", 4), LookupItem("STA", "STA", "ZPX", 4), LookupItem("STX", "STX", "ZPY", 4), LookupItem("???", "XXX", "IMP", 4), LookupItem("TYA", "TYA", "IMP", 2), LookupItem("STA", "STA", "ABY", 5), LookupItem("TXS", "TXS", "IMP", 2), LookupItem("???", "XXX", "IMP", 5), LookupItem("NOP", "NOP", "IMP", 5), LookupItem("STA", "STA", "ABX", 5), LookupItem("???", "XXX", "IMP", 5), LookupItem("???", "XXX", "IMP", 5)],
+        [LookupItem("LDY", "LDY", "IMM", 2), LookupItem("LDA", "LDA", "IZX", 6), LookupItem("LDX", "LDX", "IMM", 2), LookupItem("LAX", "LAX", "IZX", 6), LookupItem("LDY", "LDY", "ZP0", 3), LookupItem("LDA", "LDA", "ZP0", 3), LookupItem("LDX", "LDX", "ZP0", 3), LookupItem("???", "XXX", "IMP", 3), LookupItem("TAY", "TAY", "IMP", 2), LookupItem("LDA", "LDA", "IMM", 2), LookupItem("TAX", "TAX", "IMP", 2), LookupItem("???", "XXX", "IMP", 2), LookupItem("LDY", "LDY", "ABS", 4), LookupItem("LDA", "LDA", "ABS", 4), LookupItem("LDX", "LDX", "ABS", 4), LookupItem("???", "XXX", "IMP", 4)],
+        [LookupItem("BCS", "BCS", "REL", 2), LookupItem("LDA", "LDA", "IZY", 5), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 5), LookupItem("LDY", "LDY", "ZPX", 4), LookupItem("LDA", "LDA", "ZPX", 4), LookupItem("LDX", "LDX", "ZPY", 4), LookupItem("???", "XXX", "IMP", 4), LookupItem("CLV", "CLV", "IMP", 2), LookupItem("LDA", "LDA", "ABY", 4), LookupItem("TSX", "TSX", "IMP", 2), LookupItem("???", "XXX", "IMP", 4), LookupItem("LDY", "LDY", "ABX", 4), LookupItem("LDA", "LDA", "ABX", 4), LookupItem("LDX", "LDX", "ABY", 4), LookupItem("???", "XXX", "IMP", 4)],
+        [LookupItem("CPY", "CPY", "IMM", 2), LookupItem("CMP", "CMP", "IZX", 6), LookupItem("NOP", "NOP", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("CPY", "CPY", "ZP0", 3), LookupItem("CMP", "CMP", "ZP0", 3), LookupItem("DEC", "DEC", "ZP0", 5), LookupItem("???", "XXX", "IMP", 5), LookupItem("INY", "INY", "IMP", 2), LookupItem("CMP", "CMP", "IMM", 2), LookupItem("DEX", "DEX", "IMP", 2), LookupItem("???", "XXX", "IMP", 2), LookupItem("CPY", "CPY", "ABS", 4), LookupItem("CMP", "CMP", "ABS", 4), LookupItem("DEC", "DEC", "ABS", 6), LookupItem("???", "XXX", "IMP", 6)],
+        [LookupItem("BNE", "BNE", "REL", 2), LookupItem("CMP", "CMP", "IZY", 5), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("CMP", "CMP", "ZPX", 4), LookupItem("DEC", "DEC", "ZPX", 6), LookupItem("???", "XXX", "IMP", 6), LookupItem("CLD", "CLD", "IMP", 2), LookupItem("CMP", "CMP", "ABY", 4), LookupItem("NOP", "NOP", "IMP", 2), LookupItem("???", "XXX", "IMP", 7), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("CMP", "CMP", "ABX", 4), LookupItem("DEC", "DEC", "ABX", 7), LookupItem("???", "XXX", "IMP", 7)],
+        [LookupItem("CPX", "CPX", "IMM", 2), LookupItem("SBC", "SBC", "IZX", 6), LookupItem("NOP", "NOP", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("CPX", "CPX", "ZP0", 3), LookupItem("SBC", "SBC", "ZP0", 3), LookupItem("INC", "INC", "ZP0", 5), LookupItem("???", "XXX", "IMP", 5), LookupItem("INX", "INX", "IMP", 2), LookupItem("SBC", "SBC", "IMM", 2), LookupItem("NOP", "NOP", "IMP", 2), LookupItem("SBC", "SBC", "IMP", 2), LookupItem("CPX", "CPX", "ABS", 4), LookupItem("SBC", "SBC", "ABS", 4), LookupItem("INC", "INC", "ABS", 6), LookupItem("???", "XXX", "IMP", 6)],
+        [LookupItem("BEQ", "BEQ", "REL", 2), LookupItem("SBC", "SBC", "IZY", 5), LookupItem("???", "XXX", "IMP", 2), LookupItem("???", "XXX", "IMP", 8), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("SBC", "SBC", "ZPX", 4), LookupItem("INC", "INC", "ZPX", 6), LookupItem("???", "XXX", "IMP", 6), LookupItem("SED", "SED", "IMP", 2), LookupItem("SBC", "SBC", "ABY", 4), LookupItem("NOP", "NOP", "IMP", 2), LookupItem("???", "XXX", "IMP", 7), LookupItem("NOP", "NOP", "IMP", 4), LookupItem("SBC", "SBC", "ABX", 4), LookupItem("INC", "INC", "ABX", 7), LookupItem("???", "XXX", "IMP", 7)],
     ]
 
-    # Other Helper functions
-    def fetch(self):
-        if self.opcode_item.addr_mode.__name__ != "IMP":
-            self.fetched = self.read(self.addr_abs)
-        return self.fetched
-
-    def do_lookup(self, opcode):
-        hi = (opcode & 0xF0) >> 4
-        lo = opcode & 0x0F
-        return self.lookup[hi][lo]
\ No newline at end of file
+    # Flat view of the table above and the fused handler generated for every opcode, both indexed by the opcode byte
+    instructions = [item for row in lookup for item in row]
+    dispatch = build_dispatch(instructions)
@@ -0,0 +1,145 @@
+import json
+import time
+import argparse
+from Bus import Bus as Nes
+
+# Where the emulated and the host time of a game goes. Run as
+#   python Profiler.py <rom> [--frames N] [--top N] [--json FILE]
+# Profiling swaps cpu.step, ppu.run and bus.run_until for timed and counting versions on the instances, nothing is
+# checked on the normal path and stop() puts it back. Translated blocks are turned off meanwhile so that every
+# instruction is counted, idle loop skipping stays on and the cycles it skips are reported on their own.
+# Host time is split into the cpu executing instructions, the ppu catching up, and the bus, which is the rest of
+# run_until: scheduling ppu events, finding idle loops and taking interrupts. Timing every instruction adds to the
+# cpu share, so the split is a guide rather than a measurement of the unprofiled emulator
+
+
+class Profiler:
+    def __init__(self, bus):
+        self.bus = bus
+        self.counts = [0] * 256  # executions of each opcode
+        self.cycles = [0] * 256  # cycles spent in each opcode
+        self.pcs = {}  # executions by (bank, pc)
+        self.cpu_time = 0.0
+        self.ppu_time = 0.0
+        self.total_time = 0.0  # in run_until
+        self.emulated_cycles = 0  # cpu cycles that passed in run_until
+        self.use_blocks = False  # setting of the cpu before profiling started
+
+    def start(self):
+        bus = self.bus
+        self.use_blocks = bus.cpu.use_blocks
+        bus.cpu.use_blocks = False
+        bus.cpu.step = self.step
+        bus.ppu.run = self.ppu_run
+        bus.run_until = self.run_until
+
+    def stop(self):
+        bus = self.bus
+        del bus.cpu.step, bus.ppu.run, bus.run_until
+        bus.cpu.use_blocks = self.use_blocks
+
+    def bank(self, pc):
+        # Name of the memory the code at pc runs from
+        if pc >= 0x8000:
+            return "PRG {:02X}".format(self.bus.cart.mapper.prg_windows[(pc >> 13) & 0x03] >> 13)
+        if pc >= 0x6000:
+            return "SRAM"
+        return "RAM"
+
+    def step(self):
+        # cpu.step while profiling, the ppu time of a register access inside the instruction is not cpu time
+        cpu = self.bus.cpu
+        pc = cpu.pc
+        ppu_time = self.ppu_time
+        start = time.perf_counter()
+        cycles = type(cpu).step(cpu)
+        self.cpu_time += time.perf_counter() - start - (self.ppu_time - ppu_time)
+        self.counts[cpu.opcode] += 1
+        self.cycles[cpu.opcode] += cycles
+        key = (self.bank(pc), pc)
+        self.pcs[key] = self.pcs.get(key, 0) + 1
+        return cycles
+
+    def ppu_run(self, dots):
+        ppu = self.bus.ppu
+        start = time.perf_counter()
+        type(ppu).run(ppu, dots)
+        self.ppu_time += time.perf_counter() - start
+
+    def run_until(self, target):
+        bus = self.bus
+        clock_count = bus.cpu.clock_count
+        start = time.perf_counter()
+        type(bus).run_until(bus, target)
+        self.total_time += time.perf_counter() - start
+        self.emulated_cycles += bus.cpu.clock_count - clock_count
+
+    def report(self, top=20):
+        # Everything counted as plain data
+        instructions = self.bus.cpu.instructions
+        opcodes = {}
+        for opcode, item in enumerate(instructions):
+            if self.counts[opcode]:
+                entry = opcodes.setdefault("{} {}".format(item.name, item.addr_mode), {"count": 0, "cycles": 0})
+                entry["count"] += self.counts[opcode]
+                entry["cycles"] += self.cycles[opcode]
+        banks = {}
+        for (bank, pc), count in self.pcs.items():
+            banks.setdefault(bank, {})["{:04X}".format(pc)] = count
+        executed = sum(self.cycles)
+        return {
+            "time": {"total": self.total_time, "cpu": self.cpu_time, "ppu": self.ppu_time,
+                     "bus": self.total_time - self.cpu_time - self.ppu_time},
+            "cycles": {"emulated": self.emulated_cycles, "executed": executed,
+                       "interrupts and idle loops": self.emulated_cycles - executed},
+            "opcodes": dict(sorted(opcodes.items(), key=lambda entry: -entry[1]["cycles"])),
+            "banks": {bank: dict(sorted(pcs.items(), key=lambda entry: -entry[1])[:top])
+                      for bank, pcs in sorted(banks.items())},
+        }
+
+    def text(self, top=20):
+        # The report as text, with the top opcodes and the hottest pcs of each bank
+        report = self.report(top)
+        times = report["time"]
+        cycles = report["cycles"]
+        total = max(times["total"], 1e-9)
+        lines = ["host time {:.3f} s".format(times["total"])]
+        for part in ("cpu", "ppu", "bus"):
+            lines.append("  {:<6}{:8.3f} s {:6.1f} %".format(part, times[part], 100 * times[part] / total))
+        lines.append("emulated cycles {}".format(cycles["emulated"]))
+        for part in ("executed", "interrupts and idle loops"):
+            share = 100 * cycles[part] / max(cycles["emulated"], 1)
+            lines.append("  {:<26}{:>10} {:6.1f} %".format(part, cycles[part], share))
+        lines.append("opcodes by cycles")
+        for name, entry in list(report["opcodes"].items())[:top]:
+            share = 100 * entry["cycles"] / max(cycles["executed"], 1)
+            lines.append("  {:<8}{:>10} x {:>10} cycles {:6.1f} %".format(name, entry["count"], entry["cycles"], share))
+        for bank, pcs in report["banks"].items():
+            lines.append("hot pcs in {}".format(bank))
+            for pc, count in pcs.items():
+                lines.append("  {}{:>10}".format(pc, count))
+        return "\n".join(lines)
+
+    def write_json(self, path, top=20):
+        with open(path, "w") as file:
+            json.dump(self.report(top), file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile where the time of a rom goes")
+    parser.add_argument("rom")
+    parser.add_argument("--frames", type=int, default=300, help="frames to profile")
+    parser.add_argument("--top", type=int, default=20, help="opcodes and pcs per bank to list")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    nes = Nes(verbose=False)
+    nes.insert_cart(args.rom)
+    nes.reset()
+    profiler = Profiler(nes)
+    profiler.start()
+    nes.run_frames(args.frames)
+    profiler.stop()
+    print(profiler.text(args.top))
+    if args.json:
+        profiler.write_json(args.json, args.top)
@@ -0,0 +1,91 @@
+import collections
+import numpy as np
+
+
+# Rewinding keeps a snapshot of the machine (Bus.save_state) every interval frames in a ring holding a fixed number
+# of frames. Every keyframe_interval-th snapshot is kept whole, the ones in between only as their difference from
+# the keyframe before them: the xor of the two states stored as the runs of non zero bytes, which for the frames
+# between two keyframes is a few hundred bytes of ram and registers. The input of every frame is kept as well, so
+# any frame can be brought back by loading the snapshot before it and running the frames in between again
+
+
+def xor_delta(keyframe, state):
+    # Runs of bytes in which state differs from keyframe, as their starts, their ends and the xor of their bytes
+    diff = np.bitwise_xor(np.frombuffer(keyframe, dtype=np.uint8), np.frombuffer(state, dtype=np.uint8))
+    changed = diff != 0
+    edges = np.flatnonzero(np.diff(changed.astype(np.int8), prepend=0, append=0)).astype(np.uint32)
+    return edges[0::2], edges[1::2], diff[changed]
+
+
+def apply_delta(keyframe, delta):
+    # The state xor_delta(keyframe, state) was taken from
+    starts, ends, data = delta
+    starts = starts.astype(np.int64)
+    lengths = ends.astype(np.int64) - starts
+    first = np.cumsum(lengths) - lengths  # offset into data of each run
+    state = np.frombuffer(keyframe, dtype=np.uint8).copy()
+    state[np.repeat(starts - first, lengths) + np.arange(len(data))] ^= data
+    return state.tobytes()
+
+
+class Rewind:
+    def __init__(self, bus, frames=3600, interval=1, keyframe_interval=60):
+        self.bus = bus
+        self.interval = interval  # frames from one snapshot to the next
+        self.keyframe_interval = keyframe_interval  # snapshots from one keyframe to the next
+        self.snapshots = collections.deque(maxlen=frames // interval + 1)  # (frame, keyframe, delta or None)
+        self.inputs = collections.deque(maxlen=frames + interval)  # controllers during each frame, last one last
+        self.frame = 0  # frames recorded
+        self.keyframe = None  # state the next deltas are taken against
+        self.deltas = 0  # snapshots stored as deltas since the keyframe
+
+    def clear(self):
+        # Forget the history, needed when the machine is reset or a state is loaded from elsewhere
+        self.snapshots.clear()
+        self.inputs.clear()
+        self.keyframe = None
+
+    def record(self):
+        # Call after every frame, while the controllers still hold the input the frame ran with
+        self.inputs.append(tuple(self.bus.controller))
+        self.frame += 1
+        if self.snapshots and self.frame - self.snapshots[-1][0] < self.interval:
+            return
+        state = self.bus.save_state()
+        if self.keyframe is None or self.deltas >= self.keyframe_interval - 1:
+            self.snapshots.append((self.frame, state, None))
+            self.keyframe = state
+            self.deltas = 0
+        else:
+            # A delta holds on to its keyframe, so deltas stay usable after the ring dropped the keyframe itself
+            self.snapshots.append((self.frame, self.keyframe, xor_delta(self.keyframe, state)))
+            self.deltas += 1
+
+    def restore(self, frames=1):
+        # Go back frames frames, or as far as the history reaches, and return the picture of that frame, or None
+        # when there is nothing to go back to. The history after it is dropped
+        oldest = self.frame - len(self.inputs)  # the input of every frame after this one is known
+        usable = [snapshot for snapshot in self.snapshots if oldest <= snapshot[0] < self.frame]
+        if not usable:
+            return None
+        # At least one frame is run after the snapshot, the picture is not part of the state
+        target = max(self.frame - frames, usable[0][0] + 1)
+        frame, keyframe, delta = next(snapshot for snapshot in reversed(usable) if snapshot[0] < target)
+        self.bus.load_state(keyframe if delta is None else apply_delta(keyframe, delta))
+        inputs = list(self.inputs)
+        for i in range(frame + 1, target + 1):
+            self.bus.controller[:] = inputs[i - self.frame - 1]
+            screen = self.bus.run_frame(indices=i < target)
+        for _ in range(self.frame - target):
+            self.inputs.pop()
+        while self.snapshots and self.snapshots[-1][0] > target:
+            self.snapshots.pop()
+        self.frame = target
+        self.keyframe = None
+        return screen
+
+    def memory_used(self):
+        # Bytes held by the snapshots
+        keyframes = {id(keyframe): len(keyframe) for _, keyframe, _ in self.snapshots}
+        deltas = sum(sum(part.nbytes for part in delta) for _, _, delta in self.snapshots if delta is not None)
+        return sum(keyframes.values()) + deltas
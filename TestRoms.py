@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from Bus import Bus as Nes
+
+# Runs test roms headless in a process pool and reports for each whether it passed, how long it took and how fast
+# it was emulated, so the suite doubles as a performance regression check. Run as
+#   python TestRoms.py [roms or directories] [--processes N] [--frames N] [--blocks] [--min-speed N] [--json FILE]
+# Blargg's test roms report through sram: 0x6001 - 0x6003 hold DE B0 61 once they use the protocol, 0x6000 is 0x80
+# while the test runs, 0x81 when the reset button has to be pressed and the result code once done, 0 for passed.
+# A result only counts after the test was seen running, sram can hold anything before the rom sets 0x6000 up.
+# The text the rom printed is at 0x6004, zero terminated. Roms that do not use the protocol run until the frame
+# budget is used up and are reported as timed out, a test that was seen running but never finished as hung
+
+SIGNATURE = b"\xde\xb0\x61"
+RUNNING = 0x80
+NEEDS_RESET = 0x81
+RESET_DELAY = 6  # frames to wait before pressing reset, the roms ask for at least 100 ms
+
+
+def run_rom(path, frames=3600, use_blocks=False):
+    # Run one test rom for at most frames frames and return its result
+    start = time.perf_counter()
+    result = {"rom": path, "status": "timeout", "code": None, "text": "", "frames": 0}
+    cycles = 0  # cpu cycles before the last reset
+    nes = None
+    try:
+        nes = Nes(verbose=False)
+        nes.insert_cart(path)
+        nes.cpu.use_blocks = use_blocks
+        nes.reset()
+        reset_at = None
+        running = False
+        for frame in range(1, frames + 1):
+            nes.finish_frame()
+            result["frames"] = frame
+            sram = nes.cart.sram
+            if sram[1:4] != SIGNATURE:
+                continue
+            if sram[0] == RUNNING:
+                running = True
+            elif sram[0] == NEEDS_RESET:
+                running = True
+                if reset_at is None:
+                    reset_at = frame + RESET_DELAY
+                elif frame >= reset_at:
+                    cycles += nes.cpu.clock_count
+                    nes.reset()
+                    reset_at = None
+            elif sram[0] < RUNNING and running:
+                result["code"] = sram[0]
+                result["status"] = "passed" if sram[0] == 0 else "failed"
+                break
+        if result["status"] == "timeout" and running:
+            result["status"] = "hung"
+        result["text"] = bytes(nes.cart.sram[4:]).split(b"\0")[0].decode("ascii", "replace").strip()
+    except Exception as error:
+        result["status"] = "error"
+        result["text"] = "{}: {}".format(type(error).__name__, error)
+    result["seconds"] = time.perf_counter() - start
+    result["cycles"] = cycles + (nes.cpu.clock_count if nes is not None else 0)
+    result["cycles_per_second"] = result["cycles"] / result["seconds"]
+    return result
+
+
+def find_roms(paths):
+    # The .nes files given and those in the directories given, searched recursively
+    roms = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, files in os.walk(path):
+                roms += [os.path.join(directory, name) for name in files if name.lower().endswith(".nes")]
+        else:
+            roms.append(path)
+    return sorted(roms)
+
+
+def run_suite(roms, processes=None, frames=3600, use_blocks=False):
+    # Results of every rom in the order given, the roms running in parallel on processes processes
+    with multiprocessing.Pool(processes) as pool:
+        return pool.starmap(run_rom, [(rom, frames, use_blocks) for rom in roms], chunksize=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run test roms headless and report the results")
+    parser.add_argument("paths", nargs="*", default=["roms/testroms"], help="roms or directories of roms")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes, every core by default")
+    parser.add_argument("--frames", type=int, default=3600, help="frames a rom may run before it times out")
+    parser.add_argument("--blocks", action="store_true", help="run the cpu as translated blocks")
+    parser.add_argument("--min-speed", type=float, default=0, help="cpu cycles per second a rom must reach")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    roms = find_roms(args.paths)
+    start = time.perf_counter()
+    results = run_suite(roms, args.processes, args.frames, args.blocks)
+    seconds = time.perf_counter() - start
+    bad = 0
+    for result in results:
+        if result["status"] == "passed" and result["cycles_per_second"] < args.min_speed:
+            result["status"] = "slow"
+        bad += result["status"] in ("failed", "hung", "error", "slow")
+        print("{:<8}{:>8.2f} s{:>12.0f} cycles/s  {}  {}".format(result["status"], result["seconds"],
+                                                                 result["cycles_per_second"], result["rom"],
+                                                                 result["text"].replace("\n", " ")))
+    passed = sum(result["status"] == "passed" for result in results)
+    print("{} of {} passed in {:.2f} s".format(passed, len(results), seconds))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"seconds": seconds, "results": results}, file, indent=2)
+    sys.exit(1 if bad else 0)
@@ -0,0 +1,177 @@
+import re
+import sys
+import struct
+import argparse
+from Bus import Bus as Nes
+from Instructions import OPERAND_SIZES
+
+# Instruction trace in the format of nestest.log, and a diff against such a golden log. Run as
+#   python Trace.py <rom> <golden log> [--start C000] [--ignore PPU,CYC] [--log FILE]
+# Tracing swaps cpu.step for Trace.step, which records the state before every instruction into a ring buffer of
+# fixed size records, and turns off the translated blocks and the idle loop skipping, so every instruction goes
+# through it. The lines are only formatted when the log is read. Stopping removes the swap again, the cpu then runs
+# exactly the code it runs without a trace.
+# Unlike nestest.log the disassembly leaves out the memory contents (STA $00 = 00), reading memory could have side
+# effects, and the diff ignores them in the golden log
+
+UNOFFICIAL_OPERATIONS = ("XXX", "LAX")
+SHIFTS = ("ASL", "LSR", "ROL", "ROR")  # operate on the accumulator in IMP mode
+OPERAND_FORMATS = {"IMP": "", "IMM": "#${:02X}", "ZP0": "${:02X}", "ZPX": "${:02X},X", "ZPY": "${:02X},Y",
+                   "ABS": "${:04X}", "ABX": "${:04X},X", "ABY": "${:04X},Y", "IND": "(${:04X})",
+                   "IZX": "(${:02X},X)", "IZY": "(${:02X}),Y", "REL": "${:04X}"}
+FIELDS = ("PC", "bytes", "instruction", "A", "X", "Y", "P", "SP", "PPU", "CYC")
+
+
+def disassemble(item, pc, operand):
+    # Assembly text of the instruction at pc, operand is the word after the opcode
+    mode = item.addr_mode
+    if mode == "REL":
+        operand = (pc + 2 + (operand & 0xFF) - (0x100 if operand & 0x80 else 0)) & 0xFFFF
+    elif OPERAND_SIZES[mode] == 1:
+        operand &= 0xFF
+    if mode == "IMP" and item.operation in SHIFTS:
+        return item.name + " A"
+    text = OPERAND_FORMATS[mode].format(operand)
+    return item.name + " " + text if text else item.name
+
+
+def unofficial(item, opcode):
+    return item.operation in UNOFFICIAL_OPERATIONS or (item.operation == "NOP" and opcode != 0xEA) or opcode == 0xEB
+
+
+class Trace:
+    RECORD = struct.Struct("<HBBBBBBBBhHQ")  # pc, opcode, operand bytes, a, x, y, status, stkp, scanline, dot, cycle
+
+    def __init__(self, bus, capacity=1 << 20):
+        self.bus = bus
+        self.capacity = capacity  # records kept, older ones are overwritten
+        self.buffer = bytearray(capacity * self.RECORD.size)
+        self.count = 0  # records written
+        self.use_blocks = False  # setting of the cpu before the trace started
+
+    def start(self):
+        cpu = self.bus.cpu
+        self.use_blocks = cpu.use_blocks
+        cpu.use_blocks = False
+        cpu.step = self.step
+        cpu.idle_loop = self.no_idle_loop
+
+    def stop(self):
+        cpu = self.bus.cpu
+        del cpu.step, cpu.idle_loop
+        cpu.use_blocks = self.use_blocks
+
+    @staticmethod
+    def no_idle_loop(_head):
+        return 0
+
+    def peek(self, addr):
+        # Memory without side effects, anything not plainly backed by memory reads as 0
+        page = self.bus.read_pages[addr >> 8]
+        return page[addr & 0xFF] if page is not None else 0
+
+    def step(self):
+        # cpu.step while tracing
+        bus = self.bus
+        cpu = bus.cpu
+        ppu = bus.ppu
+        pc = cpu.pc
+        # the ppu lags behind the cpu, its position at the cpu's time is worked out from the system clock
+        dot = (ppu.frame_dot(ppu.scanline, ppu.cycle) + 3 * cpu.clock_count - bus.system_clock_counter) % ppu.frame_dots
+        if dot > 340 and not ppu.rendering():
+            # the ppu of nestest.log only skips dot 0 of scanline 0 while rendering, this one always does
+            scanline, dot = divmod(dot - 341, 341)
+        else:
+            scanline, dot = ppu.frame_position(dot)
+        self.RECORD.pack_into(self.buffer, (self.count % self.capacity) * self.RECORD.size, pc, self.peek(pc),
+                              self.peek((pc + 1) & 0xFFFF), self.peek((pc + 2) & 0xFFFF), cpu.a, cpu.x, cpu.y,
+                              cpu.status, cpu.stkp, scanline, dot, cpu.clock_count)
+        self.count += 1
+        return type(cpu).step(cpu)
+
+    def records(self):
+        # The records in the ring, oldest first
+        first = max(self.count - self.capacity, 0)
+        for i in range(first, self.count):
+            yield self.RECORD.unpack_from(self.buffer, (i % self.capacity) * self.RECORD.size)
+
+    def lines(self):
+        instructions = self.bus.cpu.instructions
+        for pc, opcode, low, high, a, x, y, p, sp, scanline, dot, cycle in self.records():
+            item = instructions[opcode]
+            code = "{:02X} {:02X} {:02X}".format(opcode, low, high)[:2 + 3 * OPERAND_SIZES[item.addr_mode]]
+            yield "{:04X}  {:<9}{}{:<32}A:{:02X} X:{:02X} Y:{:02X} P:{:02X} SP:{:02X} PPU:{:3d},{:3d} CYC:{}".format(
+                pc, code, "*" if unofficial(item, opcode) else " ", disassemble(item, pc, low | (high << 8)),
+                a, x, y, p, sp, scanline, dot, cycle)
+
+    def write_log(self, path):
+        with open(path, "w") as file:
+            for line in self.lines():
+                file.write(line + "\n")
+
+
+def parse_line(line):
+    # Fields of a line of a nestest style log
+    registers = line.index("A:")
+    head = line[:registers]
+    fields = {"PC": head[0:4], "bytes": head[6:15].strip(),
+              "instruction": head[16:].split(" = ")[0].split(" @ ")[0].strip()}
+    for part in re.sub(r"([:,])\s+", r"\1", line[registers:]).split():
+        name, _, value = part.partition(":")
+        fields[name] = value
+    return fields
+
+
+def diff_logs(lines, golden, ignore=()):
+    # First line where the log differs from the golden one as (line number, line, golden line, differing fields),
+    # or None when they agree for as long as both go
+    for number, (line, expected) in enumerate(zip(lines, golden), 1):
+        fields = parse_line(line)
+        expected_fields = parse_line(expected)
+        different = [name for name in FIELDS if name not in ignore and fields.get(name) != expected_fields.get(name)]
+        if different:
+            return number, line, expected, different
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trace a rom and compare it with a nestest style golden log")
+    parser.add_argument("rom")
+    parser.add_argument("golden", help="golden log, e.g. nestest.log")
+    parser.add_argument("--start", help="address to start at instead of the reset vector, C000 for nestest")
+    parser.add_argument("--ignore", default="", help="comma separated fields left out of the comparison")
+    parser.add_argument("--log", help="also write the trace to this file")
+    args = parser.parse_args()
+
+    with open(args.golden) as file:
+        golden = [line.rstrip("\n") for line in file if line.strip()]
+    nes = Nes(verbose=False)
+    nes.insert_cart(args.rom)
+    nes.reset()
+    if args.start:
+        nes.cpu.pc = int(args.start, 16)
+    trace = Trace(nes, len(golden) + 1024)  # room for the instructions past the last line in the final scanline
+    trace.start()
+    try:
+        while trace.count < len(golden):
+            nes.run_until(nes.system_clock_counter + 341)
+    except Exception as error:
+        print("stopped after {} instructions: {}: {}".format(trace.count, type(error).__name__, error))
+    trace.stop()
+    lines = list(trace.lines())[:len(golden)]
+    if args.log:
+        trace.write_log(args.log)
+    difference = diff_logs(lines, golden, args.ignore.split(","))
+    if difference is None and len(lines) == len(golden):
+        print("all {} lines match".format(len(golden)))
+        sys.exit(0)
+    if difference is None:
+        print("the trace stopped after {} of {} lines".format(len(lines), len(golden)))
+        sys.exit(1)
+    number, line, expected, fields = difference
+    print("first difference on line {} in {}".format(number, ", ".join(fields)))
+    if number > 1:
+        print("  before  " + lines[number - 2])
+    print("  trace   " + line)
+    print("  golden  " + expected)
+    sys.exit(1)
@@ -0,0 +1,122 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from Bus import Bus
+
+
+# Runs K machines of one rom in lockstep, for reinforcement learning style workloads. step() hands every machine
+# its controller byte, advances them all by the same number of frames and returns their pictures stacked into one
+# (K, 240, 256) array of palette indices together with the frames each machine ran since it was reset.
+# The machines can be spread over worker processes. Each steps its share and writes the pictures straight into the
+# array, which lives in shared memory, so only the actions and the frame counters go through the pipes
+
+
+class Machines:
+    # A group of machines stepped together, each writing its picture into its row of observations. The first
+    # machine boots the rom and the others are clones of it
+    def __init__(self, rom, count, observations):
+        nes = Bus(verbose=False)
+        nes.insert_cart(rom)
+        nes.reset()
+        self.first_picture = nes.run_frame(indices=True).copy()
+        self.start = nes.save_state()  # every machine starts from the end of the first frame
+        self.machines = [nes] + [nes.clone() for _ in range(count - 1)]
+        self.observations = observations
+        self.frames = np.zeros(count, dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        for nes in self.machines:
+            nes.load_state(self.start)
+        self.observations[:] = self.first_picture
+        self.frames[:] = 0
+        return self.frames
+
+    def step(self, actions, frames):
+        for i, (nes, action) in enumerate(zip(self.machines, actions)):
+            nes.controller[0] = int(action)
+            self.observations[i] = nes.run_frames(frames, indices=True)
+        self.frames += frames
+        return self.frames
+
+
+def worker(connection, rom, first, count, memory_name, shape):
+    # Worker process running machines first to first + count - 1 until told to close
+    memory = shared_memory.SharedMemory(name=memory_name)
+    observations = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)
+    machines = Machines(rom, count, observations[first:first + count])
+    connection.send(machines.frames)
+    while True:
+        command, args = connection.recv()
+        if command == "step":
+            connection.send(machines.step(*args))
+        elif command == "reset":
+            connection.send(machines.reset())
+        else:
+            break
+    del machines, observations
+    memory.close()
+
+
+class VecEnv:
+    def __init__(self, rom, instances, processes=0, action_repeat=1):
+        # With processes the machines are split over that many worker processes, otherwise they run in this one
+        self.instances = instances
+        self.action_repeat = action_repeat  # frames each step runs with the same actions
+        shape = (instances, 240, 256)
+        processes = min(processes, instances)
+        self.bounds = np.linspace(0, instances, max(processes, 1) + 1).astype(int)  # machines of each worker
+        self.memory = None
+        self.connections = []
+        self.processes = []
+        if not processes:
+            self.observations = np.zeros(shape, dtype=np.uint8)
+            self.machines = Machines(rom, instances, self.observations)
+            self.frames = self.machines.frames
+            return
+        self.memory = shared_memory.SharedMemory(create=True, size=instances * 240 * 256)
+        self.observations = np.ndarray(shape, dtype=np.uint8, buffer=self.memory.buf)
+        for first, last in zip(self.bounds[:-1], self.bounds[1:]):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=worker, args=(child, rom, first, last - first, self.memory.name,
+                                                                   shape), daemon=True)
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.frames = np.concatenate([connection.recv() for connection in self.connections])
+
+    def reset(self):
+        # Put every machine back to the start and return the observations
+        if not self.connections:
+            self.machines.reset()
+            return self.observations
+        for connection in self.connections:
+            connection.send(("reset", ()))
+        self.frames = np.concatenate([connection.recv() for connection in self.connections])
+        return self.observations
+
+    def step(self, actions, frames=None):
+        # Run every machine for action_repeat frames, or frames, with its controller byte from actions, and return
+        # the observations and frame counters. Both arrays are overwritten by the next step
+        frames = frames or self.action_repeat
+        actions = np.asarray(actions, dtype=np.uint8)
+        if not self.connections:
+            self.machines.step(actions, frames)
+            return self.observations, self.frames
+        for connection, first, last in zip(self.connections, self.bounds[:-1], self.bounds[1:]):
+            connection.send(("step", (actions[first:last], frames)))
+        self.frames = np.concatenate([connection.recv() for connection in self.connections])
+        return self.observations, self.frames
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(("close", ()))
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+        if self.memory is not None:
+            del self.observations
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
@@ -0,0 +1,74 @@
+import sys
+import time
+from Bus import Bus as Nes
+
+# Micro benchmarks of the emulator's hot paths. Run as
+#   python benchmark.py <rom> [frames]
+
+
+def boot(rom, dot_exact=False, use_blocks=False, frames=3):
+    # A system that has run the rom for a few frames, so the ppu is rendering when it is measured
+    nes = Nes(verbose=False)
+    nes.insert_cart(rom)
+    nes.ppu.dot_exact = dot_exact
+    nes.cpu.use_blocks = use_blocks
+    nes.reset()
+    nes.run_frames(frames)
+    return nes
+
+
+def ppu_dot(nes, dots=341 * 262):
+    # Seconds per ppu dot on the exact path, clock() called on its own with the cpu out of the way
+    clock = nes.ppu.clock
+    start = time.perf_counter()
+    for _ in range(dots):
+        clock()
+    return (time.perf_counter() - start) / dots
+
+
+def frame(nes, frames=10):
+    # Seconds per frame of the whole system
+    start = time.perf_counter()
+    nes.run_frames(frames)
+    return (time.perf_counter() - start) / frames
+
+
+def shown_frame(nes, run_ahead=0, frames=10):
+    # Seconds per frame shown by a front end, which converts every picture, with run_ahead frames of run ahead
+    nes.run_ahead = run_ahead
+    start = time.perf_counter()
+    for _ in range(frames):
+        nes.run_frame()
+    nes.run_ahead = 0
+    return (time.perf_counter() - start) / frames
+
+
+def snapshot(nes, count=1000):
+    # Seconds to save a state and load it again
+    start = time.perf_counter()
+    for _ in range(count):
+        nes.load_state(nes.save_state())
+    return (time.perf_counter() - start) / count
+
+
+def clone(nes, count=1000):
+    # Seconds to branch off a copy of the machine
+    start = time.perf_counter()
+    for _ in range(count):
+        nes.clone()
+    return (time.perf_counter() - start) / count
+
+
+if __name__ == "__main__":
+    rom = sys.argv[1]
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    results = [("frame", frame(boot(rom), frames) * 1e3, "ms"),
+               ("blocks", frame(boot(rom, use_blocks=True), frames) * 1e3, "ms"),
+               ("shown", shown_frame(boot(rom), 0, frames) * 1e3, "ms"),
+               ("ahead 1", shown_frame(boot(rom), 1, frames) * 1e3, "ms"),
+               ("ahead 2", shown_frame(boot(rom), 2, frames) * 1e3, "ms"),
+               ("snapshot", snapshot(boot(rom)) * 1e6, "us"),
+               ("clone", clone(boot(rom)) * 1e6, "us"),
+               ("ppu dot", ppu_dot(boot(rom, dot_exact=True)) * 1e6, "us")]
+    for name, value, unit in results:
+        print("{:<10}{:10.3f} {}".format(name, value, unit))
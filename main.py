@@ -1,12 +1,13 @@
-from time import sleep
+import cv2
 from Bus import Bus as Nes
+from Rewind import Rewind
 
 
 nes = Nes()
 # nes.insert_cart("roms/testroms/nestest.nes")
-# nes.insert_cart("roms/testroms/official_only.nes")  # requires mapper001
-# nes.insert_cart("roms/testroms/all_instrs.nes")  # requires mapper001
-# nes.insert_cart("roms/testroms/instr_timing.nes")  # requires mapper001
+# nes.insert_cart("roms/testroms/official_only.nes")
+# nes.insert_cart("roms/testroms/all_instrs.nes")
+# nes.insert_cart("roms/testroms/instr_timing.nes")
 # nes.insert_cart("roms/testroms/cpu_dummy_writes_ppumem.nes")
 
 nes.insert_cart("roms/Donkey Kong Jr. (JU) [p1].nes")
@@ -16,12 +17,36 @@ nes.insert_cart("roms/Donkey Kong Jr. (JU) [p1].nes")
 # nes.insert_cart("roms/Mario Bros (JU).nes")
 # nes.insert_cart("roms/Donkey Kong (JU) [p1].nes")
 nes.reset()
+rewind = Rewind(nes)
+# nes.run_ahead = 1  # show the frame after the current one, a frame less input lag at about twice the cost
 # nes.cpu.pc = 0xC000
 
 # nes.cart.PRG_memory[0x00: 0x0A] = [0xea, 0x20, 0x08, 0x80, 0x4c, 0x02, 0x40, 0x0ea, 0x60, 0xea, 0xea]
 # nes.cpu.pc = 0x8000
 while not nes.please_break:
-    nes.clock()
+    screen = nes.run_frame()
+    rewind.record()
     if nes.please_break:
         print("error reading or writing detected")
-    sleep(0.0)
+
+    cv2.imshow("screen_image", screen)
+    # nes.ppu.get_name_table(0, 1)
+    # cv2.imshow("nametable", nes.ppu.name_table_sprite[0])
+    # cv2.imshow("pattertable1", nes.ppu.get_pattern_table(0, nes.ppu.selected_palette))
+    # cv2.imshow("patterntable2", nes.ppu.get_pattern_table(1, nes.ppu.selected_palette))
+    key = cv2.waitKey(1)
+    if key == ord("w"):
+        print("pressing up")
+        nes.controller[0] = 0b1000
+    elif key == ord("s"):
+        print("pressing down")
+        nes.controller[0] = 0b100
+    elif key == ord("i"):
+        print("pressing start")
+        nes.controller[0] = 0b10000
+    elif key == ord("r"):
+        print("rewinding a second")
+        nes.controller[0] = 0
+        rewind.restore(60)
+    else:
+        nes.controller[0] = 0
@@ -0,0 +1,274 @@
+import os
+import sys
+import random
+import tempfile
+import numpy as np
+from Bus import Bus as Nes
+from OLC6502 import OLC6502
+from Instructions import OPERAND_SIZES
+from Trace import Trace, diff_logs, unofficial
+
+# Regression checks on roms generated here, so nothing but the emulator is needed. Run as
+#   python regression.py [frames]
+# The shortcuts the emulator takes have to end up with the same machine as the plain paths: the ppu rendering whole
+# scanlines against the dot exact ppu, and the translated blocks against stepping one instruction at a time. Both
+# are compared frame by frame, the picture and the ram. An mmc3 irq has to be taken again after an nmi returned,
+# and a trace of code laid out like the start of nestest has to match the first lines of nestest.log. P has to read
+# as it does in nestest.log around PLP and BRK, without B
+
+OPCODES = {}  # opcode of each official (name, addressing mode)
+for _opcode, _item in enumerate(OLC6502.instructions):
+    if not unofficial(_item, _opcode):
+        OPCODES.setdefault((_item.name, _item.addr_mode), _opcode)
+
+
+def assemble(origin, program):
+    # Machine code of a program given as labels and (name, addressing mode, operand) tuples, the operand may be a
+    # label and is left out for IMP. Returns the code and the address of every label
+    labels = {}
+    for _ in range(2):  # the first pass finds the labels
+        code = bytearray()
+        for line in program:
+            if isinstance(line, str):
+                labels[line] = origin + len(code)
+                continue
+            name, mode, operand = line if len(line) == 3 else line + (0,)
+            if isinstance(operand, str):
+                operand = labels.get(operand, 0)
+            if mode == "REL":
+                operand = (operand - origin - len(code) - 2) & 0xFF
+            code += bytes([OPCODES[(name, mode)], operand & 0xFF, operand >> 8])[:1 + OPERAND_SIZES[mode]]
+    return code, labels
+
+
+def write_rom(path, program, chr_rom=b"", mapper=0, prg_banks=1, pieces=()):
+    # iNES file whose last 16kb PRG bank holds program from 0xC000, pieces of (address, program) placed after it
+    # and the nmi, reset and irq vectors pointing at the labels of those names. Without chr rom the cart has chr ram
+    prg = bytearray(0x4000 * prg_banks)
+    last = len(prg) - 0x4000
+    code, labels = assemble(0xC000, program)
+    prg[last:last + len(code)] = code
+    for address, piece in pieces:
+        code, _ = assemble(address, piece)
+        prg[last + address - 0xC000:last + address - 0xC000 + len(code)] = code
+    prg[-6:] = b"".join(labels[name].to_bytes(2, "little") for name in ("nmi", "reset", "irq"))
+    header = b"NES\x1a" + bytes([prg_banks, len(chr_rom) // 0x2000, (mapper & 0x0F) << 4, mapper & 0xF0]) + bytes(8)
+    with open(path, "wb") as file:
+        file.write(header + prg + chr_rom)
+
+
+def wait_vblank(label):
+    return [label, ("BIT", "ABS", 0x2002), ("BPL", "REL", label)]
+
+
+# Fills the palette, the nametables and the sprites, then changes the scroll and the bank of the background
+# patterns part way down every frame, turns the sprites off further down and writes vram while rendering
+RENDER = ([
+    "reset", ("SEI", "IMP"), ("CLD", "IMP"), ("LDX", "IMM", 0xFF), ("TXS", "IMP"), ("LDA", "IMM", 0x00),
+    ("STA", "ABS", 0x2000), ("STA", "ABS", 0x2001), ("STA", "ZP0", 0x10), ("STA", "ZP0", 0x11)] +
+    wait_vblank("vblank1") + wait_vblank("vblank2") + [
+    ("LDA", "IMM", 0x3F), ("STA", "ABS", 0x2006), ("LDA", "IMM", 0x00), ("STA", "ABS", 0x2006), ("LDX", "IMM", 0x00),
+    "palette", ("TXA", "IMP"), ("ASL", "IMP"), ("ADC", "ZP0", 0x11), ("AND", "IMM", 0x3F), ("STA", "ABS", 0x2007),
+    ("INX", "IMP"), ("CPX", "IMM", 0x20), ("BNE", "REL", "palette"),
+    ("LDA", "IMM", 0x20), ("STA", "ABS", 0x2006), ("LDA", "IMM", 0x00), ("STA", "ABS", 0x2006), ("LDY", "IMM", 0x08),
+    ("LDX", "IMM", 0x00), ("STX", "ZP0", 0x01),
+    "nametables", ("TXA", "IMP"), ("CLC", "IMP"), ("ADC", "ZP0", 0x01), ("STA", "ABS", 0x2007), ("INX", "IMP"),
+    ("BNE", "REL", "nametables"), ("INC", "ZP0", 0x01), ("INC", "ZP0", 0x01), ("INC", "ZP0", 0x01), ("DEY", "IMP"),
+    ("BNE", "REL", "nametables"),
+    ("LDA", "IMM", 0x00), ("STA", "ABS", 0x2003),
+    "sprites", ("TXA", "IMP"), ("ASL", "IMP"), ("ASL", "IMP"), ("ADC", "ZP0", 0x01), ("STA", "ABS", 0x2004),
+    ("INX", "IMP"), ("BNE", "REL", "sprites"),
+    ("LDA", "IMM", 0x80), ("STA", "ABS", 0x2000), ("LDA", "IMM", 0x1E), ("STA", "ABS", 0x2001),
+    "main", ("LDA", "ZP0", 0x10),
+    "wait", ("CMP", "ZP0", 0x10), ("BEQ", "REL", "wait"), ("LDX", "IMM", 0x00), ("LDY", "IMM", 0x05),
+    "delay1", ("DEX", "IMP"), ("BNE", "REL", "delay1"), ("DEY", "IMP"), ("BNE", "REL", "delay1"),
+    ("LDA", "ZP0", 0x11), ("STA", "ABS", 0x2005), ("LDA", "IMM", 0x00), ("STA", "ABS", 0x2005), ("LDA", "IMM", 0x91),
+    ("STA", "ABS", 0x2000), ("LDY", "IMM", 0x03),
+    "delay2", ("DEX", "IMP"), ("BNE", "REL", "delay2"), ("DEY", "IMP"), ("BNE", "REL", "delay2"),
+    ("LDA", "IMM", 0x08), ("STA", "ABS", 0x2001), ("LDA", "IMM", 0x21), ("STA", "ABS", 0x2006), ("LDA", "ZP0", 0x10),
+    ("STA", "ABS", 0x2006), ("JMP", "ABS", "main"),
+    "nmi", ("PHA", "IMP"), ("INC", "ZP0", 0x10), ("INC", "ZP0", 0x11), ("INC", "ZP0", 0x11), ("LDA", "IMM", 0x80),
+    ("STA", "ABS", 0x2000), ("LDA", "IMM", 0x1E), ("STA", "ABS", 0x2001), ("LDA", "ZP0", 0x10),
+    ("STA", "ABS", 0x2005), ("LDA", "ZP0", 0x11), ("STA", "ABS", 0x2005), ("PLA", "IMP"), ("RTI", "IMP"),
+    "irq", ("RTI", "IMP")])
+
+# Counts mmc3 irqs at 0x10 and nmis at 0x11. Interrupts are enabled once, so the irqs stop when an nmi returns with
+# I set
+IRQ_AFTER_NMI = [
+    "reset", ("SEI", "IMP"), ("LDX", "IMM", 0xFF), ("TXS", "IMP"), ("LDA", "IMM", 0x00), ("STA", "ZP0", 0x10),
+    ("STA", "ZP0", 0x11), ("LDA", "IMM", 0x20), ("STA", "ABS", 0xC000), ("STA", "ABS", 0xC001), ("STA", "ABS", 0xE001),
+    ("LDA", "IMM", 0x18), ("STA", "ABS", 0x2001), ("LDA", "IMM", 0x88), ("STA", "ABS", 0x2000), ("CLI", "IMP"),
+    "loop", ("JMP", "ABS", "loop"),
+    "nmi", ("INC", "ZP0", 0x11), ("RTI", "IMP"),
+    "irq", ("STA", "ABS", 0xE000), ("STA", "ABS", 0xE001), ("INC", "ZP0", 0x10), ("RTI", "IMP")]
+
+# The code of the first lines of nestest.log at the same addresses, and those lines
+NESTEST = [
+    "reset", "nmi", "irq", ("JMP", "ABS", 0xC5F5)]
+NESTEST_PIECES = [
+    (0xC5F5, [("LDX", "IMM", 0x00), ("STX", "ZP0", 0x00), ("STX", "ZP0", 0x10), ("STX", "ZP0", 0x11),
+              ("JSR", "ABS", 0xC72D)]),
+    (0xC72D, [("NOP", "IMP"), ("SEC", "IMP"), ("BCS", "REL", 0xC735)]),
+    (0xC735, [("NOP", "IMP"), ("CLC", "IMP"), ("BCS", "REL", 0xC73C), ("JMP", "ABS", 0xC739)])]
+NESTEST_LOG = """\
+C000  4C F5 C5  JMP $C5F5                       A:00 X:00 Y:00 P:24 SP:FD PPU:  0, 21 CYC:7
+C5F5  A2 00     LDX #$00                        A:00 X:00 Y:00 P:24 SP:FD PPU:  0, 30 CYC:10
+C5F7  86 00     STX $00 = 00                    A:00 X:00 Y:00 P:26 SP:FD PPU:  0, 36 CYC:12
+C5F9  86 10     STX $10 = 00                    A:00 X:00 Y:00 P:26 SP:FD PPU:  0, 45 CYC:15
+C5FB  86 11     STX $11 = 00                    A:00 X:00 Y:00 P:26 SP:FD PPU:  0, 54 CYC:18
+C5FD  20 2D C7  JSR $C72D                       A:00 X:00 Y:00 P:26 SP:FD PPU:  0, 63 CYC:21
+C72D  EA        NOP                             A:00 X:00 Y:00 P:26 SP:FB PPU:  0, 81 CYC:27
+C72E  38        SEC                             A:00 X:00 Y:00 P:26 SP:FB PPU:  0, 87 CYC:29
+C72F  B0 04     BCS $C735                       A:00 X:00 Y:00 P:27 SP:FB PPU:  0, 93 CYC:31
+C735  EA        NOP                             A:00 X:00 Y:00 P:27 SP:FB PPU:  0,102 CYC:34
+C736  18        CLC                             A:00 X:00 Y:00 P:27 SP:FB PPU:  0,108 CYC:36"""
+
+# PLP of $FF reads back as $EF, BRK pushes B but leaves it clear in P. The P of each traced line, and the byte BRK
+# pushed, stored at 0x10
+NESTEST_STATUS = [
+    "reset", ("LDA", "IMM", 0xFF), ("PHA", "IMP"), ("PLP", "IMP"), ("LDA", "IMM", 0x00), ("PHA", "IMP"), ("PLP", "IMP"),
+    ("BRK", "IMM", 0x00),
+    "nmi", "irq", ("PLA", "IMP"), ("STA", "ZP0", 0x10), "loop", ("JMP", "ABS", "loop")]
+NESTEST_STATUS_P = ["24", "A4", "A4", "EF", "6F", "6F", "20", "24", "24"]
+
+RANDOM_OPERATIONS = ("ADC", "AND", "ASL", "BIT", "CLC", "CLV", "CMP", "CPX", "CPY", "DEC", "DEX", "DEY", "EOR", "INC",
+                     "INX", "INY", "LDA", "LDX", "LDY", "LSR", "NOP", "ORA", "ROL", "ROR", "SBC", "SEC", "STA", "STX",
+                     "STY", "TAX", "TAY", "TXA", "TYA")
+BRANCHES = ("BCC", "BCS", "BEQ", "BNE", "BMI", "BPL", "BVC", "BVS")
+
+
+def random_program(seed, length=3000):
+    # Straight line code of random instructions on ram with short forward branches, subroutine calls and pushes,
+    # run in a loop. Zero page starts out as pointers into 0x0200 - 0x05FF
+    rnd = random.Random(seed)
+    modes = {}
+    for name, mode in OPCODES:
+        if name in RANDOM_OPERATIONS:
+            modes.setdefault(name, []).append(mode)
+    program = ["reset", ("LDX", "IMM", 0xFF), ("TXS", "IMP"), ("LDX", "IMM", 0x00),
+               "pointers", ("TXA", "IMP"), ("AND", "IMM", 0x03), ("ORA", "IMM", 0x02), ("STA", "ZPX", 0x00),
+               ("INX", "IMP"), ("BNE", "REL", "pointers"), "loop"]
+    pushed = 0
+    for i in range(length):
+        name = rnd.choice(RANDOM_OPERATIONS)
+        mode = rnd.choice(modes[name])
+        if mode in ("ABS", "ABX", "ABY"):
+            program.append((name, mode, 0x0200 + rnd.randrange(0x400)))
+        else:
+            program.append((name, mode, rnd.randrange(0x100)))
+        choice = rnd.random()
+        if choice < 0.05:
+            program += [(rnd.choice(BRANCHES), "REL", "skip{}".format(i)), ("INC", "ABS", 0x0300), "skip{}".format(i)]
+        elif choice < 0.07:
+            program.append(("JSR", "ABS", "subroutine"))
+        elif choice < 0.09 and pushed < 8:
+            program.append((rnd.choice(("PHA", "PHP")), "IMP"))
+            pushed += 1
+        elif choice < 0.11 and pushed:
+            program.append((rnd.choice(("PLA", "PLP")), "IMP"))
+            pushed -= 1
+    program += [("PLA", "IMP")] * pushed
+    return program + [("JMP", "ABS", "loop"), "subroutine", ("INC", "ABS", 0x0301), ("RTS", "IMP"),
+                      "nmi", "irq", ("RTI", "IMP")]
+
+
+def run(rom, frames, dot_exact=False, use_blocks=False):
+    # Pictures of every frame and the ram at the end
+    nes = Nes(verbose=False)
+    nes.insert_cart(rom)
+    nes.ppu.dot_exact = dot_exact
+    nes.cpu.use_blocks = use_blocks
+    nes.reset()
+    pictures = [np.array(nes.run_frame()) for _ in range(frames)]
+    return pictures, bytes(nes.cpuram.ram)
+
+
+def compare(name, rom, frames, **paths):
+    # Failure messages for every path in paths that gives a different machine than the plain one
+    pictures, ram = run(rom, frames)
+    failures = []
+    for path, settings in paths.items():
+        other_pictures, other_ram = run(rom, frames, **settings)
+        different = [i for i, (picture, other) in enumerate(zip(pictures, other_pictures))
+                     if not np.array_equal(picture, other)]
+        if different:
+            failures.append("{} {}: frame {} differs".format(name, path, different[0]))
+        elif ram != other_ram:
+            failures.append("{} {}: ram differs".format(name, path))
+    return failures
+
+
+def irq_after_nmi(rom, frames):
+    nes = Nes(verbose=False)
+    nes.insert_cart(rom)
+    nes.reset()
+    irqs = []
+    for _ in range(frames):
+        nes.run_frame()
+        irqs.append(nes.cpuram.ram[0x10])
+    if nes.cpuram.ram[0x11] and len(set(irqs[-2:])) == 2:
+        return []
+    return ["irq after nmi: irqs stopped at {} after {} nmis".format(irqs[-1], nes.cpuram.ram[0x11])]
+
+
+def nestest_start(rom):
+    golden = NESTEST_LOG.splitlines()
+    nes = Nes(verbose=False)
+    nes.insert_cart(rom)
+    nes.reset()
+    nes.cpu.pc = 0xC000
+    trace = Trace(nes, 1024)
+    trace.start()
+    while trace.count < len(golden):
+        nes.run_until(nes.system_clock_counter + 341)
+    trace.stop()
+    difference = diff_logs(list(trace.lines())[:len(golden)], golden)
+    if difference is None:
+        return []
+    number, line, _, fields = difference
+    return ["nestest: line {} differs in {}: {}".format(number, ", ".join(fields), line)]
+
+
+def nestest_status(rom):
+    nes = Nes(verbose=False)
+    nes.insert_cart(rom)
+    nes.reset()
+    trace = Trace(nes, 1024)
+    trace.start()
+    while trace.count < len(NESTEST_STATUS_P) + 1:
+        nes.run_until(nes.system_clock_counter + 341)
+    trace.stop()
+    status = [line[line.index("P:") + 2:][:2] for line in list(trace.lines())[:len(NESTEST_STATUS_P)]]
+    failures = []
+    if status != NESTEST_STATUS_P:
+        failures.append("nestest status: P reads {} instead of {}".format(" ".join(status), " ".join(NESTEST_STATUS_P)))
+    if nes.cpuram.ram[0x10] != 0x30:
+        failures.append("nestest status: BRK pushed {:02X} instead of 30".format(nes.cpuram.ram[0x10]))
+    return failures
+
+
+if __name__ == "__main__":
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    rnd = random.Random(1)
+    patterns = bytes(rnd.randrange(256) for _ in range(0x2000))
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        roms = {name: os.path.join(directory, name + ".nes") for name in
+                ("render", "render_chr_ram", "random", "irq", "nestest", "nestest_status")}
+        write_rom(roms["render"], RENDER, patterns)
+        write_rom(roms["render_chr_ram"], RENDER)
+        write_rom(roms["random"], random_program(1), patterns, prg_banks=2)
+        write_rom(roms["irq"], IRQ_AFTER_NMI, mapper=4, prg_banks=2)
+        write_rom(roms["nestest"], NESTEST, pieces=NESTEST_PIECES)
+        write_rom(roms["nestest_status"], NESTEST_STATUS)
+        for name in ("render", "render_chr_ram"):
+            failures += compare(name, roms[name], frames, dot_exact={"dot_exact": True},
+                                blocks={"use_blocks": True})
+        failures += compare("random", roms["random"], frames, blocks={"use_blocks": True})
+        failures += irq_after_nmi(roms["irq"], 5)
+        failures += nestest_start(roms["nestest"])
+        failures += nestest_status(roms["nestest_status"])
+    for failure in failures:
+        print(failure)
+    print("{} failures".format(len(failures)) if failures else "all checks passed")
+    sys.exit(1 if failures else 0)